@@ -0,0 +1,7 @@
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# server reads its settings when imported; like run.py and manage.py, load
+# backend/.env first (variables already set win)
+load_dotenv(Path(__file__).parent.parent / '.env')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Measure catalog latency while a login storm hits the same worker.
+
+Start the API first with the auth rate limits raised, since every request
+comes from one IP, then from backend/:
+
+    LOGIN_RATE_LIMIT_IP=1000000000/60 LOGIN_RATE_LIMIT_EMAIL=1000000000/60 \
+        REGISTER_RATE_LIMIT_IP=1000000000/60 python run.py --workers 1
+    python -m benchmarks.bench_login_storm --url http://localhost:8001 --concurrency 32
+
+The /api/products probe runs alone first, then alongside the storm. With
+hashing on the event loop its p99 grows by the full hash cost per queued
+login; with the hashing pool it should stay close to the baseline.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import summarize
+
+
+async def probe(client: httpx.AsyncClient, duration: float):
+    samples = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get("/api/products", params={"limit": 20})
+        response.raise_for_status()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def login_loop(client: httpx.AsyncClient, credentials: dict, deadline: float, rejected: list):
+    samples = []
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.post("/api/auth/login", json=credentials)
+        if response.status_code == 429:
+            # Throttled logins never reach the hasher; timing them would flatter the result
+            rejected.append(response.status_code)
+            continue
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        users = []
+        for _ in range(args.users):
+            credentials = {"email": f"bench.{uuid.uuid4().hex[:10]}@example.com", "password": "BenchPass123!"}
+            response = await client.post(
+                "/api/auth/register", json={**credentials, "username": credentials["email"].split("@")[0]}
+            )
+            if response.status_code == 429:
+                raise SystemExit("Registration was rate limited; raise REGISTER_RATE_LIMIT_IP on the server")
+            response.raise_for_status()
+            users.append(credentials)
+
+        baseline = await probe(client, args.duration)
+
+        deadline = time.perf_counter() + args.duration
+        rejected = []
+        storm = [
+            asyncio.create_task(login_loop(client, users[i % len(users)], deadline, rejected))
+            for i in range(args.concurrency)
+        ]
+        during = await probe(client, args.duration)
+        logins = [sample for samples in await asyncio.gather(*storm) for sample in samples]
+
+    print(json.dumps({
+        "concurrency": args.concurrency,
+        "products_baseline": summarize(baseline),
+        "products_during_storm": summarize(during),
+        "logins": {**summarize(logins), "per_second": round(len(logins) / args.duration, 1),
+                   "rate_limited": len(rejected)},
+    }, indent=2))
+    if rejected:
+        print(f"{len(rejected)} login(s) were rate limited; raise LOGIN_RATE_LIMIT_IP and "
+              "LOGIN_RATE_LIMIT_EMAIL on the server", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Measure throughput as the number of API worker processes grows.
+
+For each worker count, starts ``run.py`` on a local port against the bench
+database, waits for /readyz, drives one benchmarks.load scenario at it and
+stops it. Reports throughput, p95 and scaling efficiency against one worker.
+Run from backend/ with MongoDB reachable through MONGO_URL:
+
+    python -m benchmarks.bench_scaling --workers 1 2 4 8 --scenario browse --concurrency 64
+
+The load generator is a single process on the same host. Once it saturates
+its own core, more workers stop helping. For high core counts, run it from
+another machine (benchmarks.load --url) or keep --concurrency high enough that
+requests queue on the server.
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def process_tree_rss_mb(pid: int) -> float:
+    # The gunicorn master plus its workers, Linux only
+    total = 0.0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) / 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return round(total, 1)
+
+
+def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/readyz", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {url} not ready after {timeout}s")
+
+
+def run_workers(workers: int, args, env: dict) -> dict:
+    url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, "run.py", "--workers", str(workers), "--bind", f"127.0.0.1:{args.port}",
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env
+    )
+    try:
+        wait_ready(url, args.startup_timeout)
+        with tempfile.NamedTemporaryFile(suffix=".json") as report_file:
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.load", "--url", url, "--scenario", args.scenario,
+                 "--products", str(args.products), "--users", str(args.users),
+                 "--concurrency", str(args.concurrency), "--duration", str(args.duration),
+                 "--save", report_file.name],
+                cwd=BACKEND_DIR, env=env, check=True, stdout=subprocess.DEVNULL
+            )
+            result = json.load(report_file)["scenarios"][args.scenario]
+        rss = process_tree_rss_mb(server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    p95 = max((stats["p95_ms"] for stats in result["operations"].values()), default=0.0)
+    return {
+        "workers": workers,
+        "throughput_rps": result["throughput_rps"],
+        "worst_p95_ms": p95,
+        "errors": result["errors"],
+        "rss_mb_total": rss,
+    }
+
+
+def main(args):
+    load_dotenv(BACKEND_DIR / ".env")
+    bench_db = os.environ.get("BENCH_DB_NAME", os.environ.get("DB_NAME", "test_database") + "_bench")
+    env = {
+        **os.environ,
+        "DB_NAME": bench_db,
+        "BENCH_DB_NAME": bench_db,
+        "LOGIN_RATE_LIMIT_IP": "1000000000/60",
+        "LOGIN_RATE_LIMIT_EMAIL": "1000000000/60",
+        "REGISTER_RATE_LIMIT_IP": "1000000000/60",
+    }
+
+    results = []
+    for workers in args.workers:
+        print(f"Running {args.scenario} against {workers} worker(s)...", file=sys.stderr)
+        results.append(run_workers(workers, args, env))
+
+    base = results[0]["throughput_rps"] / results[0]["workers"] if results and results[0]["throughput_rps"] else 0
+    for result in results:
+        # 1.0 means perfectly linear scaling from the first run
+        result["efficiency"] = round(result["throughput_rps"] / (base * result["workers"]), 2) if base else None
+    print(json.dumps({"cpu_count": os.cpu_count(), "scenario": args.scenario,
+                      "concurrency": args.concurrency, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cpus = os.cpu_count() or 1
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, cpus} & set(range(1, cpus + 1))))
+    parser.add_argument("--scenario", choices=["browse", "search", "login", "checkout", "mixed"], default="browse")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    main(parser.parse_args())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Compare the legacy in-Python substring scan with the Mongo text index.
+
+Run from backend/ against a scratch database:
+
+    python -m benchmarks.bench_search --products 5000 --iterations 50
+"""
+import argparse
+import asyncio
+import json
+import random
+
+import server
+from benchmarks.common import WORDS, bench_db, fake_product, summarize, time_calls
+
+
+async def legacy_scan(db, term: str):
+    products = await db.products.find({"is_active": True}).to_list(1000)
+    return [p for p in products if term in p["name"].lower() or term in p["description"].lower()]
+
+
+async def main(args):
+    client, db = bench_db()
+    rng = random.Random(args.seed)
+    try:
+        await db.products.drop()
+        batch = []
+        for i in range(args.products):
+            product = fake_product(rng, i)
+            product["search_terms"] = server.search_terms(product["name"])
+            batch.append(product)
+            if len(batch) == 1000:
+                await db.products.insert_many(batch)
+                batch = []
+        if batch:
+            await db.products.insert_many(batch)
+
+        server.db = db
+        await server.ensure_indexes()
+
+        terms = [rng.choice(WORDS) for _ in range(args.iterations)]
+        legacy_terms = iter(terms * 2)
+        indexed_terms = iter(terms * 2)
+        prefix_terms = iter(terms * 2)
+
+        results = {
+            "products": args.products,
+            "legacy_scan": summarize(await time_calls(
+                lambda: legacy_scan(db, next(legacy_terms)), args.iterations)),
+            "text_index": summarize(await time_calls(
+                lambda: server.search_products({"is_active": True}, next(indexed_terms), 50), args.iterations)),
+            "typeahead": summarize(await time_calls(
+                lambda: server.suggest_products(q=next(prefix_terms)[:3], limit=8), args.iterations)),
+        }
+        print(json.dumps(results, indent=2))
+    finally:
+        if not args.keep:
+            await db.products.drop()
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded collection")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare JSON serialization paths for catalog responses.
+
+Renders a page of product summaries and a product detail document the old
+way (raw Mongo dict through jsonable_encoder and json.dumps, legacy inline
+base64 included) and the current way (projected fields, response model,
+pydantic-core / orjson). Run from backend/:
+
+    python -m benchmarks.bench_serialization --page-size 50 --payload-kb 2048
+"""
+import argparse
+import json
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+import server
+from benchmarks.common import fake_product, summarize
+
+
+def legacy_render(content) -> bytes:
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def time_sync(fn, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    payload_size = args.payload_kb * 1024
+    # What Mongo returned before projections: every field, inline media included
+    raw_docs = []
+    for i in range(args.page_size):
+        doc = fake_product(rng, i, payload_size)
+        doc["image_base64"] = "B" * (payload_size // 8) if payload_size else None
+        doc["search_terms"] = server.search_terms(doc["name"])
+        raw_docs.append(doc)
+    projected = [{k: v for k, v in doc.items() if k in server.PRODUCT_SUMMARY_PROJECTION} for doc in raw_docs]
+
+    page = server.ProductPage(items=[server.product_summary(doc) for doc in projected])
+    detail = server.product_detail(projected[0])
+
+    cases = {
+        "page_legacy_raw_dicts": lambda: legacy_render(raw_docs),
+        "page_legacy_encoder_on_models": lambda: legacy_render(page),
+        "page_model_dump_json": lambda: server.render_json(page),
+        "page_orjson_response": lambda: server.ORJSONResponse(page.model_dump(mode="json")).body,
+        "detail_legacy_raw_dict": lambda: legacy_render(raw_docs[0]),
+        "detail_model_dump_json": lambda: server.render_json(detail),
+    }
+    results = {"page_size": args.page_size, "payload_kb": args.payload_kb}
+    for name, fn in cases.items():
+        size = len(fn())
+        results[name] = {**summarize(time_sync(fn, args.iterations)), "bytes": size}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--payload-kb", type=int, default=512, help="Legacy inline base64 size per product")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
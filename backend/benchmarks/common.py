@@ -0,0 +1,83 @@
+"""Shared helpers for the backend benchmarks."""
+import os
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+WORDS = [
+    "guide", "complet", "marketing", "digital", "débutant", "avancé", "méthode", "stratégie",
+    "réussir", "entreprise", "musique", "relaxation", "méditation", "vidéo", "formation",
+    "modèle", "présentation", "créatif", "intelligence", "artificielle", "prompts", "écriture",
+    "photographie", "cuisine", "santé", "finances", "personnelles", "productivité", "été", "noël",
+]
+
+CATEGORIES = ["ebooks", "templates", "audio", "videos", "ai_packs"]
+
+
+def bench_db():
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    name = os.environ.get("BENCH_DB_NAME", os.environ.get("DB_NAME", "test_database") + "_bench")
+    return client, client[name]
+
+
+def fake_product(rng: random.Random, index: int, payload_size: int = 0) -> dict:
+    name = " ".join(rng.choice(WORDS) for _ in range(3)).capitalize()
+    return {
+        "id": str(uuid.uuid4()),
+        "name": f"{name} {index}",
+        "description": " ".join(rng.choice(WORDS) for _ in range(30)),
+        "price": round(rng.uniform(1, 100), 2),
+        "category": rng.choice(CATEGORIES),
+        "file_base64": "A" * payload_size if payload_size else None,
+        "is_active": True,
+        "created_at": datetime.utcnow() - timedelta(seconds=index),
+        "created_by": "bench",
+    }
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def summarize(samples_ms: List[float]) -> Dict[str, float]:
+    return {
+        "n": len(samples_ms),
+        "mean_ms": round(statistics.fmean(samples_ms), 3) if samples_ms else 0.0,
+        "p50_ms": round(percentile(samples_ms, 50), 3),
+        "p95_ms": round(percentile(samples_ms, 95), 3),
+        "p99_ms": round(percentile(samples_ms, 99), 3),
+    }
+
+
+def process_rss_mb(pid: Optional[int] = None) -> Dict[str, float]:
+    """Current and peak resident set size of ``pid`` (default: this process), Linux only."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    fields[key] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        return {}
+    return {"current": fields.get("VmRSS", 0.0), "peak": fields.get("VmHWM", 0.0)}
+
+
+async def time_calls(fn: Callable[[], Awaitable], iterations: int) -> List[float]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Mixed-workload load test for the API, with JSON baselines.
+
+Seeds a scratch database with a configurable catalog, then drives each
+scenario with an async client at a fixed concurrency. Reports throughput,
+per-operation p50/p95/p99 latency and RSS. Run from backend/:
+
+    python -m benchmarks.load --products 2000 --concurrency 16 --duration 15 --save baseline.json
+    # ...change something, then:
+    python -m benchmarks.load --products 2000 --concurrency 16 --duration 15 --compare baseline.json
+
+By default the app runs in-process against the local Mongo from MONGO_URL,
+in the BENCH_DB_NAME database. --backend mongomock uses an in-memory stand-in
+(pip install mongomock-motor). It has no text search, so the search scenario
+only exercises typeahead. --url targets a running server started with
+DB_NAME set to the bench database; pass --server-pid to report its RSS. Its
+auth rate limits must be raised for the login scenarios.
+
+Scenarios: browse, search, login, checkout and mixed (weighted blend of all).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.common import CATEGORIES, WORDS, fake_product, process_rss_mb, summarize
+
+BENCH_PASSWORD = "BenchPass123!"
+SCENARIOS = ("browse", "search", "login", "checkout", "mixed")
+MIXED_WEIGHTS = {"browse": 60, "search": 20, "checkout": 15, "login": 5}
+
+
+def configure_environment(args) -> None:
+    # Must run before server is imported: it reads its config at import time
+    os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", os.environ.get("DB_NAME", "test_database") + "_bench")
+    for name in ("LOGIN_RATE_LIMIT_IP", "LOGIN_RATE_LIMIT_EMAIL", "REGISTER_RATE_LIMIT_IP"):
+        os.environ.setdefault(name, "1000000000/60")
+    if args.backend == "mongomock":
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+        os.environ["BLOB_BACKEND"] = "local"
+        os.environ["BLOB_ROOT"] = tempfile.mkdtemp(prefix="olyst-bench-blobs-")
+
+
+class Context:
+    def __init__(self, args, product_ids: List[str], users: List[dict]):
+        self.rng = random.Random(args.seed)
+        self.full_text = args.backend == "mongo"
+        self.product_ids = product_ids
+        self.users = users
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    async def call(self, client: httpx.AsyncClient, op: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.errors[f"{op}: {type(e).__name__}"] += 1
+            return None
+        self.samples[op].append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            self.errors[f"{op}: {response.status_code}"] += 1
+            return None
+        return response
+
+
+async def browse(ctx: Context, client: httpx.AsyncClient) -> None:
+    params = {"limit": 24}
+    if ctx.rng.random() < 0.5:
+        params["category"] = ctx.rng.choice(CATEGORIES)
+    response = await ctx.call(client, "GET /api/products", "GET", "/api/products", params=params)
+    if response is not None and response.json().get("next_cursor") and ctx.rng.random() < 0.3:
+        params["after"] = response.json()["next_cursor"]
+        await ctx.call(client, "GET /api/products (page 2)", "GET", "/api/products", params=params)
+    product_id = ctx.rng.choice(ctx.product_ids)
+    await ctx.call(client, "GET /api/products/{id}", "GET", f"/api/products/{product_id}")
+    if ctx.rng.random() < 0.2:
+        await ctx.call(client, "GET /api/categories", "GET", "/api/categories")
+
+
+async def search(ctx: Context, client: httpx.AsyncClient) -> None:
+    word = ctx.rng.choice(WORDS)
+    for length in (2, 4):
+        await ctx.call(client, "GET /api/products/suggest", "GET", "/api/products/suggest", params={"q": word[:length]})
+    if ctx.full_text:
+        await ctx.call(client, "GET /api/products?search", "GET", "/api/products", params={"search": word, "limit": 24})
+
+
+async def login(ctx: Context, client: httpx.AsyncClient) -> None:
+    user = ctx.rng.choice(ctx.users)
+    await ctx.call(client, "POST /api/auth/login", "POST", "/api/auth/login",
+                   json={"email": user["email"], "password": BENCH_PASSWORD})
+
+
+async def checkout(ctx: Context, client: httpx.AsyncClient) -> None:
+    user = ctx.rng.choice(ctx.users)
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    await ctx.call(client, "GET /api/auth/me", "GET", "/api/auth/me", headers=headers)
+    items = [{"product_id": product_id} for product_id in ctx.rng.sample(ctx.product_ids, k=min(3, len(ctx.product_ids)))]
+    order_headers = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+    response = await ctx.call(client, "POST /api/orders", "POST", "/api/orders", json={"items": items}, headers=order_headers)
+    if response is None:
+        return
+    if ctx.rng.random() < 0.2:
+        # Client retry after a timeout
+        await ctx.call(client, "POST /api/orders (retry)", "POST", "/api/orders", json={"items": items}, headers=order_headers)
+    await ctx.call(client, "GET /api/orders/{id}", "GET", f"/api/orders/{response.json()['id']}", headers=headers)
+    await ctx.call(client, "GET /api/me/library", "GET", "/api/me/library", headers=headers, params={"limit": 20})
+
+
+STEPS = {"browse": browse, "search": search, "login": login, "checkout": checkout}
+
+
+async def mixed(ctx: Context, client: httpx.AsyncClient) -> None:
+    name = ctx.rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+    await STEPS[name](ctx, client)
+
+
+async def seed(server, args) -> List[str]:
+    rng = random.Random(args.seed)
+    for name in ("products", "users", "auth_sessions", "orders", "entitlements"):
+        await server.db[name].delete_many({})
+
+    files = []
+    for _ in range(min(args.distinct_files, args.products) if args.file_size else 0):
+        blob = await server.blob_store.put_bytes(rng.randbytes(args.file_size))
+        files.append(blob)
+
+    product_ids = []
+    batch = []
+    for i in range(args.products):
+        product = fake_product(rng, i)
+        product.pop("file_base64")
+        product["search_terms"] = server.search_terms(product["name"])
+        if files:
+            blob = files[i % len(files)]
+            product.update(file_blob_id=blob.id, file_name=f"bench-{i}.bin",
+                           file_type="application/octet-stream", file_size=blob.size)
+        batch.append(product)
+        product_ids.append(product["id"])
+        if len(batch) == 1000:
+            await server.db.products.insert_many(batch)
+            batch = []
+    if batch:
+        await server.db.products.insert_many(batch)
+    return product_ids
+
+
+async def seed_users(server, client: httpx.AsyncClient, count: int) -> List[dict]:
+    # One hash for every account keeps seeding fast; logins still verify it
+    password_hash = await server.password_hasher.hash(BENCH_PASSWORD)
+    users = []
+    for i in range(count):
+        email = f"bench{i}@example.com"
+        await server.db.users.insert_one(server.User(email=email, username=f"bench{i}", password_hash=password_hash).dict())
+        response = await client.post("/api/auth/login", json={"email": email, "password": BENCH_PASSWORD})
+        response.raise_for_status()
+        users.append({"email": email, "token": response.json()["token"]})
+    return users
+
+
+async def run_scenario(name: str, ctx: Context, client: httpx.AsyncClient, args) -> dict:
+    step = mixed if name == "mixed" else STEPS[name]
+    ctx.samples.clear()
+    ctx.errors.clear()
+
+    async def worker(deadline: float):
+        while time.perf_counter() < deadline:
+            await step(ctx, client)
+
+    await asyncio.gather(*(worker(time.perf_counter() + args.warmup) for _ in range(args.concurrency)))
+    ctx.samples.clear()
+    ctx.errors.clear()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(started + args.duration) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    requests = sum(len(samples) for samples in ctx.samples.values())
+    return {
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 2),
+        "requests": requests,
+        "throughput_rps": round(requests / elapsed, 1),
+        "errors": dict(ctx.errors),
+        "operations": {op: summarize(samples) for op, samples in sorted(ctx.samples.items())},
+        "rss_mb": process_rss_mb(args.server_pid if args.url else None),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """Return regressions: p95 or throughput worse than ``threshold`` percent."""
+    regressions = []
+    print(f"\n{'scenario / operation':58} {'base p95':>9} {'now p95':>9} {'delta':>8}")
+    for name, result in current["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            continue
+        drop = (base["throughput_rps"] - result["throughput_rps"]) / base["throughput_rps"] * 100 if base["throughput_rps"] else 0
+        print(f"{name + ' throughput (rps)':58} {base['throughput_rps']:>9} {result['throughput_rps']:>9} {-drop:>+7.1f}%")
+        if drop > threshold:
+            regressions.append(f"{name}: throughput down {drop:.1f}%")
+        for op, stats in result["operations"].items():
+            base_stats = base["operations"].get(op)
+            if not base_stats or not base_stats["p95_ms"]:
+                continue
+            delta = (stats["p95_ms"] - base_stats["p95_ms"]) / base_stats["p95_ms"] * 100
+            print(f"  {op:56} {base_stats['p95_ms']:>9} {stats['p95_ms']:>9} {delta:>+7.1f}%")
+            # Ignore sub-millisecond noise on very fast operations
+            if delta > threshold and stats["p95_ms"] - base_stats["p95_ms"] > 1:
+                regressions.append(f"{name} / {op}: p95 up {delta:.1f}%")
+    return regressions
+
+
+async def main(args) -> int:
+    configure_environment(args)
+    import server
+
+    server.connect()
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        await server.ensure_indexes()
+        await server.invalidation_bus.start()
+        await server.response_cache.start()
+        await server.rate_limiter.start()
+        transport = httpx.ASGITransport(app=server.app)
+        base_url = "http://bench"
+
+    try:
+        product_ids = await seed(server, args)
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60) as client:
+            users = await seed_users(server, client, args.users)
+            ctx = Context(args, product_ids, users)
+            scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+            results = {}
+            for name in scenarios:
+                print(f"Running {name} for {args.duration}s at concurrency {args.concurrency}...", file=sys.stderr)
+                results[name] = await run_scenario(name, ctx, client, args)
+    finally:
+        if not args.url:
+            await server.invalidation_bus.stop()
+            server.password_hasher.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.utcnow().isoformat(),
+            "backend": "url" if args.url else args.backend,
+            "products": args.products,
+            "file_size": args.file_size,
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+        },
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--backend", choices=["mongo", "mongomock"], default="mongo")
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--server-pid", type=int, help="With --url, report this process's RSS")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--file-size", type=int, default=0, help="Bytes per product file (0: no files)")
+    parser.add_argument("--distinct-files", type=int, default=10)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", help="Write the report to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON to compare against; exits 1 on regression")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,100 @@
+"""Streaming NDJSON and CSV parsing and writing for bulk import and export.
+
+Uploads are read chunk by chunk and yielded one record at a time, so memory
+stays bounded by one row however large the file is. Parse errors are yielded
+in place of the record instead of aborting the import, which lets the caller
+report them per row.
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator, Iterable, Optional, Tuple, Union
+
+
+class RowError(Exception):
+    pass
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[bytes]:
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            yield line.rstrip(b"\r")
+        if len(buffer) > max_line_bytes:
+            raise RowError(f"line longer than {max_line_bytes} bytes")
+    if buffer:
+        yield bytes(buffer).rstrip(b"\r")
+
+
+async def parse_ndjson(lines: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Union[dict, RowError]]]:
+    row = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = json.loads(line)
+        except (UnicodeDecodeError, ValueError) as e:
+            yield row, RowError(f"invalid JSON: {e}")
+            continue
+        yield row, record if isinstance(record, dict) else RowError("expected a JSON object")
+
+
+async def parse_csv(lines: AsyncIterator[bytes],
+                    max_row_bytes: Optional[int] = None) -> AsyncIterator[Tuple[int, Union[dict, RowError]]]:
+    """Header row first; empty cells become None. Quoted fields may span lines."""
+    header: Optional[list] = None
+    pending: Optional[list] = None  # lines of a record whose quoted field is still open
+    pending_bytes = pending_quotes = 0
+    row = 0
+    async for line in lines:
+        try:
+            text = line.decode("utf-8-sig" if header is None and pending is None else "utf-8")
+        except UnicodeDecodeError as e:
+            row += 1
+            pending = None
+            yield row, RowError(f"invalid UTF-8: {e}")
+            continue
+        if pending is None:
+            pending, pending_bytes, pending_quotes = [text], len(line), text.count('"')
+        else:
+            pending.append(text)
+            pending_bytes += len(line) + 1
+            pending_quotes += text.count('"')
+        # An odd number of quotes means a quoted field continues on the next line
+        if pending_quotes % 2:
+            # Unbalanced quotes would otherwise pull the rest of the upload into one row
+            if max_row_bytes and pending_bytes > max_row_bytes:
+                raise RowError(f"row longer than {max_row_bytes} bytes")
+            continue
+        values = next(csv.reader(["\n".join(pending)]), [])
+        pending = None
+        if not any(values):
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, RowError(f"expected {len(header)} columns, got {len(values)}")
+            continue
+        yield row, {name: value if value != "" else None for name, value in zip(header, values)}
+    if pending is not None:
+        yield row + 1, RowError("unterminated quoted field")
+
+
+def parse_records(fmt: str, chunks: AsyncIterator[bytes], max_line_bytes: int):
+    lines = iter_lines(chunks, max_line_bytes)
+    return parse_csv(lines, max_line_bytes) if fmt == "csv" else parse_ndjson(lines)
+
+
+def csv_line(values: Iterable) -> str:
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerow(["" if value is None else value for value in values])
+    return out.getvalue()
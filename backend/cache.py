@@ -0,0 +1,338 @@
+"""In-process caches, the public response cache and cross-worker invalidation.
+
+Each uvicorn worker keeps its own caches. Writes that make cached data stale
+publish a message on an invalidation bus: the local bus only reaches the
+current process, the Mongo bus fans messages out to every worker through a
+capped collection.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, CursorType, IndexModel
+from pymongo.errors import CollectionInvalid, PyMongoError
+from starlette.requests import Request
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] < self.clock():
+            if entry is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        self._data[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def discard_where(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key, (_, value) in self._data.items() if predicate(value)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LocalInvalidationBus:
+    """Delivers invalidation messages to handlers in the current process only."""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[Any], None]]] = defaultdict(list)
+
+    def subscribe(self, channel: str, handler: Callable[[Any], None]) -> None:
+        self._handlers[channel].append(handler)
+
+    def dispatch(self, channel: str, message: Any) -> None:
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Invalidation handler failed on channel %s", channel)
+
+    async def publish(self, channel: str, message: Any) -> None:
+        self.dispatch(channel, message)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class MongoInvalidationBus(LocalInvalidationBus):
+    """Fans invalidation messages out to every worker through a capped collection."""
+
+    def __init__(self, db, collection_name: str = "cache_invalidations", size: int = 1024 * 1024,
+                 retry_interval: float = 1.0):
+        super().__init__()
+        self.db = db
+        self.collection_name = collection_name
+        self.size = size
+        self.retry_interval = retry_interval
+        self.origin = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    async def publish(self, channel: str, message: Any) -> None:
+        self.dispatch(channel, message)
+        await self.collection.insert_one({"channel": channel, "message": message, "origin": self.origin})
+
+    async def start(self) -> None:
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _listen(self) -> None:
+        # Only messages published after this worker started are relevant
+        last = await self.collection.find_one({}, sort=[("$natural", -1)])
+        last_id = last["_id"] if last else None
+        while True:
+            # Resume by position, not {"_id": {"$gt": last_id}}: ObjectIds made by
+            # different processes are not in insertion order. Documents up to
+            # last_id in natural order were seen; if last_id was overwritten
+            # meanwhile, what was skipped is delivered after all (invalidating
+            # twice is harmless, missing one is not)
+            skipped = [] if last_id else None
+            try:
+                cursor = self.collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        if skipped is not None:
+                            if doc["_id"] == last_id:
+                                skipped = None
+                            else:
+                                skipped.append(doc)
+                            continue
+                        last_id = doc["_id"]
+                        self._receive(doc)
+                    for doc in skipped or []:
+                        last_id = doc["_id"]
+                        self._receive(doc)
+                    skipped = None
+                    await asyncio.sleep(0.1)
+            except PyMongoError as e:
+                logger.warning("Invalidation listener error, retrying: %s", e)
+            await asyncio.sleep(self.retry_interval)
+
+    def _receive(self, doc: dict) -> None:
+        if doc.get("origin") != self.origin:
+            self.dispatch(doc["channel"], doc["message"])
+
+
+class MemoryResponseBackend:
+    """Per-worker response store; invalidated on every worker through the bus."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def start(self) -> None:
+        pass
+
+    async def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, entry: dict) -> None:
+        self._cache.set(key, entry)
+
+    async def delete(self, key: str) -> None:
+        self._cache.pop(key)
+
+    async def purge_tag(self, tag: str) -> None:
+        pass
+
+    def discard_tag(self, tag: str) -> None:
+        self._cache.discard_where(lambda entry: tag in entry["tags"])
+
+
+class MongoResponseBackend:
+    """Response store shared by all workers, expired by a TTL index."""
+
+    def __init__(self, db, ttl: float, collection_name: str = "response_cache"):
+        self.collection = db[collection_name]
+        self.ttl = ttl
+
+    async def start(self) -> None:
+        await self.collection.create_indexes([
+            IndexModel([("expires_at", ASCENDING)], name="response_cache_ttl", expireAfterSeconds=0),
+            IndexModel([("tags", ASCENDING)], name="response_cache_tags"),
+        ])
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+
+    async def set(self, key: str, entry: dict) -> None:
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        await self.collection.replace_one({"_id": key}, {**entry, "expires_at": expires_at}, upsert=True)
+
+    async def delete(self, key: str) -> None:
+        await self.collection.delete_one({"_id": key})
+
+    async def purge_tag(self, tag: str) -> None:
+        await self.collection.delete_many({"tags": tag})
+
+    def discard_tag(self, tag: str) -> None:
+        pass
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or any(value.removeprefix("W/") == etag for value in candidates)
+
+
+class ResponseCache:
+    """Caches rendered GET responses by path and query string.
+
+    Entries are fresh for ``max_age`` seconds, then served stale for up to
+    ``stale_while_revalidate`` seconds while a single background refresh runs.
+    Responses carry an ETag and conditional requests get a 304.
+    """
+
+    def __init__(self, backend, bus: LocalInvalidationBus, render: Callable[[Any], bytes],
+                 max_age: int = 30, stale_while_revalidate: int = 300):
+        self.backend = backend
+        self.bus = bus
+        self.render = render
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self.hits = 0
+        self.misses = 0
+        self._generation = 0
+        self._refreshing: set = set()
+        self._tasks: set = set()
+        bus.subscribe("response_cache", self._on_invalidate)
+
+    @property
+    def cache_control(self) -> str:
+        return f"public, max-age={self.max_age}, stale-while-revalidate={self.stale_while_revalidate}"
+
+    @staticmethod
+    def key_for(request: Request) -> str:
+        return request.url.path + "?" + "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+
+    async def start(self) -> None:
+        await self.backend.start()
+
+    async def respond(self, request: Request, tags: List[str], producer: Callable[[], Awaitable[Any]],
+                      media_type: str = "application/json") -> Response:
+        key = self.key_for(request)
+        entry = await self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = await self._refresh(key, tags, producer, media_type)
+        else:
+            self.hits += 1
+            if time.time() - entry["stored_at"] > self.max_age:
+                self._refresh_in_background(key, tags, producer, media_type)
+
+        headers = {"ETag": entry["etag"], "Cache-Control": self.cache_control}
+        if etag_matches(request.headers.get("if-none-match"), entry["etag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry["body"], media_type=entry["media_type"], headers=headers)
+
+    async def invalidate(self, tag: str) -> None:
+        await self.backend.purge_tag(tag)
+        await self.bus.publish("response_cache", tag)
+
+    def _on_invalidate(self, tag: str) -> None:
+        self._generation += 1
+        self.backend.discard_tag(tag)
+
+    async def _refresh(self, key: str, tags: List[str], producer, media_type: str) -> dict:
+        generation = self._generation
+        body = self.render(await producer())
+        entry = {
+            "body": body,
+            "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+            "media_type": media_type,
+            "stored_at": time.time(),
+            "tags": tags,
+        }
+        # Don't store a response computed from data invalidated meanwhile
+        if generation == self._generation:
+            await self.backend.set(key, entry)
+        return entry
+
+    def _refresh_in_background(self, key: str, tags: List[str], producer, media_type: str) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def run():
+            try:
+                await self._refresh(key, tags, producer, media_type)
+            except Exception:
+                # e.g. the product is gone now; the next request recomputes
+                await self.backend.delete(key)
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def create_invalidation_bus(backend: str, db) -> LocalInvalidationBus:
+    if backend == "local":
+        return LocalInvalidationBus()
+    if backend == "mongo":
+        return MongoInvalidationBus(db)
+    raise ValueError(f"Unknown cache invalidation backend: {backend}")
+
+
+def create_response_backend(backend: str, db, maxsize: int, ttl: float):
+    if backend == "memory":
+        return MemoryResponseBackend(maxsize=maxsize, ttl=ttl)
+    if backend == "mongo":
+        return MongoResponseBackend(db, ttl=ttl)
+    raise ValueError(f"Unknown response cache backend: {backend}")
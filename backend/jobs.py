@@ -0,0 +1,211 @@
+"""Durable background job queue backed by a Mongo collection.
+
+Jobs survive restarts and are shared by every worker: a job is claimed with an
+atomic find-and-modify that takes a time-limited lease, so a crashed worker's
+job is picked up again once the lease runs out. A heartbeat keeps extending
+the lease while the handler runs, so long jobs are never claimed twice.
+Failures, including crashes that let the lease expire, are retried with
+exponential backoff until ``max_attempts``.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    def __init__(self, collection, handler: Callable[[dict], Awaitable[None]], name: str,
+                 concurrency: int = 2, max_attempts: int = 5, backoff_base: float = 2.0,
+                 backoff_max: float = 300.0, lease_seconds: float = 300.0, heartbeat_seconds: Optional[float] = None,
+                 poll_interval: float = 1.0, retention: timedelta = timedelta(days=7),
+                 dedupe_finished: bool = True):
+        self.collection = collection
+        self.handler = handler
+        self.name = name
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = timedelta(seconds=lease_seconds)
+        self.heartbeat_interval = heartbeat_seconds or lease_seconds / 3
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # False: a dedupe key only blocks while its job is queued or running
+        self.dedupe_finished = dedupe_finished
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._last_sweep = 0.0
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        await self.collection.create_indexes([
+            IndexModel([("dedupe_key", ASCENDING)], name=f"{self.name}_dedupe", unique=True, sparse=True),
+            IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name=f"{self.name}_ready"),
+            # Finished jobs are kept for a while for inspection and deduplication
+            IndexModel(
+                [("finished_at", ASCENDING)],
+                name=f"{self.name}_retention",
+                expireAfterSeconds=int(self.retention.total_seconds())
+            ),
+        ])
+        if not self.dedupe_finished:
+            # Jobs finished before dedupe_finished was turned off still hold their keys
+            await self.collection.update_many(
+                {"finished_at": {"$ne": None}, "dedupe_key": {"$exists": True}},
+                {"$unset": {"dedupe_key": ""}}
+            )
+        self._tasks =[asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, payload: dict, dedupe_key: Optional[str] = None) -> bool:
+        """Queue a job; returns False if a job with the same dedupe key exists."""
+        now = datetime.utcnow()
+        job = {
+            "id": str(uuid.uuid4()),
+            "payload": payload,
+            "status": "queued",  # queued, running, done, failed
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+            "locked_until": None,
+            "finished_at": None,
+            "last_error": None,
+        }
+        if dedupe_key:
+            job["dedupe_key"] = dedupe_key
+        try:
+            await self.collection.insert_one(job)
+        except DuplicateKeyError:
+            return False
+        self._wakeup.set()
+        return True
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                # Lease expired: the worker died mid-job, which counts as an attempt
+                {"status": "running", "locked_until": {"$lt": now}, "attempts": {"$lt": self.max_attempts}},
+            ]},
+            {
+                "$set": {"status": "running", "locked_until": now + self.lease, "lock_id": str(uuid.uuid4())},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def fail_abandoned(self) -> int:
+        """Fail jobs whose last attempt crashed its worker; returns how many."""
+        now = datetime.utcnow()
+        result = await self.collection.update_many(
+            {"status": "running", "locked_until": {"$lt": now}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": "failed", "finished_at": now, "locked_until": None,
+                      "last_error": "lease expired on the last attempt"}, **self._release_dedupe()}
+        )
+        if result.modified_count:
+            self.failed += result.modified_count
+            logger.error("%s: %d job(s) abandoned on their last attempt", self.name, result.modified_count)
+        return result.modified_count
+
+    def _release_dedupe(self) -> dict:
+        return {} if self.dedupe_finished else {"$unset": {"dedupe_key": ""}}
+
+    def backoff(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(self.backoff_base ** attempts, self.backoff_max))
+
+    async def _heartbeat(self, job: dict) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                result = await self.collection.update_one(
+                    {"_id": job["_id"], "lock_id": job["lock_id"]},
+                    {"$set": {"locked_until": datetime.utcnow() + self.lease}}
+                )
+            except PyMongoError as e:
+                logger.warning("%s job %s heartbeat failed: %s", self.name, job["id"], e)
+                continue
+            if not result.matched_count:
+                logger.warning("%s job %s lost its lease to another worker", self.name, job["id"])
+                return
+
+    async def run_job(self, job: dict) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        error: Optional[Exception] = None
+        try:
+            await self.handler(job)
+        except Exception as e:
+            error = e
+        finally:
+            heartbeat.cancel()
+        now = datetime.utcnow()
+        if error is None:
+            self.processed += 1
+            update = {"status": "done", "finished_at": now}
+        elif job["attempts"] >= self.max_attempts:
+            self.failed += 1
+            logger.error("%s job %s failed permanently", self.name, job["id"], exc_info=error)
+            update = {"status": "failed", "finished_at": now, "last_error": repr(error)}
+        else:
+            self.retried += 1
+            logger.warning("%s job %s failed (attempt %d), retrying: %r", self.name, job["id"], job["attempts"], error)
+            update = {"status": "queued", "run_at": now + self.backoff(job["attempts"]), "last_error": repr(error)}
+        # Fenced by lock_id: a worker that lost its lease can't overwrite the new owner's state
+        await self.collection.update_one(
+            {"_id": job["_id"], "lock_id": job["lock_id"]},
+            {"$set": {**update, "locked_until": None}, **(self._release_dedupe() if "finished_at" in update else {})}
+        )
+
+    async def _work(self) -> None:
+        while True:
+            try:
+                job = await self.claim()
+            except PyMongoError as e:
+                logger.warning("%s queue unavailable: %s", self.name, e)
+                job = None
+            if job is None:
+                # Idle: occasionally fail jobs that can't be claimed again
+                if time.monotonic() - self._last_sweep >= self.heartbeat_interval:
+                    self._last_sweep = time.monotonic()
+                    try:
+                        await self.fail_abandoned()
+                    except PyMongoError as e:
+                        logger.warning("%s queue unavailable: %s", self.name, e)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_job(job)
+
+    async def stats(self) -> dict:
+        now = datetime.utcnow()
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        async for row in self.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        oldest = await self.collection.find_one(
+            {"status": "queued", "run_at": {"$lte": now}}, {"run_at": 1}, sort=[("run_at", ASCENDING)]
+        )
+        return {
+            **counts,
+            "lag_seconds": (now - oldest["run_at"]).total_seconds() if oldest else 0.0,
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed_total": self.failed,
+        }
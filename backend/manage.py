@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Maintenance commands for the Olyst backend.
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from payments import SIGNATURE_HEADER, sign_payload
+
+# server reads its settings when imported; variables already set win over .env
+load_dotenv(Path(__file__).parent / '.env')
+
+import server  # noqa: E402
+from server import decode_base64_field, guess_image_type, invalidate_user, search_terms  # noqa: E402
+
+logger = logging.getLogger("manage")
+
+
+async def migrate_media(args):
+    # Move product payloads still stored inline as base64 into the blob store
+    query = {"$or": [{"image_base64": {"$nin": [None, ""]}}, {"file_base64": {"$nin": [None, ""]}}]}
+    migrated = 0
+    cursor = server.db.products.find(query, {"id": 1, "image_base64": 1, "file_base64": 1}, batch_size=1)
+    async for product in cursor:
+        if args.dry_run:
+            logger.info("Would migrate product %s", product["id"])
+            migrated += 1
+            continue
+        fields = {}
+        if product.get("image_base64"):
+            data = decode_base64_field(product["image_base64"], "image_base64")
+            blob = await server.blob_store.put_bytes(data)
+            fields.update(image_blob_id=blob.id, image_type=guess_image_type(data))
+        if product.get("file_base64"):
+            data = decode_base64_field(product["file_base64"], "file_base64")
+            blob = await server.blob_store.put_bytes(data)
+            fields.update(file_blob_id=blob.id, file_size=blob.size)
+        await server.db.products.update_one(
+            {"_id": product["_id"]},
+            {"$set": fields, "$unset": {"image_base64": "", "file_base64": ""}}
+        )
+        logger.info("Migrated product %s", product["id"])
+        migrated += 1
+    await server.response_cache.invalidate("catalog")
+    logger.info("%d product(s) migrated", migrated)
+
+
+async def reindex_search(args):
+    # Rebuild typeahead terms, e.g. for products created before they existed
+    updated = 0
+    async for product in server.db.products.find({}, {"_id": 1, "name": 1}):
+        await server.db.products.update_one(
+            {"_id": product["_id"]},
+            {"$set": {"search_terms": search_terms(product["name"])}}
+        )
+        updated += 1
+    await server.response_cache.invalidate("catalog")
+    logger.info("%d product(s) reindexed", updated)
+
+
+async def set_admin(args):
+    user = await server.db.users.find_one_and_update(
+        {"email": args.email},
+        {"$set": {"is_admin": not args.revoke}},
+        {"id": 1}
+    )
+    if not user:
+        logger.error("No user with email %s", args.email)
+        return
+    # Only reaches running workers when CACHE_INVALIDATION_BACKEND=mongo;
+    # otherwise their cached copy expires after SESSION_CACHE_TTL
+    await invalidate_user(user["id"])
+    logger.info("%s is %s an admin", args.email, "no longer" if args.revoke else "now")
+
+
+async def purge_uploads(args):
+    # Drop abandoned resumable uploads and their stored parts
+    purged = 0
+    query = {"status": {"$ne": "completed"}, "expires_at": {"$lt": datetime.utcnow()}}
+    async for upload in server.db.uploads.find(query, {"id": 1, "total_parts": 1}):
+        await server.blob_store.delete_parts(upload["id"], list(range(1, upload["total_parts"] + 1)))
+        await server.db.uploads.delete_one({"_id": upload["_id"]})
+        purged += 1
+    logger.info("%d expired upload(s) purged", purged)
+
+
+async def derive_media(args):
+    # Queue thumbnail/preview generation, e.g. after enabling ffmpeg
+    query = {"$or": [{"image_blob_id": {"$ne": None}}, {"file_blob_id": {"$ne": None}}]}
+    if args.missing:
+        query["media"] = {"$in": [None, {}]}
+    queued = 0
+    async for product in server.db.products.find(query, {"id": 1, "image_blob_id": 1, "file_blob_id": 1}):
+        # No dedupe key: re-deriving unchanged media is the point here
+        await server.media_jobs.enqueue({"product_id": product["id"]})
+        queued += 1
+    logger.info("%d product(s) queued; jobs run in the API workers", queued)
+
+
+async def backfill_entitlements(args):
+    # Grant library access for orders completed before entitlements existed
+    granted = 0
+    async for order in server.db.orders.find({"status": "completed"}, {"_id": 0}):
+        await server.grant_entitlements(order)
+        granted += 1
+    logger.info("Entitlements granted for %d completed order(s)", granted)
+
+
+async def hash_session_tokens(args):
+    # Convert sessions created before tokens were stored hashed; their owners stay signed in
+    converted = 0
+    async for session in server.db.auth_sessions.find({"token": {"$exists": True}}, {"token": 1, "created_at": 1}):
+        await server.db.auth_sessions.update_one(
+            {"_id": session["_id"]},
+            {
+                "$set": {
+                    "token_hash": server.hash_token(session["token"]),
+                    "last_used_at": session.get("created_at") or datetime.utcnow(),
+                },
+                "$unset": {"token": ""},
+            }
+        )
+        converted += 1
+    logger.info("%d session(s) converted", converted)
+    users = await server.db.auth_sessions.distinct("user_id")
+    for user_id in users:
+        await server.prune_sessions(user_id)
+    logger.info("Sessions capped at %d for %d user(s)", server.SESSION_MAX_PER_USER, len(users))
+
+
+async def backfill_sales(args):
+    # Roll up completed orders the order hook never saw; --rebuild recomputes from scratch
+    query = {"status": "completed", "rolled_up": {"$ne": True}}
+    if args.rebuild:
+        for name in ("sales_daily", "sales_products", "sales_categories"):
+            await server.db[name].delete_many({})
+        # Replay every completed order, flagged or not: orders completing
+        # meanwhile are counted once thanks to the per-order guards
+        query = {"status": "completed"}
+    rolled_up = 0
+    async for order in server.db.orders.find(query, {"_id": 0, "rolled_up": 0}):
+        await server.roll_up_sales(order)
+        rolled_up += 1
+    logger.info("%d completed order(s) rolled up", rolled_up)
+
+
+async def rollup_referrals(args):
+    # Same rollup the API workers run periodically; safe to run alongside them
+    updated = await server.referral_ledger.roll_up()
+    logger.info("%d referrer summary(ies) updated", updated)
+
+
+def post_webhook(url: str, payload: bytes, signature: str):
+    request = urllib.request.Request(
+        url, data=payload, method="POST",
+        headers={"Content-Type": "application/json", SIGNATURE_HEADER: signature}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+async def fake_webhook(args):
+    # Local stand-in for FedaPay: signs events like the provider and posts them
+    secret = args.secret or server.FEDAPAY_WEBHOOK_SECRET
+    if not secret:
+        logger.error("Set FEDAPAY_WEBHOOK_SECRET or pass --secret")
+        return
+    url = args.url.rstrip("/") + "/api/payments/fedapay/webhook"
+    event_id = args.event_id or str(uuid.uuid4())
+    # Pays the order's own total unless --amount or --currency says otherwise
+    order = await server.db.orders.find_one({"id": args.order_id}, {"total_amount": 1, "currency": 1}) or {}
+    event = {
+        "id": event_id,
+        "name": f"transaction.{args.status}",
+        "entity": {
+            "id": args.transaction_id,
+            "amount": args.amount if args.amount is not None else order.get("total_amount", 0),
+            "currency": {"iso": args.currency or order.get("currency") or server.PAYMENT_CURRENCY},
+            "custom_metadata": {"order_id": args.order_id},
+        },
+    }
+    payload = json.dumps(event).encode()
+    # Repeats reuse the event id, as provider redeliveries do
+    for _ in range(args.repeat):
+        status, body = await asyncio.to_thread(post_webhook, url, payload, sign_payload(payload, secret))
+        logger.info("Event %s -> %s %s", event_id, status, body)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("migrate-media", help="Move inline base64 product media into blob storage")
+    cmd.add_argument("--dry-run", action="store_true")
+    cmd.set_defaults(func=migrate_media)
+
+    cmd = commands.add_parser("reindex-search", help="Rebuild product typeahead terms")
+    cmd.set_defaults(func=reindex_search)
+
+    cmd = commands.add_parser("purge-uploads", help="Delete expired unfinished uploads")
+    cmd.set_defaults(func=purge_uploads)
+
+    cmd = commands.add_parser("derive-media", help="Queue thumbnail and preview generation")
+    cmd.add_argument("--missing", action="store_true", help="Only products without derived media")
+    cmd.set_defaults(func=derive_media)
+
+    cmd = commands.add_parser("backfill-entitlements", help="Grant library access for past completed orders")
+    cmd.set_defaults(func=backfill_entitlements)
+
+    cmd = commands.add_parser("backfill-sales", help="Build sales rollups from past completed orders")
+    cmd.add_argument("--rebuild", action="store_true", help="Clear the rollups and recount every order")
+    cmd.set_defaults(func=backfill_sales)
+
+    cmd = commands.add_parser("rollup-referrals", help="Fold new referral ledger entries into summaries")
+    cmd.set_defaults(func=rollup_referrals)
+
+    cmd = commands.add_parser("fake-webhook", help="Send a signed FedaPay event to a running server")
+    cmd.add_argument("order_id")
+    cmd.add_argument("--status", default="approved", choices=["approved", "declined", "canceled", "transferred"])
+    cmd.add_argument("--url", default="http://localhost:8001")
+    cmd.add_argument("--secret", help="Defaults to FEDAPAY_WEBHOOK_SECRET")
+    cmd.add_argument("--event-id", help="Reuse an event id to test deduplication")
+    cmd.add_argument("--transaction-id", type=int, default=0)
+    cmd.add_argument("--amount", type=float, help="Defaults to the order's total")
+    cmd.add_argument("--currency", help="Defaults to the order's currency")
+    cmd.add_argument("--repeat", type=int, default=1)
+    cmd.set_defaults(func=fake_webhook)
+
+    cmd = commands.add_parser("hash-session-tokens", help="Replace stored raw session tokens with their hashes")
+    cmd.set_defaults(func=hash_session_tokens)
+
+    cmd = commands.add_parser("set-admin", help="Grant or revoke admin rights")
+    cmd.add_argument("email")
+    cmd.add_argument("--revoke", action="store_true")
+    cmd.set_defaults(func=set_admin)
+
+    return parser
+
+
+async def run(args):
+    server.connect()
+    await server.invalidation_bus.start()
+    try:
+        await args.func(args)
+    finally:
+        await server.invalidation_bus.stop()
+        server.client.close()
+
+
+def main():
+    args = build_parser().parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Derived media for products: image thumbnails and audio/video previews.
+
+Image resizing is CPU-bound and runs in a process pool; previews are produced
+by ffmpeg in a subprocess when it is installed, and skipped otherwise.
+"""
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = (160, 480, 960)
+PREVIEW_SECONDS = 30
+
+MEDIA_TYPES = {
+    "webp": "image/webp",
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "mp3": "audio/mpeg",
+    "mp4": "video/mp4",
+}
+
+
+def make_thumbnails(data: bytes, sizes: Tuple[int, ...] = THUMBNAIL_SIZES, quality: int = 80) -> Dict[int, bytes]:
+    """Return WebP thumbnails keyed by their max width; never upscales."""
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    thumbnails = {}
+    for size in sizes:
+        thumb = image.copy()
+        thumb.thumbnail((size, size * 4), Image.LANCZOS)
+        out = io.BytesIO()
+        thumb.save(out, "WEBP", quality=quality, method=4)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+
+def ffmpeg_path() -> Optional[str]:
+    return os.environ.get("FFMPEG_PATH") or shutil.which("ffmpeg")
+
+
+async def run_ffmpeg(*args: str, timeout: float = 300) -> None:
+    process = await asyncio.create_subprocess_exec(
+        ffmpeg_path(), "-hide_banner", "-loglevel", "error", "-y", *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')[-500:]}")
+
+
+async def make_audio_previews(source: str, workdir: str) -> Dict[str, str]:
+    clip = os.path.join(workdir, "preview.mp3")
+    waveform = os.path.join(workdir, "waveform.png")
+    await run_ffmpeg("-i", source, "-t", str(PREVIEW_SECONDS), "-vn", "-c:a", "libmp3lame", "-b:a", "96k", clip)
+    await run_ffmpeg(
+        "-i", source, "-filter_complex", "aformat=channel_layouts=mono,showwavespic=s=960x120:colors=#3b82f6",
+        "-frames:v", "1", waveform
+    )
+    return {"preview": clip, "waveform": waveform}
+
+
+async def make_video_previews(source: str, workdir: str) -> Dict[str, str]:
+    clip = os.path.join(workdir, "preview.mp4")
+    poster = os.path.join(workdir, "poster.jpg")
+    await run_ffmpeg(
+        "-i", source, "-t", str(PREVIEW_SECONDS), "-vf", "scale=-2:480", "-c:v", "libx264",
+        "-preset", "veryfast", "-crf", "28", "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart", clip
+    )
+    await run_ffmpeg("-ss", "1", "-i", source, "-frames:v", "1", "-vf", "scale=-2:480", poster)
+    return {"preview": clip, "poster": poster}
+
+
+def preview_kind(file_type: Optional[str]) -> Optional[str]:
+    if not file_type:
+        return None
+    if file_type.startswith("audio/"):
+        return "audio"
+    if file_type.startswith("video/"):
+        return "video"
+    return None
+
+
+def new_workdir() -> str:
+    return tempfile.mkdtemp(prefix="olyst-media-")
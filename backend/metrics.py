@@ -0,0 +1,376 @@
+"""Request and MongoDB instrumentation exposed in the Prometheus text format.
+
+``MetricsMiddleware`` times every HTTP request per route template and status
+and measures response sizes. ``MongoCommandListener`` is registered on the
+Motor client and attributes each command to the request that issued it
+through a context variable (Motor copies the context into its executor
+threads), so per-request round-trips and DB time can be reported and
+slow requests logged with a breakdown. ``MongoPoolListener`` reports
+connection pool occupancy and checkout waits.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple, value: float) -> None:
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            else:
+                data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(data)) for labels, data in self._values.items()]
+        for labels, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), data):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(data[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class CallbackMetric:
+    """Read at scrape time from a callback returning a value or {labels: value}."""
+
+    def __init__(self, name: str, help: str, callback: Callable, labelnames: Sequence[str] = (), kind: str = "gauge"):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.callback()
+        values = value if isinstance(value, dict) else {(): value}
+        for labels, sample in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(sample)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable, labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, callback, labelnames))
+
+    def counter_callback(self, name: str, help: str, callback: Callable,
+                         labelnames: Sequence[str] = ()) -> CallbackMetric:
+        """For totals already counted elsewhere, e.g. cache hit counters."""
+        return self.register(CallbackMetric(name, help, callback, labelnames, kind="counter"))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception:
+                logger.exception("Collecting metric %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    __slots__ = ("commands", "db_seconds", "by_command")
+
+    def __init__(self):
+        self.commands = 0
+        self.db_seconds = 0.0
+        self.by_command: Dict[str, list] = defaultdict(lambda: [0, 0.0])
+
+    def add(self, command: str, seconds: float) -> None:
+        self.commands += 1
+        self.db_seconds += seconds
+        entry = self.by_command[command]
+        entry[0] += 1
+        entry[1] += seconds
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, registry: MetricsRegistry):
+        self.duration = registry.histogram(
+            "mongodb_command_duration_seconds", "MongoDB command round-trip time", ["command"]
+        )
+        self.failures = registry.counter("mongodb_command_failures_total", "Failed MongoDB commands", ["command"])
+
+    def started(self, event) -> None:
+        pass
+
+    def _record(self, event) -> float:
+        seconds = event.duration_micros / 1e6
+        self.duration.observe((event.command_name,), seconds)
+        stats = current_request.get()
+        if stats is not None:
+            stats.add(event.command_name, seconds)
+        return seconds
+
+    def succeeded(self, event) -> None:
+        self._record(event)
+
+    def failed(self, event) -> None:
+        self._record(event)
+        self.failures.inc((event.command_name,))
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Tracks connection pool occupancy per server to expose saturation.
+
+    A checkout runs synchronously on one Motor executor thread, so its wait
+    time is measured between the started and checked-out events of that thread.
+    """
+
+    def __init__(self, registry: MetricsRegistry, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._open: Dict[str, int] = defaultdict(int)
+        self._in_use: Dict[str, int] = defaultdict(int)
+        self._waiting: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.checkout_wait = registry.histogram(
+            "mongodb_pool_checkout_wait_seconds", "Time waiting for a pooled connection", ["address"]
+        )
+        self.checkout_failures = registry.counter(
+            "mongodb_pool_checkout_failures_total", "Failed connection checkouts", ["address", "reason"]
+        )
+        registry.gauge("mongodb_pool_connections", "Open pooled connections", lambda: self._snapshot(self._open), ["address"])
+        registry.gauge("mongodb_pool_in_use", "Connections checked out", lambda: self._snapshot(self._in_use), ["address"])
+        registry.gauge("mongodb_pool_waiting", "Checkouts waiting for a connection", lambda: self._snapshot(self._waiting), ["address"])
+        registry.gauge("mongodb_pool_max_size", "Configured maxPoolSize", lambda: self.max_pool_size)
+
+    @staticmethod
+    def _address(event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def _snapshot(self, values: Dict[str, int]) -> Dict[Tuple, int]:
+        with self._lock:
+            return {(address,): value for address, value in values.items()}
+
+    def _add(self, values: Dict[str, int], event, amount: int) -> None:
+        with self._lock:
+            values[self._address(event)] += amount
+
+    def saturated(self) -> bool:
+        """True while every connection to some server is busy and requests queue for one."""
+        with self._lock:
+            return any(
+                self._in_use[address] >= self.max_pool_size and self._waiting[address] > 0
+                for address in list(self._waiting)
+            )
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        with self._lock:
+            for values in (self._open, self._in_use, self._waiting):
+                values.pop(self._address(event), None)
+
+    def connection_created(self, event) -> None:
+        self._add(self._open, event, 1)
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        self._add(self._open, event, -1)
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.started = time.perf_counter()
+        self._add(self._waiting, event, 1)
+
+    def connection_check_out_failed(self, event) -> None:
+        self._local.started = None
+        self._add(self._waiting, event, -1)
+        self.checkout_failures.inc((self._address(event), str(event.reason)))
+
+    def connection_checked_out(self, event) -> None:
+        address = self._address(event)
+        with self._lock:
+            self._waiting[address] -= 1
+            self._in_use[address] += 1
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.checkout_wait.observe((address,), time.perf_counter() - started)
+            self._local.started = None
+
+    def connection_checked_in(self, event) -> None:
+        self._add(self._in_use, event, -1)
+
+
+class HttpMetrics:
+    def __init__(self, registry: MetricsRegistry):
+        self.requests = registry.counter(
+            "http_requests_total", "HTTP requests", ["method", "route", "status"]
+        )
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "HTTP request latency", ["method", "route"]
+        )
+        self.response_size = registry.histogram(
+            "http_response_size_bytes", "HTTP response body size", ["method", "route"], SIZE_BUCKETS
+        )
+        self.db_commands = registry.histogram(
+            "http_request_mongodb_commands", "MongoDB commands issued per request", ["method", "route"], COUNT_BUCKETS
+        )
+        self.db_time = registry.histogram(
+            "http_request_mongodb_seconds", "MongoDB time per request", ["method", "route"]
+        )
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streamed bodies are timed and sized to the last byte."""
+
+    def __init__(self, app, metrics: HttpMetrics, slow_request_ms: float = 0):
+        self.app = app
+        self.metrics = metrics
+        self.slow_request_ms = slow_request_ms
+        self._route_paths: Dict[Callable, str] = {}
+
+    def route_for(self, scope) -> str:
+        # Label by route template, never the raw path, to bound cardinality
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self._route_paths.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    path = self._route_paths[endpoint] = route.path
+                    break
+            else:
+                return "unmatched"
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            elapsed = time.perf_counter() - started
+            method = scope["method"]
+            route = self.route_for(scope)
+            self.metrics.requests.inc((method, route, str(status)))
+            self.metrics.latency.observe((method, route), elapsed)
+            self.metrics.response_size.observe((method, route), size)
+            self.metrics.db_commands.observe((method, route), stats.commands)
+            self.metrics.db_time.observe((method, route), stats.db_seconds)
+            if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+                self.log_slow(method, scope.get("path", ""), route, status, elapsed, size, stats)
+
+    def log_slow(self, method: str, path: str, route: str, status: int, elapsed: float, size: int,
+                 stats: RequestStats) -> None:
+        commands = ", ".join(
+            f"{name}×{count} {seconds * 1000:.1f}ms"
+            for name, (count, seconds) in sorted(stats.by_command.items(), key=lambda item: -item[1][1])
+        )
+        logger.warning(
+            "Slow request %s %s (%s) -> %d in %.1fms: mongodb %d command(s) %.1fms [%s], other %.1fms, %d bytes sent",
+            method, path, route, status, elapsed * 1000, stats.commands, stats.db_seconds * 1000,
+            commands or "none", max(elapsed - stats.db_seconds, 0) * 1000, size
+        )
@@ -0,0 +1,100 @@
+"""FedaPay webhook signatures and event interpretation.
+
+FedaPay signs each webhook with HMAC-SHA256 over ``"<timestamp>.<raw body>"``
+and sends ``X-FEDAPAY-SIGNATURE: t=<timestamp>,s=<hex digest>``. The same
+helpers sign events for the local fake provider (``manage.py fake-webhook``).
+
+A valid signature only proves the event came from FedaPay, not that it paid
+for the order it names: approvals are checked against the order's total and
+currency before the order is completed.
+"""
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+from pydantic import BaseModel
+
+SIGNATURE_HEADER = "x-fedapay-signature"
+
+# Event name -> order status it moves the order to
+EVENT_STATUSES = {
+    "transaction.approved": "completed",
+    "transaction.transferred": "completed",
+    "transaction.declined": "failed",
+    "transaction.canceled": "failed",
+}
+
+# Status -> statuses it may be reached from; "completed" is terminal
+ALLOWED_TRANSITIONS = {
+    "completed": ["pending", "failed"],
+    "failed": ["pending"],
+}
+
+
+class InvalidSignature(Exception):
+    pass
+
+
+class PaymentTransition(BaseModel):
+    order_id: str
+    status: str
+    transaction_id: str
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+
+    def pays_for(self, total: float, currency: str) -> bool:
+        if self.amount is None or self.currency is None:
+            return False
+        # Amounts arrive in major units; totals are rounded to cents
+        return abs(self.amount - total) < 0.005 and self.currency == currency.upper()
+
+
+def sign_payload(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},s={digest}"
+
+
+def verify_signature(payload: bytes, header: Optional[str], secret: str, tolerance: int = 300) -> None:
+    """Raise InvalidSignature unless ``header`` signs ``payload`` recently enough."""
+    parts = dict(item.split("=", 1) for item in (header or "").split(",") if "=" in item)
+    try:
+        timestamp = int(parts["t"])
+        signature = parts["s"]
+    except (KeyError, ValueError):
+        raise InvalidSignature("malformed signature header")
+    # Reject replays of old, validly signed events
+    if abs(time.time() - timestamp) > tolerance:
+        raise InvalidSignature("timestamp outside tolerance")
+    expected = sign_payload(payload, secret, timestamp).split(",s=", 1)[1]
+    if not hmac.compare_digest(expected, signature):
+        raise InvalidSignature("signature mismatch")
+
+
+def event_currency(entity: dict) -> Optional[str]:
+    # Sent either as an ISO code or as the expanded currency object
+    currency = entity.get("currency")
+    if isinstance(currency, dict):
+        currency = currency.get("iso")
+    return currency.upper() if isinstance(currency, str) and currency else None
+
+
+def event_transition(event: dict) -> Optional[PaymentTransition]:
+    """Return the transition an event asks for, or None for events we ignore."""
+    new_status = EVENT_STATUSES.get(event.get("name"))
+    entity = event.get("entity") or {}
+    order_id = (entity.get("custom_metadata") or {}).get("order_id") or entity.get("merchant_reference")
+    if not new_status or not order_id:
+        return None
+    try:
+        amount = float(entity["amount"])
+    except (KeyError, TypeError, ValueError):
+        amount = None
+    return PaymentTransition(
+        order_id=str(order_id),
+        status=new_status,
+        transaction_id=str(entity.get("id", "")),
+        amount=amount,
+        currency=event_currency(entity)
+    )
@@ -0,0 +1,153 @@
+"""Sliding-window rate limiting for expensive unauthenticated routes.
+
+Counts are kept per fixed window; a request is allowed while the previous
+window's count, weighted by how much of it still overlaps the sliding window,
+plus the current window's count stays within the limit. The memory backend is
+per worker; the Mongo backend shares counters between workers and hosts.
+"""
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """Parse ``"<requests>/<seconds>"``, e.g. ``"5/60"``."""
+    limit, window = rate.split("/", 1)
+    return int(limit), int(window)
+
+
+class MemoryRateLimitBackend:
+    def __init__(self, maxsize: int = 100_000):
+        self._counts = TTLCache(maxsize=maxsize, ttl=3600)
+
+    async def start(self) -> None:
+        pass
+
+    async def increment(self, key: str, window_index: int, window: int) -> Tuple[int, int]:
+        """Count a hit; return the current and previous window counts."""
+        current = self._counts.get((key, window_index), 0) + 1
+        self._counts.set((key, window_index), current, ttl=2 * window)
+        return current, self._counts.get((key, window_index - 1), 0)
+
+
+class MongoRateLimitBackend:
+    def __init__(self, db, collection_name: str = "rate_limits"):
+        self.collection = db[collection_name]
+
+    async def start(self) -> None:
+        await self.collection.create_indexes([
+            IndexModel([("expires_at", ASCENDING)], name="rate_limits_ttl", expireAfterSeconds=0),
+        ])
+
+    async def increment(self, key: str, window_index: int, window: int) -> Tuple[int, int]:
+        expires_at = datetime.utcnow() + timedelta(seconds=2 * window)
+        for attempt in range(2):
+            try:
+                doc = await self.collection.find_one_and_update(
+                    {"_id": f"{key}:{window_index}"},
+                    {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": expires_at}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                break
+            except DuplicateKeyError:
+                # Two workers upserted the same new window; the retry updates it
+                if attempt:
+                    raise
+        previous = await self.collection.find_one({"_id": f"{key}:{window_index - 1}"}, {"count": 1})
+        return doc["count"], previous["count"] if previous else 0
+
+
+class RateLimiter:
+    def __init__(self, backend, clock: Callable[[], float] = time.time):
+        self.backend = backend
+        self.clock = clock
+        self.rejected = 0
+
+    async def start(self) -> None:
+        await self.backend.start()
+
+    async def hit(self, key: str, limit: int, window: int) -> int:
+        """Record a request; return 0 if allowed, else seconds until it would be."""
+        now = self.clock()
+        window_index = int(now // window)
+        elapsed = now - window_index * window
+        current, previous = await self.backend.increment(key, window_index, window)
+        # Scaled by window so whole-second timestamps stay exact: allowed while
+        # previous * overlap + current <= limit, overlap being remaining / window
+        remaining = window - elapsed
+        if previous * remaining + current * window <= limit * window:
+            return 0
+        # The retry is itself counted, so solve for when one more hit fits
+        if current + 1 <= limit and previous:
+            # Within this window, once enough of the previous one has slid out
+            retry_after = (previous * remaining + (current + 1 - limit) * window) / previous
+        else:
+            # Not before the next window, where this window's count is the one weighted down
+            retry_after = remaining + window * (current + 1 - limit) / current
+        return max(1, math.ceil(retry_after))
+
+
+class RateLimit:
+    """Route dependency limiting requests per client IP or per submitted email.
+
+    Attach it with ``dependencies=[Depends(RateLimit(...))]``; it runs before
+    the endpoint body, so rejected requests never reach password hashing.
+    """
+
+    def __init__(self, limiter: RateLimiter, name: str, rate: str, key: str = "ip", trust_proxy: bool = False):
+        if key not in ("ip", "email"):
+            raise ValueError(f"Unknown rate limit key: {key}")
+        self.limiter = limiter
+        self.name = name
+        self.limit, self.window = parse_rate(rate)
+        self.key = key
+        self.trust_proxy = trust_proxy
+
+    def client_ip(self, request: Request) -> Optional[str]:
+        forwarded = request.headers.get("x-forwarded-for")
+        if self.trust_proxy and forwarded:
+            return forwarded.split(",", 1)[0].strip()
+        return request.client.host if request.client else None
+
+    async def __call__(self, request: Request) -> None:
+        if self.key == "ip":
+            value = self.client_ip(request)
+        else:
+            # FastAPI has already parsed the body; request.json() reuses it
+            try:
+                body = await request.json()
+            except ValueError:
+                return
+            value = body.get("email") if isinstance(body, dict) else None
+            value = value.strip().lower() if isinstance(value, str) else None
+        if not value:
+            return
+
+        retry_after = await self.limiter.hit(f"{self.name}:{self.key}:{value}", self.limit, self.window)
+        if retry_after:
+            self.limiter.rejected += 1
+            logger.warning("Rate limit %s exceeded for %s %s", self.name, self.key, value)
+            raise HTTPException(
+                status_code=429,
+                detail="Trop de tentatives, veuillez réessayer plus tard",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+
+def create_rate_limit_backend(backend: str, db):
+    if backend == "memory":
+        return MemoryRateLimitBackend()
+    if backend == "mongo":
+        return MongoRateLimitBackend(db)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
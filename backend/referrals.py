@@ -0,0 +1,160 @@
+"""Referral codes, the append-only reward ledger and its per-referrer rollup.
+
+Every attribution (a signup through a referral link) and every reward (a
+purchase by a referred user) is one immutable ledger entry, deduplicated by an
+event key so retried hooks never pay twice. A periodic rollup folds new entries
+into one summary document per referrer, so dashboards read a single document.
+
+The rollup advances a watermark over ledger ``_id`` values. It only takes
+entries whose ObjectId is older than ``lag``, so an entry whose id was
+generated just before a slow insert cannot land behind the watermark. The
+range being applied is persisted before any summary is touched, and each
+summary records how far it has been rolled up, so a run interrupted midway
+is resumed without counting anything twice.
+"""
+import asyncio
+import logging
+import secrets
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# No 0/O or 1/I, so codes survive being read aloud or retyped
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+MIN_OBJECT_ID = ObjectId("0" * 24)
+STATE_ID = "rollup"
+
+
+def generate_referral_code(length: int = 8) -> str:
+    return "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+def normalize_referral_code(code: str) -> str:
+    return code.strip().upper()
+
+
+class ReferralLedger:
+    def __init__(self, entries, summaries, state, interval: float = 60.0, lag: float = 30.0,
+                 lease_seconds: float = 300.0):
+        self.entries = entries
+        self.summaries = summaries
+        self.state = state
+        self.interval = interval
+        self.lag = timedelta(seconds=lag)
+        self.lease = timedelta(seconds=lease_seconds)
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self.entries.create_indexes([
+            IndexModel([("event_key", ASCENDING)], name="referral_ledger_event_key", unique=True),
+            IndexModel([("referrer_id", ASCENDING)], name="referral_ledger_referrer"),
+        ])
+        await self.summaries.create_indexes([
+            IndexModel([("referrer_id", ASCENDING)], name="referral_summaries_referrer", unique=True),
+        ])
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def record(self, referrer_id: str, referred_user_id: str, kind: str, amount: float,
+                     event_key: str, order_id: Optional[str] = None) -> bool:
+        """Append an entry; returns False if ``event_key`` was already recorded."""
+        try:
+            await self.entries.insert_one({
+                "id": str(uuid.uuid4()),
+                "event_key": event_key,
+                "referrer_id": referrer_id,
+                "referred_user_id": referred_user_id,
+                "kind": kind,  # signup, purchase
+                "order_id": order_id,
+                "amount": round(amount, 2),
+                "created_at": datetime.utcnow(),
+            })
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def summary(self, referrer_id: str) -> Optional[dict]:
+        return await self.summaries.find_one({"referrer_id": referrer_id}, {"_id": 0, "through": 0})
+
+    async def _acquire(self, now: datetime) -> Optional[dict]:
+        try:
+            return await self.state.find_one_and_update(
+                {"_id": STATE_ID, "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+                {"$set": {"locked_until": now + self.lease}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The state document exists and another worker holds the lease
+            return None
+
+    async def roll_up(self) -> int:
+        """Fold ledger entries past the watermark into summaries; returns referrers updated."""
+        now = datetime.utcnow()
+        state = await self._acquire(now)
+        if state is None:
+            return 0
+        try:
+            lower = state.get("watermark") or MIN_OBJECT_ID
+            upper = state.get("pending_upper")
+            if upper is None:
+                upper = ObjectId.from_datetime(now - self.lag)
+                if upper <= lower:
+                    return 0
+                await self.state.update_one({"_id": STATE_ID}, {"$set": {"pending_upper": upper}})
+
+            ops: List[UpdateOne] = []
+            pipeline = [
+                {"$match": {"_id": {"$gte": lower, "$lt": upper}}},
+                {"$group": {
+                    "_id": "$referrer_id",
+                    "signups": {"$sum": {"$cond": [{"$eq": ["$kind", "signup"]}, 1, 0]}},
+                    "purchases": {"$sum": {"$cond": [{"$eq": ["$kind", "purchase"]}, 1, 0]}},
+                    "rewards_total": {"$sum": "$amount"},
+                }},
+            ]
+            async for row in self.entries.aggregate(pipeline):
+                ops.append(UpdateOne(
+                    # Summaries already advanced to this range are skipped
+                    {"referrer_id": row["_id"], "through": {"$lt": upper}},
+                    {
+                        "$inc": {"signups": row["signups"], "purchases": row["purchases"],
+                                 "rewards_total": row["rewards_total"]},
+                        "$set": {"through": upper, "updated_at": now},
+                    },
+                    upsert=True
+                ))
+            if ops:
+                try:
+                    await self.summaries.bulk_write(ops, ordered=False)
+                except BulkWriteError as e:
+                    # A skipped summary makes its upsert collide on referrer_id; anything else is real
+                    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                        raise
+            await self.state.update_one(
+                {"_id": STATE_ID}, {"$set": {"watermark": upper}, "$unset": {"pending_upper": ""}}
+            )
+            return len(ops)
+        finally:
+            await self.state.update_one({"_id": STATE_ID}, {"$set": {"locked_until": None}})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                updated = await self.roll_up()
+                if updated:
+                    logger.info("Referral rollup updated %d referrer(s)", updated)
+            except Exception:
+                logger.exception("Referral rollup failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Run the API on several worker processes behind one port.
+
+gunicorn supervises N uvicorn workers. Run from backend/:
+
+    python run.py --workers 4 --bind 0.0.0.0:8001
+
+Workers are forked before they import ``server``, so each one builds its own
+thread pools and caches after the fork, and its Motor client when the app
+starts; nothing opened by the master process is shared. ``kill -HUP <master>`` reloads gracefully: new
+workers start, and old ones stop accepting connections and finish in-flight
+requests within --graceful-timeout. /readyz fails as soon as a worker starts
+draining. ``kill -TERM`` drains and exits.
+
+Per-worker state and what keeps it correct across workers:
+
+- Session cache, response cache: invalidated over CACHE_INVALIDATION_BACKEND.
+  With more than one worker this must be ``mongo``, or a logout, role change
+  or product edit only reaches the worker that handled it (the others serve
+  stale data until SESSION_CACHE_TTL / RESPONSE_CACHE_MAX_AGE expire).
+- Rate limit counters: RATE_LIMIT_BACKEND=mongo shares them; with ``memory``
+  each worker enforces the limit on its own, multiplying it by N.
+- Download URL signatures: DOWNLOAD_URL_SECRET must be identical in every
+  worker. The launcher generates one for its workers when it is unset; set
+  it explicitly so links also survive restarts and validate on other hosts.
+  Started another way, a worker refuses to start without it when
+  WEB_CONCURRENCY is above 1, and warns otherwise.
+- Media and payment job queues: leased in MongoDB, safe with any number of
+  workers. Each worker runs MEDIA_JOB_CONCURRENCY jobs on its own pool of
+  MEDIA_PROCESS_WORKERS processes.
+- Password hashing pool, MongoDB connection pool: sized per worker. The
+  launcher splits PASSWORD_HASH_WORKERS across workers; budget
+  MONGO_MAX_POOL_SIZE x workers against the server's connection limit.
+- Metrics: each worker has its own registry, so /metrics reports whichever
+  worker answered the scrape. Compare rates, not absolute counters.
+
+Unset settings above get multi-worker defaults; values from the environment or
+backend/.env always win.
+"""
+import argparse
+import logging
+import os
+import secrets
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+logger = logging.getLogger("run")
+
+
+def configure_environment(workers: int) -> None:
+    # Workers inherit the master's environment; load .env first so it takes precedence
+    load_dotenv(ROOT_DIR / '.env')
+    os.environ.setdefault("DOWNLOAD_URL_SECRET", secrets.token_hex(32))
+    if workers == 1:
+        return
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // workers)))
+    for name in ("CACHE_INVALIDATION_BACKEND", "RATE_LIMIT_BACKEND"):
+        os.environ.setdefault(name, "mongo")
+        if os.environ[name] != "mongo":
+            logger.warning("%s=%s is per worker; use mongo with %d workers", name, os.environ[name], workers)
+
+
+def build_application(options: dict):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Runs in each worker after the fork (preload_app stays off)
+            from server import app
+            return app
+
+    return Application()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--bind", default=os.environ.get("BIND", "0.0.0.0:8001"))
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="Seconds draining workers get to finish")
+    parser.add_argument("--timeout", type=int, default=60, help="Restart workers silent for this many seconds")
+    parser.add_argument("--max-requests", type=int, default=0, help="Recycle workers after this many requests")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    configure_environment(args.workers)
+    build_application({
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": False,
+        "graceful_timeout": args.graceful_timeout,
+        "timeout": args.timeout,
+        "keepalive": 5,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "loglevel": args.log_level,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,195 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, File, UploadFile, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, File, UploadFile, Form, Header, Query, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 import os
+import re
+import json
 import logging
+import orjson
+import unicodedata
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import uuid
+import math
+import time
+import asyncio
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import hashlib
+import hmac
 import secrets
+from urllib.parse import quote
 import base64
-from werkzeug.security import generate_password_hash, check_password_hash
+import binascii
+from bulk import RowError, csv_line, parse_records
+from storage import BlobStore, create_blob_store, is_blob_id
+from cache import (
+    LocalInvalidationBus, ResponseCache, TTLCache, create_invalidation_bus, create_response_backend, etag_matches
+)
+from jobs import JobQueue
+from media import MEDIA_TYPES, ffmpeg_path, make_audio_previews, make_thumbnails, make_video_previews, new_workdir, preview_kind
+from passwords import PasswordHasher, PasswordHasherBusy
+from metrics import HttpMetrics, MetricsMiddleware, MetricsRegistry, MongoCommandListener, MongoPoolListener
+from ratelimit import RateLimit, RateLimiter, create_rate_limit_backend
+from referrals import ReferralLedger, generate_referral_code, normalize_referral_code
+from payments import ALLOWED_TRANSITIONS, SIGNATURE_HEADER, InvalidSignature, event_transition, verify_signature
 
 ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Request and MongoDB metrics, served on /metrics; SLOW_REQUEST_MS > 0 logs slow requests
+metrics_registry = MetricsRegistry()
+http_metrics = HttpMetrics(metrics_registry)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Settings are read from the environment when this module is imported; run.py,
+# manage.py and the benchmarks load backend/.env first (with plain uvicorn,
+# pass --env-file .env)
+
+# MongoDB connection; pool limits apply per worker process. connect() builds
+# the client, and everything bound to the database, when startup() runs
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
+MONGO_WARMUP_CONNECTIONS = int(os.environ.get('MONGO_WARMUP_CONNECTIONS', MONGO_MIN_POOL_SIZE))
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', 2))
+mongo_pool_listener = MongoPoolListener(metrics_registry, MONGO_MAX_POOL_SIZE)
+client: Optional[AsyncIOMotorClient] = None
+db: Optional[AsyncIOMotorDatabase] = None
+
+# Blob storage for product files and images
+blob_store: Optional[BlobStore] = None
+
+# Resolved sessions are cached per worker; writes invalidate them over the bus
+session_cache = TTLCache(
+    maxsize=int(os.environ.get('SESSION_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('SESSION_CACHE_TTL', 60))
+)
+# Sessions slide: each use pushes expiry out again, but the write happens at
+# most once per refresh interval; beyond the per-user cap the least recently
+# used sessions are dropped
+SESSION_TTL = timedelta(days=int(os.environ.get('SESSION_TTL_DAYS', 7)))
+SESSION_REFRESH_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_REFRESH_INTERVAL', 3600)))
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', 10))
+invalidation_bus: Optional[LocalInvalidationBus] = None
+
+def serialize_model(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def render_json(content) -> bytes:
+    # pydantic-core and orjson, instead of jsonable_encoder's recursive walk
+    if isinstance(content, BaseModel):
+        return content.model_dump_json().encode("utf-8")
+    return orjson.dumps(content, default=serialize_model)
+
+# Public catalog responses, invalidated on every product write
+RESPONSE_CACHE_MAX_AGE = int(os.environ.get('RESPONSE_CACHE_MAX_AGE', 30))
+RESPONSE_CACHE_SWR = int(os.environ.get('RESPONSE_CACHE_SWR', 300))
+response_cache: Optional[ResponseCache] = None
+
+# Password hashing runs in a bounded pool, off the event loop
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2'),
+    max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)),
+    max_queue=int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 64))
+)
+
+# Auth rate limits ("<requests>/<seconds>"), checked before any hashing. The
+# routes hold on to the limiter; connect() gives it its backend
+rate_limiter = RateLimiter(backend=None)
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'
+LOGIN_RATE_LIMIT_IP = os.environ.get('LOGIN_RATE_LIMIT_IP', '20/60')
+LOGIN_RATE_LIMIT_EMAIL = os.environ.get('LOGIN_RATE_LIMIT_EMAIL', '10/300')
+REGISTER_RATE_LIMIT_IP = os.environ.get('REGISTER_RATE_LIMIT_IP', '5/600')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup() and shutdown() are defined at the end, after what they start
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# Resumable uploads
+UPLOAD_PART_SIZE = int(os.environ.get('UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+UPLOAD_EXPIRY = timedelta(hours=int(os.environ.get('UPLOAD_EXPIRY_HOURS', 24)))
+UPLOAD_ALLOWED_TYPES = os.environ.get(
+    'UPLOAD_ALLOWED_TYPES',
+    'application/pdf,application/epub+zip,application/zip,application/x-zip-compressed,audio/,video/,image/,text/'
+).split(',')
+
+# Derived media (thumbnails, previews)
+MEDIA_JOB_CONCURRENCY = int(os.environ.get('MEDIA_JOB_CONCURRENCY', 2))
+MEDIA_PROCESS_WORKERS = int(os.environ.get('MEDIA_PROCESS_WORKERS', 2))
+MEDIA_MAX_IMAGE_BYTES = int(os.environ.get('MEDIA_MAX_IMAGE_BYTES', 50 * 1024 * 1024))
+media_pool: Optional[ProcessPoolExecutor] = None
+
+# Pagination
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Orders
+MAX_ORDER_ITEMS = 50
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+# Sales rollup documents remember this many recent order ids, so a retried
+# rollup skips the documents it already counted
+SALES_ROLLUP_GUARD = 1000
+SALES_ROLLUP_PROJECTION = {"order_ids": 0}
+
+# Payments
+FEDAPAY_WEBHOOK_SECRET = os.environ.get('FEDAPAY_WEBHOOK_SECRET')
+FEDAPAY_WEBHOOK_TOLERANCE = int(os.environ.get('FEDAPAY_WEBHOOK_TOLERANCE', 300))
+PAYMENT_JOB_CONCURRENCY = int(os.environ.get('PAYMENT_JOB_CONCURRENCY', 4))
+PAYMENT_CURRENCY = os.environ.get('PAYMENT_CURRENCY', 'XOF').upper()
+
+# Downloads; set DOWNLOAD_URL_SECRET so links validate on every worker and
+# survive restarts (checked at startup, see check_download_url_secret)
+DOWNLOAD_URL_SECRET = os.environ.get('DOWNLOAD_URL_SECRET') or secrets.token_hex(32)
+DOWNLOAD_URL_TTL = int(os.environ.get('DOWNLOAD_URL_TTL', 900))
+
+# Bulk product import: rows are written in batches of this size
+BULK_IMPORT_BATCH_SIZE = int(os.environ.get('BULK_IMPORT_BATCH_SIZE', 500))
+BULK_IMPORT_MAX_ROW_BYTES = int(os.environ.get('BULK_IMPORT_MAX_ROW_BYTES', 16 * 1024 * 1024))
+BULK_IMPORT_MAX_ERRORS = 1000
+
+# Referrals; dashboard totals lag the ledger by up to interval + lag seconds
+REFERRAL_SIGNUP_REWARD = float(os.environ.get('REFERRAL_SIGNUP_REWARD', 0))
+REFERRAL_PURCHASE_RATE = float(os.environ.get('REFERRAL_PURCHASE_RATE', 0.05))
+REFERRAL_ROLLUP_INTERVAL = float(os.environ.get('REFERRAL_ROLLUP_INTERVAL', 60))
+REFERRAL_ROLLUP_LAG = float(os.environ.get('REFERRAL_ROLLUP_LAG', 30))
+
+# Search
+SEARCH_LANGUAGE = os.environ.get('SEARCH_LANGUAGE', 'french')
+MAX_SUGGESTIONS = 10
 
 # --- MODELS ---
 class User(BaseModel):
@@ -39,12 +198,15 @@ class User(BaseModel):
     username: str
     password_hash: str
     is_admin: bool = False
+    referral_code: str = Field(default_factory=generate_referral_code)
+    referred_by: Optional[str] = None  # referrer's user id
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class UserCreate(BaseModel):
     email: str
     username: str
     password: str
+    referral_code: Optional[str] = None  # the referrer's code, from ?ref=
 
 class UserLogin(BaseModel):
     email: str
@@ -55,6 +217,14 @@ class UserResponse(BaseModel):
     email: str
     username: str
     is_admin: bool
+    referral_code: Optional[str] = None
+
+class AuthResponse(BaseModel):
+    token: str
+    user: UserResponse
+
+class Message(BaseModel):
+    message: str
 
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -62,10 +232,20 @@ class Product(BaseModel):
     description: str
     price: float
     category: str  # ebooks, templates, audio, videos, ai_packs
-    image_base64: Optional[str] = None
-    file_base64: Optional[str] = None
+    image_blob_id: Optional[str] = None
+    image_type: Optional[str] = None
+    file_blob_id: Optional[str] = None
     file_name: Optional[str] = None
     file_type: Optional[str] = None
+    file_size: Optional[int] = None
+    search_terms: List[str] = []  # accent-folded name tokens for typeahead
+    media: dict = {}  # derived assets: {thumbnails: {width: asset}, preview, waveform, poster}
+    media_blob_ids: List[str] = []
+    # Review aggregates, kept current with $inc on every review write
+    rating_sum: int = 0
+    rating_count: int = 0
+    # Bumped on every edit, for optimistic locking; products predating it count as 0
+    version: int = 1
     is_active: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
     created_by: str
@@ -77,162 +257,1350 @@ class ProductCreate(BaseModel):
     category: str
     image_base64: Optional[str] = None
     file_base64: Optional[str] = None
+    image_blob_id: Optional[str] = None  # from a completed image upload
+    file_blob_id: Optional[str] = None  # from a completed file upload
     file_name: Optional[str] = None
     file_type: Optional[str] = None
 
+class ProductPatch(BaseModel):
+    # Only the fields sent are changed; media is replaced only when sent
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = None
+    category: Optional[str] = None
+    image_base64: Optional[str] = None
+    file_base64: Optional[str] = None
+    image_blob_id: Optional[str] = None
+    file_blob_id: Optional[str] = None
+    file_name: Optional[str] = None
+    file_type: Optional[str] = None
+    version: Optional[int] = None  # the version being edited; or send it as If-Match
+
+PRODUCT_REQUIRED_FIELDS = {"name", "description", "price", "category"}
+
+# ProductCreate fields resolved by store_product_media rather than copied as-is
+PRODUCT_MEDIA_INPUTS = {"image_base64", "file_base64", "image_blob_id", "file_blob_id"}
+
+class ProductSummary(BaseModel):
+    id: str
+    name: str
+    description: str
+    price: float
+    category: str
+    image_url: Optional[str] = None
+    thumbnails: Dict[str, str] = {}
+    preview_url: Optional[str] = None
+    file_name: Optional[str] = None
+    file_type: Optional[str] = None
+    file_size: Optional[int] = None
+    rating_average: Optional[float] = None
+    rating_count: int = 0
+    version: int = 0
+    is_active: bool = True
+    created_at: datetime
+
+# Listing fields only: media payloads never leave Mongo on catalog pages
+PRODUCT_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "name": 1,
+    "description": 1,
+    "price": 1,
+    "category": 1,
+    "image_blob_id": 1,
+    "media": 1,
+    "file_name": 1,
+    "file_type": 1,
+    "file_size": 1,
+    "rating_sum": 1,
+    "rating_count": 1,
+    "version": 1,
+    "is_active": 1,
+    "created_at": 1,
+}
+
+class ProductDetail(ProductSummary):
+    waveform_url: Optional[str] = None
+    poster_url: Optional[str] = None
+
+class ProductPage(BaseModel):
+    items: List[ProductSummary]
+    next_cursor: Optional[str] = None
+
+class ReviewCreate(BaseModel):
+    rating: int = Field(ge=1, le=5)
+    comment: str = Field(default="", max_length=2000)
+
+class Review(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    product_id: str
+    user_id: str
+    username: str
+    rating: int
+    comment: str = ""
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+
+class ReviewPage(BaseModel):
+    items: List[Review]
+    next_cursor: Optional[str] = None
+
+class ProductExport(BaseModel):
+    # Round-trips through the bulk import; media is not exported
+    id: str
+    name: str
+    description: str
+    price: float
+    category: str
+    file_name: Optional[str] = None
+    file_type: Optional[str] = None
+    is_active: bool = True
+    created_at: datetime
+
+PRODUCT_EXPORT_FIELDS = list(ProductExport.model_fields)
+
+class ProductImport(ProductCreate):
+    # Left out, an imported row keeps the product's current state (new products are active)
+    is_active: Optional[bool] = None
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class ImportResult(BaseModel):
+    received: int = 0
+    inserted: int = 0
+    updated: int = 0
+    failed: int = 0
+    errors: List[ImportRowError] = []
+    errors_truncated: bool = False
+    aborted: Optional[str] = None  # set when the upload itself could not be read to the end
+
+class ProductSuggestion(BaseModel):
+    id: str
+    name: str
+    category: str
+    image_url: Optional[str] = None
+
+class UserAdminUpdate(BaseModel):
+    username: Optional[str] = None
+    is_admin: Optional[bool] = None
+
+class UploadCreate(BaseModel):
+    kind: str = "file"  # file, image
+    file_name: str
+    file_type: str
+    size: int
+    sha256: Optional[str] = None
+
+class Upload(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    kind: str
+    file_name: str
+    file_type: str
+    size: int
+    sha256: Optional[str] = None
+    part_size: int
+    total_parts: int
+    parts: dict = {}  # {"1": {size, sha256}}
+    status: str = "pending"  # pending, completing, completed
+    blob_id: Optional[str] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+
+class UploadStatus(BaseModel):
+    id: str
+    kind: str
+    status: str
+    size: int
+    part_size: int
+    total_parts: int
+    received_parts: List[int]
+    blob_id: Optional[str] = None
+    expires_at: datetime
+
 class AuthSession(BaseModel):
+    # Only the SHA-256 of the bearer token is stored
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
-    token: str
+    token_hash: str
     expires_at: datetime
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_used_at: datetime = Field(default_factory=datetime.utcnow)
+
+class OrderItemCreate(BaseModel):
+    product_id: str
+    quantity: int = Field(default=1, ge=1, le=100)
+
+class OrderCreate(BaseModel):
+    items: List[OrderItemCreate] = Field(min_length=1, max_length=MAX_ORDER_ITEMS)
+    user_email: Optional[str] = None
+    payment_method: str = "fedapay"
+
+class OrderItem(BaseModel):
+    product_id: str
+    name: str
+    price: float
+    quantity: int = 1
+    category: Optional[str] = None
 
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: Optional[str] = None
     user_email: Optional[str] = None
-    products: List[dict]  # [{product_id, name, price}]
+    products: List[OrderItem]
     total_amount: float
+    currency: str = PAYMENT_CURRENCY
     status: str = "pending"  # pending, completed, failed
     payment_method: str = "fedapay"
+    payment_reference: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+ORDER_PROJECTION = {"_id": 0, "idempotency_key": 0, "request_hash": 0, "rolled_up": 0, "payment_mismatch": 0}
+
+class Entitlement(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    product_id: str
+    order_id: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class LibraryItem(BaseModel):
+    product_id: str
+    name: Optional[str] = None
+    image_url: Optional[str] = None
+    file_name: Optional[str] = None
+    file_type: Optional[str] = None
+    file_size: Optional[int] = None
+    order_id: str
+    purchased_at: datetime
+    download_url: Optional[str] = None
+
+class LibraryPage(BaseModel):
+    items: List[LibraryItem]
+    next_cursor: Optional[str] = None
+
+class ReferralSummary(BaseModel):
+    referral_code: str
+    signups: int = 0
+    purchases: int = 0
+    rewards_total: float = 0.0
+    updated_at: Optional[datetime] = None
+
+class SalesDay(BaseModel):
+    day: str  # YYYY-MM-DD, UTC
+    revenue: float = 0.0
+    orders: int = 0
+    units: int = 0
+
+class SalesSummary(BaseModel):
+    start: str
+    end: str
+    revenue: float
+    orders: int
+    units: int
+    average_order_value: Optional[float] = None
+
+class ProductSales(BaseModel):
+    product_id: str
+    name: Optional[str] = None
+    category: Optional[str] = None
+    revenue: float = 0.0
+    units: int = 0
+    orders: int = 0
+    last_sold_at: Optional[datetime] = None
+
+class CategorySales(BaseModel):
+    category: str
+    revenue: float = 0.0
+    units: int = 0
+
+class DownloadLink(BaseModel):
+    download_url: str
+    expires_in: int
+
 # --- HELPER FUNCTIONS ---
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+async def create_session(user_id: str) -> str:
+    token = secrets.token_urlsafe(32)
+    session = AuthSession(
+        user_id=user_id,
+        token_hash=hash_token(token),
+        expires_at=datetime.utcnow() + SESSION_TTL
+    )
+    await db.auth_sessions.insert_one(session.dict())
+    await prune_sessions(user_id)
+    return token
+
+async def prune_sessions(user_id: str):
+    # Keep the newest SESSION_MAX_PER_USER sessions, evicting the least recently used
+    stale = await db.auth_sessions.find(
+        {"user_id": user_id}, {"_id": 1, "token_hash": 1}
+    ).sort("last_used_at", DESCENDING).skip(SESSION_MAX_PER_USER).to_list(None)
+    if not stale:
+        return
+    await db.auth_sessions.delete_many({"_id": {"$in": [session["_id"] for session in stale]}})
+    for session in stale:
+        await invalidation_bus.publish("sessions", session["token_hash"])
+
+async def touch_session(session: dict, now: datetime) -> datetime:
+    # Sliding expiry, written at most once per SESSION_REFRESH_INTERVAL;
+    # matching on last_used_at lets only one concurrent request do the write
+    last_used_at = session.get("last_used_at", session["created_at"])
+    if now - last_used_at < SESSION_REFRESH_INTERVAL:
+        return session["expires_at"]
+    expires_at = now + SESSION_TTL
+    await db.auth_sessions.update_one(
+        {"_id": session["_id"], "last_used_at": session.get("last_used_at")},
+        {"$set": {"last_used_at": now, "expires_at": expires_at}}
+    )
+    return expires_at
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    token = credentials.credentials
-    session = await db.auth_sessions.find_one({"token": token})
+    token_hash = hash_token(credentials.credentials)
+    cached = session_cache.get(token_hash)
+    if cached and cached["expires_at"] >= datetime.utcnow():
+        return cached["user"]
+    
+    now = datetime.utcnow()
+    session = await db.auth_sessions.find_one({"token_hash": token_hash})
     
-    if not session or session["expires_at"] < datetime.utcnow():
+    if not session or session["expires_at"] < now:
         raise HTTPException(status_code=401, detail="Token invalide ou expiré")
     
-    user = await db.users.find_one({"id": session["user_id"]})
+    user = await db.users.find_one({"id": session["user_id"]}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="Utilisateur non trouvé")
     
+    expires_at = await touch_session(session, now)
+    session_cache.set(token_hash, {"user": user, "expires_at": expires_at})
     return user
 
+async def get_optional_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> Optional[dict]:
+    # Guest checkout: a missing token is fine, an invalid one is still rejected
+    if credentials is None:
+        return None
+    return await get_current_user(credentials)
+
+def drop_cached_user(user_id: str):
+    session_cache.discard_where(lambda entry: entry["user"]["id"] == user_id)
+
+async def invalidate_user(user_id: str):
+    # Call after any change to a user or their sessions
+    await invalidation_bus.publish("users", user_id)
+
 async def get_admin_user(user: dict = Depends(get_current_user)) -> dict:
     if not user.get("is_admin"):
         raise HTTPException(status_code=403, detail="Accès administrateur requis")
     return user
 
+DATA_URL_PREFIX = re.compile(r"^data:[^,]*;base64,", re.IGNORECASE)
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    return None
+
+def guess_image_type(data: bytes) -> str:
+    return sniff_image_type(data) or "image/jpeg"
+
+def decode_base64_field(value: str, field_name: str) -> bytes:
+    # Accepts bare base64 or a data URL (data:image/png;base64,...)
+    payload = re.sub(r"\s+", "", DATA_URL_PREFIX.sub("", value.strip(), count=1))
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail=f"Contenu base64 invalide: {field_name}")
+
+def media_url(asset: Optional[str]) -> Optional[str]:
+    return f"/api/media/{asset}" if asset else None
+
+def product_image_url(product: dict, width: int = 480) -> Optional[str]:
+    # Prefer a derived thumbnail; fall back to the original upload
+    thumbnails = (product.get("media") or {}).get("thumbnails") or {}
+    if str(width) in thumbnails:
+        return media_url(thumbnails[str(width)])
+    if not product.get("image_blob_id"):
+        return None
+    return f"/api/products/{product['id']}/image"
+
+def product_media_urls(product: dict) -> dict:
+    media = product.get("media") or {}
+    return {
+        "image_url": product_image_url(product),
+        "thumbnails": {width: media_url(asset) for width, asset in (media.get("thumbnails") or {}).items()},
+        "preview_url": media_url(media.get("preview")),
+        "waveform_url": media_url(media.get("waveform")),
+        "poster_url": media_url(media.get("poster")),
+    }
+
+def rating_average(product: dict) -> Optional[float]:
+    count = product.get("rating_count") or 0
+    return round(product.get("rating_sum", 0) / count, 2) if count else None
+
+def product_summary(product: dict) -> ProductSummary:
+    urls = product_media_urls(product)
+    return ProductSummary(
+        **{k: v for k, v in product.items() if k not in ("image_blob_id", "media")},
+        image_url=urls["image_url"],
+        thumbnails=urls["thumbnails"],
+        preview_url=urls["preview_url"],
+        rating_average=rating_average(product)
+    )
+
+def product_detail(product: dict) -> ProductDetail:
+    return ProductDetail(
+        **{k: v for k, v in product.items() if k not in ("image_blob_id", "media")},
+        **product_media_urls(product),
+        rating_average=rating_average(product)
+    )
+
+def encode_cursor(doc: dict, sort_key: str = "created_at") -> str:
+    raw = json.dumps([doc[sort_key].isoformat(), doc["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, last_id = json.loads(raw)
+        return datetime.fromisoformat(sort_value), str(last_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+
+def keyset_query(query: dict, after: Optional[str], sort_key: str = "created_at") -> dict:
+    # Newest first, ties broken on id so pages never overlap or skip
+    if not after:
+        return query
+    sort_value, last_id = decode_cursor(after)
+    return {"$and": [query, {"$or": [
+        {sort_key: {"$lt": sort_value}},
+        {sort_key: sort_value, "id": {"$lt": last_id}}
+    ]}]}
+
+def encode_offset_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([offset]).encode()).decode().rstrip("=")
+
+def decode_offset_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        (offset,) = json.loads(raw)
+        return max(int(offset), 0)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+
+async def paginate(collection, query: dict, projection: dict, limit: int, after: Optional[str] = None,
+                   sort_key: str = "created_at") -> Tuple[List[dict], Optional[str]]:
+    cursor = collection.find(keyset_query(query, after, sort_key), projection)
+    docs = await cursor.sort([(sort_key, -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(docs[limit - 1], sort_key) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+def ndjson_response(collection, query: dict, projection: dict, transform, limit: Optional[int] = None,
+                    after: Optional[str] = None, sort_key: str = "created_at") -> StreamingResponse:
+    cursor = collection.find(keyset_query(query, after, sort_key), projection)
+    cursor = cursor.sort([(sort_key, -1), ("id", -1)]).batch_size(100)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    async def body():
+        async for doc in cursor:
+            yield transform(doc).model_dump_json() + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def normalize_search_text(text: str) -> str:
+    # Lowercase and strip accents so "Étude" and "etude" match
+    folded = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in folded if not unicodedata.combining(c)).lower()
+
+def search_terms(text: str) -> List[str]:
+    return sorted(set(re.findall(r"\w+", normalize_search_text(text))))
+
+async def search_products(query: dict, search: str, limit: int, after: Optional[str] = None
+                          ) -> Tuple[List[dict], Optional[str]]:
+    # Relevance-ordered full-text search through the products_text index
+    offset = decode_offset_cursor(after) if after else 0
+    projection = {**PRODUCT_SUMMARY_PROJECTION, "score": {"$meta": "textScore"}}
+    cursor = db.products.find({**query, "$text": {"$search": search}}, projection)
+    cursor = cursor.sort([("score", {"$meta": "textScore"}), ("id", 1)]).skip(offset).limit(limit + 1)
+    docs = await cursor.to_list(limit + 1)
+    next_cursor = encode_offset_cursor(offset + limit) if len(docs) > limit else None
+    for doc in docs:
+        doc.pop("score", None)
+    return docs[:limit], next_cursor
+
+async def store_product_media(product_data: ProductCreate) -> dict:
+    # Inline base64 payloads are moved to the blob store; only ids stay on the product
+    media = {}
+    if product_data.image_base64:
+        data = decode_base64_field(product_data.image_base64, "image_base64")
+        blob = await blob_store.put_bytes(data)
+        media.update(image_blob_id=blob.id, image_type=guess_image_type(data))
+    if product_data.file_base64:
+        data = decode_base64_field(product_data.file_base64, "file_base64")
+        blob = await blob_store.put_bytes(data)
+        media.update(file_blob_id=blob.id, file_size=blob.size)
+    if product_data.image_blob_id:
+        upload = await get_completed_upload(product_data.image_blob_id, "image")
+        media.update(image_blob_id=upload["blob_id"], image_type=upload["file_type"])
+    if product_data.file_blob_id:
+        upload = await get_completed_upload(product_data.file_blob_id, "file")
+        media.update(
+            file_blob_id=upload["blob_id"],
+            file_size=upload["size"],
+            file_name=product_data.file_name or upload["file_name"],
+            file_type=product_data.file_type or upload["file_type"]
+        )
+    return media
+
+async def get_completed_upload(blob_id: str, kind: str) -> dict:
+    upload = await db.uploads.find_one({"blob_id": blob_id, "kind": kind, "status": "completed"})
+    if not upload:
+        raise HTTPException(status_code=400, detail="Fichier téléversé introuvable")
+    return upload
+
+def is_allowed_upload_type(kind: str, file_type: str) -> bool:
+    if kind == "image":
+        return file_type.startswith("image/")
+    return any(file_type.startswith(allowed) for allowed in UPLOAD_ALLOWED_TYPES if allowed)
+
+def expected_part_size(upload: dict, part_number: int) -> int:
+    if part_number < upload["total_parts"]:
+        return upload["part_size"]
+    return upload["size"] - upload["part_size"] * (upload["total_parts"] - 1)
+
+def upload_status(upload: dict) -> UploadStatus:
+    return UploadStatus(
+        id=upload["id"],
+        kind=upload["kind"],
+        status=upload["status"],
+        size=upload["size"],
+        part_size=upload["part_size"],
+        total_parts=upload["total_parts"],
+        received_parts=sorted(int(n) for n in upload.get("parts", {})),
+        blob_id=upload.get("blob_id"),
+        expires_at=upload["expires_at"]
+    )
+
+async def get_user_upload(upload_id: str, user: dict) -> dict:
+    upload = await db.uploads.find_one({"id": upload_id, "created_by": user["id"]}, {"_id": 0})
+    if not upload or (upload["status"] != "completed" and upload["expires_at"] < datetime.utcnow()):
+        raise HTTPException(status_code=404, detail="Téléversement non trouvé")
+    return upload
+
+def download_signature(product_id: str, user_id: str, expires: int) -> str:
+    message = f"{product_id}:{user_id}:{expires}".encode()
+    return hmac.new(DOWNLOAD_URL_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def signed_download_url(product_id: str, user_id: str) -> str:
+    # Short-lived link; checked by signature alone, without touching the database
+    expires = int(time.time()) + DOWNLOAD_URL_TTL
+    signature = download_signature(product_id, user_id, expires)
+    return f"/api/products/{product_id}/file?uid={quote(user_id)}&expires={expires}&sig={signature}"
+
+def verify_download_signature(product_id: str, user_id: Optional[str], expires: Optional[int], sig: Optional[str]):
+    if not (user_id and expires and sig):
+        raise HTTPException(status_code=403, detail="Lien de téléchargement requis")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="Lien de téléchargement expiré")
+    if not hmac.compare_digest(download_signature(product_id, user_id, expires), sig):
+        raise HTTPException(status_code=403, detail="Lien de téléchargement invalide")
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    # Single byte ranges only; anything else falls back to the full body
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    match = re.fullmatch(r"(\d*)-(\d*)", spec.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start_str, end_str = match.groups()
+    if start_str == "":
+        # Suffix range: the last N bytes
+        start = max(size - int(end_str), 0)
+        end = size - 1
+    else:
+        start = int(start_str)
+        if end_str and int(end_str) < start:
+            # Syntactically invalid, so ignored rather than unsatisfiable
+            return None
+        end = min(int(end_str), size - 1) if end_str else size - 1
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Plage demandée invalide",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+async def stream_blob(blob_id: str, media_type: str, range_header: Optional[str] = None,
+                      filename: Optional[str] = None) -> StreamingResponse:
+    size = await blob_store.size(blob_id)
+    if size is None:
+        raise HTTPException(status_code=404, detail="Fichier non trouvé")
+
+    byte_range = parse_range_header(range_header, size)
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1 if size else 0),
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if filename:
+        headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+
+    async def body():
+        if size:
+            async for chunk in blob_store.iter_range(blob_id, start, end):
+                yield chunk
+
+    return StreamingResponse(
+        body(),
+        status_code=206 if byte_range else 200,
+        media_type=media_type,
+        headers=headers
+    )
+
+# --- MEDIA PIPELINE ---
+async def store_thumbnails(blob_id: str) -> Dict[str, str]:
+    data = await blob_store.read(blob_id)
+    # Resizing is CPU-bound; keep it off the event loop
+    thumbnails = await asyncio.get_running_loop().run_in_executor(media_pool, make_thumbnails, data)
+    assets = {}
+    for width, thumbnail in thumbnails.items():
+        blob = await blob_store.put_bytes(thumbnail)
+        assets[str(width)] = f"{blob.id}.webp"
+    return assets
+
+async def derive_product_media(job: dict):
+    product_id = job["payload"]["product_id"]
+    product = await db.products.find_one(
+        {"id": product_id},
+        {"_id": 0, "image_blob_id": 1, "file_blob_id": 1, "file_type": 1}
+    )
+    if not product:
+        return
+    
+    media = {}
+    image_size = await blob_store.size(product["image_blob_id"]) if product.get("image_blob_id") else None
+    if image_size and image_size <= MEDIA_MAX_IMAGE_BYTES:
+        media["thumbnails"] = await store_thumbnails(product["image_blob_id"])
+    
+    kind = preview_kind(product.get("file_type"))
+    if kind and product.get("file_blob_id") and ffmpeg_path():
+        workdir = new_workdir()
+        try:
+            source = os.path.join(workdir, "source")
+            await blob_store.download_to(product["file_blob_id"], source)
+            make_previews = make_audio_previews if kind == "audio" else make_video_previews
+            for name, path in (await make_previews(source, workdir)).items():
+                blob = await blob_store.put_file(path)
+                media[name] = f"{blob.id}.{path.rsplit('.', 1)[1]}"
+                # Videos without a cover image get thumbnails from their poster frame
+                if name == "poster" and "thumbnails" not in media:
+                    media["thumbnails"] = await store_thumbnails(blob.id)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    assets = list(media.get("thumbnails", {}).values()) + [v for k, v in media.items() if k != "thumbnails"]
+    # Skip the write if the source media was replaced while we worked
+    await db.products.update_one(
+        {"id": product_id, "image_blob_id": product.get("image_blob_id"), "file_blob_id": product.get("file_blob_id")},
+        {"$set": {"media": media, "media_blob_ids": [asset.split(".", 1)[0] for asset in assets]}}
+    )
+    await response_cache.invalidate("catalog")
+
+media_jobs: Optional[JobQueue] = None
+
+async def schedule_media_derivation(product: dict):
+    if not product.get("image_blob_id") and not product.get("file_blob_id"):
+        return
+    await media_jobs.enqueue(
+        {"product_id": product["id"]},
+        dedupe_key=f"{product['id']}:{product.get('image_blob_id')}:{product.get('file_blob_id')}"
+    )
+
+# --- PAYMENTS ---
+# Called once an order is paid; hooks must be idempotent, they rerun if a
+# later hook fails and the event is retried
+order_completed_hooks: List[Callable[[dict], Awaitable[None]]] = []
+
+def on_order_completed(hook):
+    order_completed_hooks.append(hook)
+    return hook
+
+async def fulfil_order(order: dict):
+    for hook in order_completed_hooks:
+        await hook(order)
+    await db.orders.update_one({"id": order["id"]}, {"$set": {"fulfilled_at": datetime.utcnow()}})
+
+async def apply_payment_event(job: dict):
+    transition = event_transition(job["payload"])
+    if not transition:
+        return
+    order_id, new_status = transition.order_id, transition.status
+    if new_status == "completed":
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0, "total_amount": 1, "currency": 1})
+        if order and not transition.pays_for(order["total_amount"], order.get("currency") or PAYMENT_CURRENCY):
+            # Signed but not for this order's price: record it for review, never fulfil
+            logger.warning(
+                "Payment event %s for order %s paid %s %s, expected %s %s",
+                job["payload"].get("id"), order_id, transition.amount, transition.currency,
+                order["total_amount"], order.get("currency") or PAYMENT_CURRENCY
+            )
+            await db.orders.update_one(
+                {"id": order_id, "status": {"$in": ALLOWED_TRANSITIONS[new_status]}},
+                {"$set": {"payment_mismatch": {
+                    "transaction_id": transition.transaction_id,
+                    "amount": transition.amount,
+                    "currency": transition.currency,
+                    "at": datetime.utcnow(),
+                }}}
+            )
+            return
+    # Conditional update: duplicate or out-of-order events are no-ops
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "status": {"$in": ALLOWED_TRANSITIONS[new_status]}},
+        {"$set": {"status": new_status, "payment_reference": transition.transaction_id, "updated_at": datetime.utcnow()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if order is None:
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+        if order is None:
+            logger.warning("Payment event %s for unknown order %s", job["payload"].get("id"), order_id)
+            return
+    if order["status"] == "completed" and not order.get("fulfilled_at"):
+        await fulfil_order(order)
+
+@on_order_completed
+async def grant_entitlements(order: dict):
+    # Guest orders are never attached by email: registration doesn't prove
+    # ownership of the address, so anyone could claim someone else's purchases
+    user_id = order.get("user_id")
+    if not user_id:
+        return
+    # Upserts keep this idempotent when a payment event is retried
+    await db.entitlements.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "product_id": item["product_id"]},
+            {"$setOnInsert": Entitlement(user_id=user_id, product_id=item["product_id"], order_id=order["id"]).dict()},
+            upsert=True
+        )
+        for item in order["products"]
+    ], ordered=False)
+
+@on_order_completed
+async def reward_referrer(order: dict):
+    # Same rule as entitlements: a guest order's email proves nothing about the account
+    if not order.get("user_id"):
+        return
+    user = await db.users.find_one({"id": order["user_id"]}, {"id": 1, "referred_by": 1})
+    if not user or not user.get("referred_by"):
+        return
+    # Keyed on the order, so a retried payment event rewards once
+    await referral_ledger.record(
+        user["referred_by"], user["id"], "purchase", order["total_amount"] * REFERRAL_PURCHASE_RATE,
+        event_key=f"purchase:{order['id']}", order_id=order["id"]
+    )
+
+def sales_day(order: dict) -> str:
+    # Revenue counts on the day the order completed
+    return (order.get("updated_at") or order["created_at"]).strftime("%Y-%m-%d")
+
+@on_order_completed
+async def roll_up_sales(order: dict):
+    # Every increment is guarded by the order id, so a retry after a partial
+    # failure finishes the rollup without counting anything twice
+    if order.get("rolled_up"):
+        return
+    await apply_sales_rollup(order)
+    await db.orders.update_one({"id": order["id"]}, {"$set": {"rolled_up": True}})
+
+async def apply_once(collection, order_id: str, updates: List[Tuple[str, dict]]):
+    # Apply each (_id, update) unless that document has already counted order_id
+    def guarded(key: str, update: dict, upsert: bool) -> UpdateOne:
+        return UpdateOne(
+            {"_id": key, "order_ids": {"$ne": order_id}},
+            {**update, "$push": {"order_ids": {"$each": [order_id], "$slice": -SALES_ROLLUP_GUARD}}},
+            upsert=upsert
+        )
+    try:
+        await collection.bulk_write([guarded(key, update, True) for key, update in updates], ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        # The document exists: either it already counted this order or a
+        # concurrent upsert created it first. Without the upsert, the guard decides
+        await collection.bulk_write([guarded(*updates[error["index"]], False) for error in errors], ordered=False)
+
+async def apply_sales_rollup(order: dict):
+    day = sales_day(order)
+    items = order["products"]
+    # Orders placed before items carried their category
+    categories = {}
+    missing = [item["product_id"] for item in items if not item.get("category")]
+    if missing:
+        async for product in db.products.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "category": 1}):
+            categories[product["id"]] = product["category"]
+    
+    by_category: Dict[str, list] = {}
+    product_updates = []
+    for item in items:
+        quantity = item.get("quantity", 1)
+        revenue = item["price"] * quantity
+        category = item.get("category") or categories.get(item["product_id"]) or "unknown"
+        totals = by_category.setdefault(category, [0.0, 0])
+        totals[0] += revenue
+        totals[1] += quantity
+        product_updates.append((item["product_id"], {
+            "$inc": {"revenue": revenue, "units": quantity, "orders": 1},
+            "$set": {"name": item["name"], "category": category},
+            "$max": {"last_sold_at": order.get("updated_at") or order["created_at"]},
+        }))
+    
+    await apply_once(db.sales_daily, order["id"], [(day, {
+        "$inc": {"revenue": order["total_amount"], "orders": 1, "units": sum(i.get("quantity", 1) for i in items)}
+    })])
+    if product_updates:
+        await apply_once(db.sales_products, order["id"], product_updates)
+        await apply_once(db.sales_categories, order["id"], [
+            (f"{day}:{category}", {
+                "$inc": {"revenue": revenue, "units": units},
+                "$setOnInsert": {"day": day, "category": category},
+            })
+            for category, (revenue, units) in by_category.items()
+        ])
+
+referral_ledger: Optional[ReferralLedger] = None
+payment_jobs: Optional[JobQueue] = None
+
+# --- INDEXES ---
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="users_email", unique=True),
+        IndexModel([("id", ASCENDING)], name="users_id", unique=True),
+        IndexModel([("referral_code", ASCENDING)], name="users_referral_code", unique=True,
+                   partialFilterExpression={"referral_code": {"$type": "string"}}),
+    ],
+    "auth_sessions": [
+        # Partial until `manage.py hash-session-tokens` has converted legacy sessions
+        IndexModel([("token_hash", ASCENDING)], name="auth_sessions_token_hash", unique=True,
+                   partialFilterExpression={"token_hash": {"$type": "string"}}),
+        # Per-user pruning walks sessions by recency
+        IndexModel([("user_id", ASCENDING), ("last_used_at", DESCENDING)], name="auth_sessions_user_recent"),
+        # Mongo purges sessions as soon as they expire
+        IndexModel([("expires_at", ASCENDING)], name="auth_sessions_ttl", expireAfterSeconds=0),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="products_id", unique=True),
+        IndexModel(
+            [("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="products_active_recent"
+        ),
+        IndexModel(
+            [("is_active", ASCENDING), ("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="products_active_category_recent"
+        ),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="products_recent"),
+        IndexModel(
+            [("name", TEXT), ("description", TEXT)],
+            name="products_text",
+            weights={"name": 10, "description": 2},
+            default_language=SEARCH_LANGUAGE
+        ),
+        IndexModel([("search_terms", ASCENDING)], name="products_search_terms"),
+        IndexModel([("media_blob_ids", ASCENDING)], name="products_media_blob_ids"),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="orders_id", unique=True),
+        IndexModel(
+            [("idempotency_key", ASCENDING)],
+            name="orders_idempotency_key",
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$type": "string"}}
+        ),
+    ],
+    "entitlements": [
+        IndexModel([("user_id", ASCENDING), ("product_id", ASCENDING)], name="entitlements_user_product", unique=True),
+        IndexModel(
+            [("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="entitlements_user_recent"
+        ),
+    ],
+    # Sales rollups; sales_daily is keyed and range-scanned by its "YYYY-MM-DD" _id
+    "sales_products": [
+        IndexModel([("revenue", DESCENDING)], name="sales_products_revenue"),
+        IndexModel([("units", DESCENDING)], name="sales_products_units"),
+    ],
+    "sales_categories": [
+        IndexModel([("day", ASCENDING), ("category", ASCENDING)], name="sales_categories_day"),
+    ],
+    "reviews": [
+        IndexModel([("id", ASCENDING)], name="reviews_id", unique=True),
+        IndexModel([("product_id", ASCENDING), ("user_id", ASCENDING)], name="reviews_product_user", unique=True),
+        IndexModel(
+            [("product_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="reviews_product_recent"
+        ),
+    ],
+    "uploads": [
+        IndexModel([("id", ASCENDING)], name="uploads_id", unique=True),
+        IndexModel([("blob_id", ASCENDING), ("kind", ASCENDING)], name="uploads_blob"),
+        IndexModel([("status", ASCENDING), ("expires_at", ASCENDING)], name="uploads_expiry"),
+    ],
+}
+
+# Representative filters of the hot paths, checked with explain() at startup
+HOT_QUERIES = [
+    ("users", {"email": ""}),
+    ("users", {"id": ""}),
+    ("users", {"referral_code": ""}),
+    ("auth_sessions", {"token_hash": ""}),
+    ("auth_sessions", {"user_id": ""}),
+    ("products", {"id": "", "is_active": True}),
+    ("products", {"is_active": True, "category": ""}),
+    ("orders", {"id": ""}),
+    ("entitlements", {"user_id": "", "product_id": ""}),
+    ("reviews", {"product_id": ""}),
+]
+
+# Superseded indexes; the raw token index would reject every new session
+RETIRED_INDEXES = {
+    "auth_sessions": ["auth_sessions_token", "auth_sessions_user_id"],
+}
+
+async def ensure_indexes():
+    for collection_name, names in RETIRED_INDEXES.items():
+        try:
+            existing = await db[collection_name].index_information()
+            for name in set(names) & set(existing):
+                await db[collection_name].drop_index(name)
+                logger.info("Dropped retired index %s on %s", name, collection_name)
+        except OperationFailure as e:
+            logger.error("Dropping retired indexes on %s failed: %s", collection_name, e)
+    # create_indexes is a no-op for indexes that already exist with the same spec
+    for collection_name, indexes in INDEXES.items():
+        try:
+            names = await db[collection_name].create_indexes(indexes)
+            logger.info("Indexes ready on %s: %s", collection_name, ", ".join(names))
+        except OperationFailure as e:
+            logger.error("Index build failed on %s: %s", collection_name, e)
+
+def plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+async def report_collection_scans():
+    for collection_name, query in HOT_QUERIES:
+        try:
+            explain = await db[collection_name].find(query).explain()
+        except OperationFailure as e:
+            logger.warning("Could not explain query on %s: %s", collection_name, e)
+            continue
+        stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            logger.warning("Slow query: %s %s would scan the whole collection", collection_name, list(query))
+
 # --- AUTH ROUTES ---
-@api_router.post("/auth/register")
+@api_router.post("/auth/register", response_model=AuthResponse, dependencies=[
+    Depends(RateLimit(rate_limiter, "register", REGISTER_RATE_LIMIT_IP, "ip", RATE_LIMIT_TRUST_PROXY)),
+])
 async def register(user_data: UserCreate):
     # Check if user exists
     existing_user = await db.users.find_one({"email": user_data.email})
     if existing_user:
         raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
     
+    # An unknown referral code never blocks signing up
+    referrer = None
+    if user_data.referral_code:
+        referrer = await db.users.find_one(
+            {"referral_code": normalize_referral_code(user_data.referral_code)}, {"id": 1}
+        )
+    
     # Create user
-    password_hash = generate_password_hash(user_data.password)
+    password_hash = await password_hasher.hash(user_data.password)
     user = User(
         email=user_data.email,
         username=user_data.username,
         password_hash=password_hash,
-        is_admin=False  # First user can be made admin manually in DB
+        is_admin=False,  # First user can be made admin manually in DB
+        referred_by=referrer["id"] if referrer else None
     )
     
-    await db.users.insert_one(user.dict())
+    while True:
+        try:
+            await db.users.insert_one(user.dict())
+            break
+        except DuplicateKeyError as e:
+            if "referral_code" not in (e.details or {}).get("keyPattern", {}):
+                raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
+            user.referral_code = generate_referral_code()
     
-    # Create session
-    token = secrets.token_urlsafe(32)
-    session = AuthSession(
-        user_id=user.id,
-        token=token,
-        expires_at=datetime.utcnow() + timedelta(days=7)
-    )
-    await db.auth_sessions.insert_one(session.dict())
+    if referrer:
+        await referral_ledger.record(
+            referrer["id"], user.id, "signup", REFERRAL_SIGNUP_REWARD, event_key=f"signup:{user.id}"
+        )
     
-    return {
-        "token": token,
-        "user": UserResponse(
+    token = await create_session(user.id)
+    
+    return AuthResponse(
+        token=token,
+        user=UserResponse(
             id=user.id,
             email=user.email,
             username=user.username,
-            is_admin=user.is_admin
+            is_admin=user.is_admin,
+            referral_code=user.referral_code
         )
-    }
+    )
 
-@api_router.post("/auth/login")
+@api_router.post("/auth/login", response_model=AuthResponse, dependencies=[
+    Depends(RateLimit(rate_limiter, "login", LOGIN_RATE_LIMIT_IP, "ip", RATE_LIMIT_TRUST_PROXY)),
+    Depends(RateLimit(rate_limiter, "login", LOGIN_RATE_LIMIT_EMAIL, "email")),
+])
 async def login(login_data: UserLogin):
     user = await db.users.find_one({"email": login_data.email})
-    if not user or not check_password_hash(user["password_hash"], login_data.password):
+    if not user or not await password_hasher.verify(user["password_hash"], login_data.password):
         raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
     
-    # Create session
-    token = secrets.token_urlsafe(32)
-    session = AuthSession(
-        user_id=user["id"],
-        token=token,
-        expires_at=datetime.utcnow() + timedelta(days=7)
-    )
-    await db.auth_sessions.insert_one(session.dict())
+    # Upgrade the stored hash when the configured algorithm or cost changed
+    if await password_hasher.needs_rehash(user["password_hash"]):
+        await db.users.update_one(
+            {"id": user["id"]},
+            {"$set": {"password_hash": await password_hasher.hash(login_data.password)}}
+        )
     
-    return {
-        "token": token,
-        "user": UserResponse(
+    token = await create_session(user["id"])
+    
+    return AuthResponse(
+        token=token,
+        user=UserResponse(
             id=user["id"],
             email=user["email"],
             username=user["username"],
-            is_admin=user["is_admin"]
+            is_admin=user["is_admin"],
+            referral_code=user.get("referral_code")
         )
-    }
+    )
 
-@api_router.post("/auth/logout")
-async def logout(user: dict = Depends(get_current_user)):
-    # Delete all sessions for user
-    await db.auth_sessions.delete_many({"user_id": user["id"]})
+@api_router.post("/auth/logout", response_model=Message)
+async def logout(
+    user: dict = Depends(get_current_user),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    # Only the session presenting this token; other devices stay signed in
+    token_hash = hash_token(credentials.credentials)
+    await db.auth_sessions.delete_one({"token_hash": token_hash})
+    await invalidation_bus.publish("sessions", token_hash)
     return {"message": "Déconnexion réussie"}
 
-@api_router.get("/auth/me")
+@api_router.post("/auth/logout-all", response_model=Message)
+async def logout_all(user: dict = Depends(get_current_user)):
+    await db.auth_sessions.delete_many({"user_id": user["id"]})
+    await invalidate_user(user["id"])
+    return {"message": "Déconnexion de toutes les sessions réussie"}
+
+@api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(user: dict = Depends(get_current_user)):
     return UserResponse(
         id=user["id"],
         email=user["email"],
         username=user["username"],
-        is_admin=user["is_admin"]
+        is_admin=user["is_admin"],
+        referral_code=user.get("referral_code")
+    )
+
+@api_router.get("/me/referrals", response_model=ReferralSummary)
+async def get_referrals(user: dict = Depends(get_current_user)):
+    referral_code = user.get("referral_code")
+    if not referral_code:
+        # Accounts created before referral codes get one on first visit
+        referral_code = generate_referral_code()
+        updated = await db.users.find_one_and_update(
+            {"id": user["id"], "referral_code": None},
+            {"$set": {"referral_code": referral_code}},
+            {"referral_code": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated is None:
+            referral_code = (await db.users.find_one({"id": user["id"]}, {"referral_code": 1}))["referral_code"]
+        await invalidate_user(user["id"])
+    # One precomputed document; the ledger itself is never scanned here
+    summary = await referral_ledger.summary(user["id"]) or {}
+    return ReferralSummary(referral_code=referral_code, **{k: v for k, v in summary.items() if k != "referrer_id"})
+
+@api_router.get("/me/library", response_model=LibraryPage)
+async def get_library(
+    user: dict = Depends(get_current_user),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    entitlements, next_cursor = await paginate(
+        db.entitlements, {"user_id": user["id"]}, {"_id": 0}, limit, cursor
     )
+    products = {}
+    async for product in db.products.find(
+        {"id": {"$in": [e["product_id"] for e in entitlements]}},
+        {"_id": 0, "id": 1, "name": 1, "image_blob_id": 1, "media.thumbnails": 1,
+         "file_blob_id": 1, "file_name": 1, "file_type": 1, "file_size": 1}
+    ):
+        products[product["id"]] = product
+    
+    items = []
+    for entitlement in entitlements:
+        product = products.get(entitlement["product_id"], {"id": entitlement["product_id"]})
+        items.append(LibraryItem(
+            product_id=entitlement["product_id"],
+            name=product.get("name"),
+            image_url=product_image_url(product),
+            file_name=product.get("file_name"),
+            file_type=product.get("file_type"),
+            file_size=product.get("file_size"),
+            order_id=entitlement["order_id"],
+            purchased_at=entitlement["created_at"],
+            download_url=signed_download_url(product["id"], user["id"]) if product.get("file_blob_id") else None
+        ))
+    return LibraryPage(items=items, next_cursor=next_cursor)
+
+@api_router.get("/me/library/{product_id}/download", response_model=DownloadLink)
+async def get_download_link(product_id: str, user: dict = Depends(get_current_user)):
+    # Fresh link for an item whose library URL has expired
+    if not await db.entitlements.find_one({"user_id": user["id"], "product_id": product_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Achat non trouvé")
+    return DownloadLink(download_url=signed_download_url(product_id, user["id"]), expires_in=DOWNLOAD_URL_TTL)
 
 # --- PRODUCT ROUTES ---
-@api_router.get("/products")
-async def get_products(category: Optional[str] = None, search: Optional[str] = None):
+@api_router.get("/products", response_model=ProductPage)
+async def get_products(
+    request: Request,
+    category: Optional[str] = None,
+    search: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    output: str = Query("json", alias="format", pattern="^(json|ndjson)$")
+):
     query = {"is_active": True}
     
     if category:
         query["category"] = category
     
-    products = await db.products.find(query).to_list(1000)
+    if output == "ndjson":
+        # Search results are ranked pages, not a stream over the catalog
+        if search:
+            raise HTTPException(status_code=400, detail="Le format ndjson n'est pas disponible avec search")
+        return ndjson_response(db.products, query, PRODUCT_SUMMARY_PROJECTION, product_summary, limit, after)
     
-    if search:
-        products = [p for p in products if search.lower() in p["name"].lower() or search.lower() in p["description"].lower()]
+    async def produce():
+        if search:
+            products, next_cursor = await search_products(query, search, limit or DEFAULT_PAGE_SIZE, after)
+        else:
+            products, next_cursor = await paginate(
+                db.products, query, PRODUCT_SUMMARY_PROJECTION, limit or DEFAULT_PAGE_SIZE, after
+            )
+        return ProductPage(items=[product_summary(p) for p in products], next_cursor=next_cursor)
     
-    return products
+    return await response_cache.respond(request, ["catalog"], produce)
 
-@api_router.get("/products/{product_id}")
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id, "is_active": True})
-    if not product:
-        raise HTTPException(status_code=404, detail="Produit non trouvé")
-    return product
+@api_router.get("/products/suggest", response_model=List[ProductSuggestion])
+async def suggest_products(q: str = Query(..., min_length=1), limit: int = Query(8, ge=1, le=MAX_SUGGESTIONS)):
+    # Typeahead: complete words must match exactly, the last one as a prefix
+    terms = re.findall(r"\w+", normalize_search_text(q))
+    if not terms:
+        return []
+    *words, prefix = terms
+    conditions = [{"search_terms": word} for word in words]
+    conditions.append({"search_terms": {"$regex": f"^{re.escape(prefix)}"}})
+    products = await db.products.find(
+        {"is_active": True, "$and": conditions},
+        {"_id": 0, "id": 1, "name": 1, "category": 1, "image_blob_id": 1, "media.thumbnails": 1}
+    ).sort("name", 1).limit(limit).to_list(limit)
+    return [
+        ProductSuggestion(id=p["id"], name=p["name"], category=p["category"], image_url=product_image_url(p, 160))
+        for p in products
+    ]
+
+@api_router.get("/products/{product_id}", response_model=ProductDetail)
+async def get_product(request: Request, product_id: str):
+    async def produce():
+        # Same fields as listings: internal and legacy inline media fields stay in Mongo
+        product = await db.products.find_one({"id": product_id, "is_active": True}, PRODUCT_SUMMARY_PROJECTION)
+        if not product:
+            raise HTTPException(status_code=404, detail="Produit non trouvé")
+        return product_detail(product)
+    
+    return await response_cache.respond(request, ["catalog"], produce)
+
+@api_router.get("/products/{product_id}/file")
+async def get_product_file(
+    product_id: str,
+    uid: Optional[str] = None,
+    expires: Optional[int] = None,
+    sig: Optional[str] = None,
+    range_header: Optional[str] = Header(None, alias="Range")
+):
+    # Links come from /me/library or /me/library/{product_id}/download. The
+    # signature proves the purchase, so buyers keep access after a soft delete
+    verify_download_signature(product_id, uid, expires, sig)
+    product = await db.products.find_one(
+        {"id": product_id},
+        {"file_blob_id": 1, "file_name": 1, "file_type": 1}
+    )
+    if not product or not product.get("file_blob_id"):
+        raise HTTPException(status_code=404, detail="Fichier non trouvé")
+    return await stream_blob(
+        product["file_blob_id"],
+        product.get("file_type") or "application/octet-stream",
+        range_header,
+        filename=product.get("file_name")
+    )
+
+@api_router.get("/products/{product_id}/image")
+async def get_product_image(product_id: str):
+    product = await db.products.find_one(
+        {"id": product_id, "is_active": True},
+        {"image_blob_id": 1, "image_type": 1}
+    )
+    if not product or not product.get("image_blob_id"):
+        raise HTTPException(status_code=404, detail="Image non trouvée")
+    return await stream_blob(product["image_blob_id"], product.get("image_type") or "image/jpeg")
+
+@api_router.get("/media/{asset}")
+async def get_media_asset(asset: str, request: Request):
+    # Derived assets are content-addressed, so they can be cached forever
+    blob_id, _, extension = asset.partition(".")
+    if not is_blob_id(blob_id) or extension not in MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Média non trouvé")
+    etag = f'"{blob_id}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if not await db.products.find_one({"media_blob_ids": blob_id, "is_active": True}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Média non trouvé")
+    response = await stream_blob(blob_id, MEDIA_TYPES[extension], request.headers.get("range"))
+    response.headers.update(headers)
+    return response
 
-@api_router.post("/products")
+@api_router.post("/products", response_model=ProductDetail)
 async def create_product(product_data: ProductCreate, user: dict = Depends(get_admin_user)):
-    product = Product(**product_data.dict(), created_by=user["id"])
+    fields = product_data.dict(exclude=PRODUCT_MEDIA_INPUTS)
+    fields.update(await store_product_media(product_data))
+    product = Product(
+        **fields,
+        search_terms=search_terms(product_data.name),
+        created_by=user["id"]
+    )
     await db.products.insert_one(product.dict())
-    return product
+    await response_cache.invalidate("catalog")
+    await schedule_media_derivation(product.dict())
+    return product_detail(product.dict())
+
+def product_update(fields: dict, media: dict) -> dict:
+    update = {"$set": fields}
+    # Derived assets of replaced media are dropped until regenerated
+    stale = {}
+    if "image_blob_id" in media:
+        stale["media.thumbnails"] = ""
+    if "file_blob_id" in media:
+        stale.update({"media.preview": "", "media.waveform": "", "media.poster": ""})
+    if stale:
+        update["$unset"] = stale
+    return update
+
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    # Accepts "3", W/"3" or a bare 3
+    if not if_match:
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="En-tête If-Match invalide")
 
-@api_router.put("/products/{product_id}")
+@api_router.patch("/products/{product_id}", response_model=ProductDetail)
+async def patch_product(
+    product_id: str,
+    product_data: ProductPatch,
+    if_match: Optional[str] = Header(None),
+    user: dict = Depends(get_admin_user)
+):
+    expected = parse_if_match(if_match)
+    if expected is None:
+        expected = product_data.version
+    if expected is None:
+        raise HTTPException(status_code=428, detail="Version du produit requise (champ version ou en-tête If-Match)")
+    
+    fields = product_data.dict(exclude=PRODUCT_MEDIA_INPUTS | {"version"}, exclude_unset=True)
+    cleared = [name for name in PRODUCT_REQUIRED_FIELDS if name in fields and fields[name] is None]
+    if cleared:
+        raise HTTPException(status_code=422, detail=f"Champs obligatoires: {sorted(cleared)}")
+    media = await store_product_media(product_data)
+    fields.update(media)
+    if "name" in fields:
+        fields["search_terms"] = search_terms(fields["name"])
+    
+    update = product_update(fields, media)
+    update["$set"]["version"] = expected + 1
+    # The version match makes concurrent edits fail instead of overwriting each other
+    version_filter = {"version": expected} if expected else {"version": {"$in": [0, None]}}
+    product = await db.products.find_one_and_update(
+        {"id": product_id, **version_filter},
+        update,
+        projection={**PRODUCT_SUMMARY_PROJECTION, "file_blob_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not product:
+        if await db.products.find_one({"id": product_id}, {"_id": 1}):
+            raise HTTPException(status_code=412, detail="Le produit a été modifié entre-temps, rechargez-le")
+        raise HTTPException(status_code=404, detail="Produit non trouvé")
+    await response_cache.invalidate("catalog")
+    if media:
+        await schedule_media_derivation(product)
+    return product_detail(product)
+
+@api_router.put("/products/{product_id}", response_model=Message)
 async def update_product(product_id: str, product_data: ProductCreate, user: dict = Depends(get_admin_user)):
-    result = await db.products.update_one(
+    # Media is only replaced when a new payload is sent
+    fields = product_data.dict(exclude=PRODUCT_MEDIA_INPUTS, exclude_none=True)
+    media = await store_product_media(product_data)
+    fields.update(media)
+    fields["search_terms"] = search_terms(product_data.name)
+    update = product_update(fields, media)
+    update["$inc"] = {"version": 1}
+    product = await db.products.find_one_and_update(
         {"id": product_id},
-        {"$set": product_data.dict()}
+        update,
+        projection={"_id": 0, "id": 1, "image_blob_id": 1, "file_blob_id": 1},
+        return_document=ReturnDocument.AFTER
     )
-    if result.matched_count == 0:
+    if not product:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
+    await response_cache.invalidate("catalog")
+    if media:
+        await schedule_media_derivation(product)
     return {"message": "Produit mis à jour"}
 
-@api_router.delete("/products/{product_id}")
+@api_router.delete("/products/{product_id}", response_model=Message)
 async def delete_product(product_id: str, user: dict = Depends(get_admin_user)):
     result = await db.products.update_one(
         {"id": product_id},
@@ -240,38 +1608,572 @@ async def delete_product(product_id: str, user: dict = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
+    await response_cache.invalidate("catalog")
     return {"message": "Produit supprimé"}
 
-@api_router.get("/admin/products")
-async def get_admin_products(user: dict = Depends(get_admin_user)):
-    products = await db.products.find().to_list(1000)
-    return products
+# --- REVIEW ROUTES ---
+@api_router.get("/products/{product_id}/reviews", response_model=ReviewPage)
+async def get_product_reviews(
+    product_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    reviews, next_cursor = await paginate(db.reviews, {"product_id": product_id}, {"_id": 0}, limit, cursor)
+    return ReviewPage(items=reviews, next_cursor=next_cursor)
+
+@api_router.put("/products/{product_id}/reviews", response_model=Review)
+async def put_product_review(product_id: str, review_data: ReviewCreate, user: dict = Depends(get_current_user)):
+    # One review per user and product; posting again replaces it
+    if not await db.products.find_one({"id": product_id, "is_active": True}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Produit non trouvé")
+    review = Review(product_id=product_id, user_id=user["id"], username=user["username"], **review_data.dict())
+    for attempt in range(2):
+        try:
+            previous = await db.reviews.find_one_and_update(
+                {"product_id": product_id, "user_id": user["id"]},
+                {
+                    "$set": {"rating": review.rating, "comment": review.comment, "username": review.username,
+                             "updated_at": datetime.utcnow()},
+                    "$setOnInsert": {"id": review.id, "created_at": review.created_at},
+                },
+                {"_id": 0, "rating": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+            break
+        except DuplicateKeyError:
+            # A concurrent first review won the upsert; the retry updates it
+            if attempt:
+                raise
+    # The pre-image makes the delta exact even when the same user posts twice at once
+    if previous is None:
+        delta = {"rating_sum": review.rating, "rating_count": 1}
+    else:
+        delta = {"rating_sum": review.rating - previous["rating"]}
+    await db.products.update_one({"id": product_id}, {"$inc": delta})
+    await response_cache.invalidate("catalog")
+    return await db.reviews.find_one({"product_id": product_id, "user_id": user["id"]}, {"_id": 0})
+
+@api_router.delete("/reviews/{review_id}", response_model=Message)
+async def delete_review(review_id: str, user: dict = Depends(get_current_user)):
+    query = {"id": review_id} if user.get("is_admin") else {"id": review_id, "user_id": user["id"]}
+    review = await db.reviews.find_one_and_delete(query, {"_id": 0, "product_id": 1, "rating": 1})
+    if not review:
+        raise HTTPException(status_code=404, detail="Avis non trouvé")
+    await db.products.update_one(
+        {"id": review["product_id"]},
+        {"$inc": {"rating_sum": -review["rating"], "rating_count": -1}}
+    )
+    await response_cache.invalidate("catalog")
+    return {"message": "Avis supprimé"}
+
+@api_router.get("/admin/products", response_model=ProductPage)
+async def get_admin_products(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    output: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    user: dict = Depends(get_admin_user)
+):
+    if output == "ndjson":
+        return ndjson_response(db.products, {}, PRODUCT_SUMMARY_PROJECTION, product_summary, limit, after)
+    
+    products, next_cursor = await paginate(
+        db.products, {}, PRODUCT_SUMMARY_PROJECTION, limit or DEFAULT_PAGE_SIZE, after
+    )
+    return ProductPage(items=[product_summary(p) for p in products], next_cursor=next_cursor)
+
+def import_error(result: ImportResult, row: int, error: str):
+    result.failed += 1
+    if len(result.errors) < BULK_IMPORT_MAX_ERRORS:
+        result.errors.append(ImportRowError(row=row, error=error))
+    else:
+        result.errors_truncated = True
+
+async def product_import_operation(record: dict, user: dict):
+    # Rows with an id update that product (or create it with that id); others are new products
+    product_data = ProductImport.model_validate(record)
+    media = await store_product_media(product_data)
+    fields = {
+        **product_data.dict(exclude=PRODUCT_MEDIA_INPUTS, exclude_none=True),
+        **media,
+        "search_terms": search_terms(product_data.name),
+    }
+    product_id = record.get("id")
+    if not product_id:
+        product = Product(**fields, created_by=user["id"]).dict()
+        return InsertOne(product), product, bool(media)
+    product = Product(**fields, id=str(product_id), created_by=user["id"]).dict()
+    update = product_update(fields, media)
+    # $setOnInsert may not touch a field $unset also names (media when it is reset)
+    unset = {path.split(".", 1)[0] for path in update.get("$unset", {})}
+    update["$setOnInsert"] = {k: v for k, v in product.items() if k not in fields and k not in unset and k != "version"}
+    update["$inc"] = {"version": 1}
+    return UpdateOne({"id": product["id"]}, update, upsert=True), product, bool(media)
+
+async def write_import_batch(batch: list, result: ImportResult):
+    failed = {}
+    try:
+        counts = (await db.products.bulk_write([op for _, op, _, _ in batch], ordered=False)).bulk_api_result
+    except BulkWriteError as e:
+        counts = e.details
+        failed = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+    result.inserted += counts["nInserted"] + counts["nUpserted"]
+    result.updated += counts["nMatched"]
+    for index, (row, _, product, derive) in enumerate(batch):
+        if index in failed:
+            import_error(result, row, failed[index])
+        elif derive:
+            await schedule_media_derivation(product)
+
+@api_router.post("/admin/products/import", response_model=ImportResult)
+async def import_products(
+    request: Request,
+    input_format: Optional[str] = Query(None, alias="format", pattern="^(ndjson|csv)$"),
+    user: dict = Depends(get_admin_user)
+):
+    # The body is parsed as it arrives; only one batch of rows is held at a time
+    fmt = input_format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    result = ImportResult()
+    batch = []
+    try:
+        async for row, record in parse_records(fmt, request.stream(), BULK_IMPORT_MAX_ROW_BYTES):
+            result.received += 1
+            if isinstance(record, RowError):
+                import_error(result, row, str(record))
+                continue
+            try:
+                batch.append((row, *await product_import_operation(record, user)))
+            except ValidationError as e:
+                import_error(result, row, "; ".join(
+                    f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                ))
+            except HTTPException as e:
+                import_error(result, row, str(e.detail))
+            if len(batch) >= BULK_IMPORT_BATCH_SIZE:
+                await write_import_batch(batch, result)
+                batch = []
+    except RowError as e:
+        result.aborted = str(e)
+    if batch:
+        await write_import_batch(batch, result)
+    if result.inserted or result.updated:
+        await response_cache.invalidate("catalog")
+    return result
+
+@api_router.get("/admin/products/export")
+async def export_products(
+    output: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    user: dict = Depends(get_admin_user)
+):
+    projection = {"_id": 0, **{field: 1 for field in PRODUCT_EXPORT_FIELDS}}
+    if output == "ndjson":
+        response = ndjson_response(db.products, {}, projection, lambda doc: ProductExport(**doc))
+    else:
+        cursor = db.products.find({}, projection).sort([("created_at", -1), ("id", -1)]).batch_size(500)
+
+        async def body():
+            yield csv_line(PRODUCT_EXPORT_FIELDS)
+            async for doc in cursor:
+                yield csv_line(ProductExport(**doc).model_dump(mode="json").values())
+
+        response = StreamingResponse(body(), media_type="text/csv")
+    response.headers["Content-Disposition"] = f'attachment; filename="products.{output}"'
+    return response
+
+@api_router.patch("/admin/users/{user_id}", response_model=UserResponse)
+async def update_user(user_id: str, user_data: UserAdminUpdate, admin: dict = Depends(get_admin_user)):
+    fields = user_data.dict(exclude_none=True)
+    if not fields:
+        raise HTTPException(status_code=400, detail="Aucune modification fournie")
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$set": fields},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
+    await invalidate_user(user_id)
+    return UserResponse(
+        id=user["id"],
+        email=user["email"],
+        username=user["username"],
+        is_admin=user["is_admin"],
+        referral_code=user.get("referral_code")
+    )
+
+# --- UPLOAD ROUTES ---
+@api_router.post("/uploads", response_model=UploadStatus)
+async def create_upload(upload_data: UploadCreate, user: dict = Depends(get_admin_user)):
+    if upload_data.kind not in ("file", "image"):
+        raise HTTPException(status_code=400, detail="Type de téléversement invalide")
+    if upload_data.size <= 0:
+        raise HTTPException(status_code=400, detail="Taille de fichier invalide")
+    if upload_data.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Fichier trop volumineux")
+    if not is_allowed_upload_type(upload_data.kind, upload_data.file_type):
+        raise HTTPException(status_code=415, detail="Type de fichier non autorisé")
+    
+    upload = Upload(
+        **upload_data.dict(),
+        part_size=UPLOAD_PART_SIZE,
+        total_parts=math.ceil(upload_data.size / UPLOAD_PART_SIZE),
+        created_by=user["id"],
+        expires_at=datetime.utcnow() + UPLOAD_EXPIRY
+    )
+    await db.uploads.insert_one(upload.dict())
+    return upload_status(upload.dict())
+
+@api_router.get("/uploads/{upload_id}", response_model=UploadStatus)
+async def get_upload(upload_id: str, user: dict = Depends(get_admin_user)):
+    # Clients resume by re-sending the parts missing from received_parts
+    return upload_status(await get_user_upload(upload_id, user))
+
+@api_router.put("/uploads/{upload_id}/parts/{part_number}")
+async def upload_part(
+    upload_id: str,
+    part_number: int,
+    request: Request,
+    part_sha256: Optional[str] = Header(None, alias="X-Part-Sha256"),
+    user: dict = Depends(get_admin_user)
+):
+    upload = await get_user_upload(upload_id, user)
+    if upload["status"] != "pending":
+        raise HTTPException(status_code=409, detail="Téléversement déjà finalisé")
+    if not 1 <= part_number <= upload["total_parts"]:
+        raise HTTPException(status_code=400, detail="Numéro de partie invalide")
+    
+    expected_size = expected_part_size(upload, part_number)
+    
+    async def body():
+        # Stream straight to storage, refusing anything past the expected size
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > expected_size:
+                raise HTTPException(status_code=413, detail="Partie trop volumineuse")
+            yield chunk
+    
+    part = await blob_store.put_part(upload_id, part_number, body())
+    if part.size != expected_size or (part_sha256 and part_sha256.lower() != part.sha256):
+        await blob_store.delete_parts(upload_id, [part_number])
+        raise HTTPException(status_code=400, detail="Partie incomplète ou corrompue")
+    
+    await db.uploads.update_one(
+        {"id": upload_id, "status": "pending"},
+        {"$set": {f"parts.{part_number}": part.dict()}}
+    )
+    return {"part_number": part_number, "size": part.size, "sha256": part.sha256}
+
+@api_router.post("/uploads/{upload_id}/complete", response_model=UploadStatus)
+async def complete_upload(upload_id: str, user: dict = Depends(get_admin_user)):
+    upload = await get_user_upload(upload_id, user)
+    if upload["status"] == "completed":
+        return upload_status(upload)
+    
+    part_numbers = list(range(1, upload["total_parts"] + 1))
+    missing = [n for n in part_numbers if str(n) not in upload.get("parts", {})]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Parties manquantes: {missing}")
+    
+    claimed = await db.uploads.find_one_and_update(
+        {"id": upload_id, "status": "pending"},
+        {"$set": {"status": "completing"}}
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Téléversement en cours de finalisation")
+    
+    # Parts are concatenated and hashed in one streaming pass
+    try:
+        blob = await blob_store.compose(upload_id, part_numbers)
+    except BaseException:
+        await db.uploads.update_one({"id": upload_id}, {"$set": {"status": "pending"}})
+        raise
+    file_type = upload["file_type"]
+    error = None
+    if blob.size != upload["size"]:
+        error = "Taille du fichier incorrecte"
+    elif upload.get("sha256") and upload["sha256"].lower() != blob.id:
+        error = "Empreinte SHA-256 incorrecte"
+    elif upload["kind"] == "image":
+        head = b"".join([chunk async for chunk in blob_store.iter_range(blob.id, 0, min(15, blob.size - 1))])
+        file_type = sniff_image_type(head)
+        if not file_type:
+            error = "Format d'image non reconnu"
+    if error:
+        await db.uploads.update_one({"id": upload_id}, {"$set": {"status": "pending"}})
+        raise HTTPException(status_code=400, detail=error)
+    
+    upload = await db.uploads.find_one_and_update(
+        {"id": upload_id},
+        {"$set": {"status": "completed", "blob_id": blob.id, "file_type": file_type}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    await blob_store.delete_parts(upload_id, part_numbers)
+    return upload_status(upload)
+
+@api_router.delete("/uploads/{upload_id}", response_model=Message)
+async def abort_upload(upload_id: str, user: dict = Depends(get_admin_user)):
+    upload = await get_user_upload(upload_id, user)
+    if upload["status"] != "pending":
+        raise HTTPException(status_code=409, detail="Téléversement déjà finalisé")
+    await blob_store.delete_parts(upload_id, list(range(1, upload["total_parts"] + 1)))
+    await db.uploads.delete_one({"id": upload_id})
+    return {"message": "Téléversement annulé"}
 
 # --- ORDER ROUTES ---
-@api_router.post("/orders")
-async def create_order(order_data: dict):
-    order = Order(**order_data)
-    await db.orders.insert_one(order.dict())
+async def price_order_items(items: List[OrderItemCreate]) -> Tuple[List[OrderItem], float]:
+    # Prices always come from the catalog, never from the client
+    quantities: Dict[str, int] = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    
+    products = {}
+    async for product in db.products.find(
+        {"id": {"$in": list(quantities)}, "is_active": True},
+        {"_id": 0, "id": 1, "name": 1, "price": 1, "category": 1}
+    ):
+        products[product["id"]] = product
+    
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Produits indisponibles: {missing}")
+    
+    lines = [
+        OrderItem(
+            product_id=product_id,
+            name=products[product_id]["name"],
+            price=products[product_id]["price"],
+            quantity=quantity,
+            category=products[product_id].get("category")
+        )
+        for product_id, quantity in quantities.items()
+    ]
+    total = round(sum(line.price * line.quantity for line in lines), 2)
+    return lines, total
+
+def order_request_hash(order_data: OrderCreate, user: Optional[dict]) -> str:
+    payload = json.dumps([user["id"] if user else None, order_data.dict()], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def find_idempotent_order(idempotency_key: str, request_hash: str) -> Optional[dict]:
+    existing = await db.orders.find_one({"idempotency_key": idempotency_key}, {"_id": 0})
+    if existing and existing["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Clé d'idempotence déjà utilisée pour une autre commande")
+    return existing
+
+@api_router.post("/orders", response_model=Order)
+async def create_order(
+    order_data: OrderCreate,
+    user: Optional[dict] = Depends(get_optional_user),
+    idempotency_key: Optional[str] = Header(default=None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH)
+):
+    request_hash = order_request_hash(order_data, user)
+    if idempotency_key:
+        # Keys are scoped per user so clients can't collide with each other
+        idempotency_key = f"{user['id'] if user else 'guest'}:{idempotency_key}"
+        existing = await find_idempotent_order(idempotency_key, request_hash)
+        if existing:
+            return existing
+    
+    lines, total = await price_order_items(order_data.items)
+    order = Order(
+        user_id=user["id"] if user else None,
+        user_email=user["email"] if user else order_data.user_email,
+        products=lines,
+        total_amount=total,
+        payment_method=order_data.payment_method
+    )
+    doc = order.dict()
+    if idempotency_key:
+        doc.update(idempotency_key=idempotency_key, request_hash=request_hash)
+    try:
+        await db.orders.insert_one(doc)
+    except DuplicateKeyError:
+        # A concurrent retry with the same key won the race
+        existing = await find_idempotent_order(idempotency_key, request_hash) if idempotency_key else None
+        if not existing:
+            raise
+        return existing
     return order
 
-@api_router.get("/orders/{order_id}")
+@api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
-    order = await db.orders.find_one({"id": order_id})
+    order = await db.orders.find_one({"id": order_id}, ORDER_PROJECTION)
     if not order:
         raise HTTPException(status_code=404, detail="Commande non trouvée")
     return order
 
-# --- CATEGORIES ROUTE ---
-@api_router.get("/categories")
-async def get_categories():
+@api_router.post("/payments/fedapay/webhook")
+async def fedapay_webhook(request: Request):
+    # Only verify and enqueue here; transitions are applied by payment_jobs
+    if not FEDAPAY_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="Webhooks de paiement non configurés")
+    payload = await request.body()
+    try:
+        verify_signature(payload, request.headers.get(SIGNATURE_HEADER), FEDAPAY_WEBHOOK_SECRET, FEDAPAY_WEBHOOK_TOLERANCE)
+        event = json.loads(payload)
+    except (InvalidSignature, ValueError):
+        raise HTTPException(status_code=400, detail="Signature ou contenu invalide")
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Signature ou contenu invalide")
+    
+    # Providers redeliver on timeouts; the event id dedupes them
+    event_id = event.get("id")
+    queued = await payment_jobs.enqueue(event, dedupe_key=f"fedapay:{event_id}" if event_id else None)
+    return {"received": True, "duplicate": not queued}
+
+def stats_range(days: int, end: Optional[str]) -> Tuple[str, str]:
+    try:
+        last = datetime.strptime(end, "%Y-%m-%d") if end else datetime.utcnow()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date invalide, format attendu AAAA-MM-JJ")
+    return (last - timedelta(days=days - 1)).strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d")
+
+# Stats answer from the rollups: cost grows with the days asked for, never with order volume
+@api_router.get("/admin/stats/summary", response_model=SalesSummary)
+async def get_sales_summary(
+    days: int = Query(30, ge=1, le=366),
+    end: Optional[str] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    start, end = stats_range(days, end)
+    revenue, orders, units = 0.0, 0, 0
+    async for bucket in db.sales_daily.find({"_id": {"$gte": start, "$lte": end}}, SALES_ROLLUP_PROJECTION):
+        revenue += bucket.get("revenue", 0.0)
+        orders += bucket.get("orders", 0)
+        units += bucket.get("units", 0)
+    return SalesSummary(
+        start=start,
+        end=end,
+        revenue=round(revenue, 2),
+        orders=orders,
+        units=units,
+        average_order_value=round(revenue / orders, 2) if orders else None
+    )
+
+@api_router.get("/admin/stats/daily", response_model=List[SalesDay])
+async def get_sales_daily(
+    days: int = Query(30, ge=1, le=366),
+    end: Optional[str] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    start, end = stats_range(days, end)
+    buckets = await db.sales_daily.find({"_id": {"$gte": start, "$lte": end}}, SALES_ROLLUP_PROJECTION).sort("_id", ASCENDING).to_list(days)
+    return [
+        SalesDay(day=bucket["_id"], revenue=round(bucket.get("revenue", 0.0), 2),
+                 orders=bucket.get("orders", 0), units=bucket.get("units", 0))
+        for bucket in buckets
+    ]
+
+@api_router.get("/admin/stats/products", response_model=List[ProductSales])
+async def get_top_products(
+    limit: int = Query(10, ge=1, le=100),
+    sort: str = Query("revenue", pattern="^(revenue|units)$"),
+    admin: dict = Depends(get_admin_user)
+):
+    # All-time best sellers, read straight off the sort index
+    products = await db.sales_products.find({}, SALES_ROLLUP_PROJECTION).sort(sort, DESCENDING).limit(limit).to_list(limit)
     return [
-        {"id": "ebooks", "name": "E-books", "description": "Livres numériques"},
-        {"id": "templates", "name": "Templates", "description": "Modèles et templates"},
-        {"id": "audio", "name": "Audio", "description": "Fichiers audio"},
-        {"id": "videos", "name": "Vidéos", "description": "Contenus vidéo"},
-        {"id": "ai_packs", "name": "Packs IA", "description": "Outils et ressources IA"}
+        ProductSales(product_id=p.pop("_id"), **{**p, "revenue": round(p.get("revenue", 0.0), 2)})
+        for p in products
     ]
 
+@api_router.get("/admin/stats/categories", response_model=List[CategorySales])
+async def get_category_sales(
+    days: int = Query(30, ge=1, le=366),
+    end: Optional[str] = None,
+    admin: dict = Depends(get_admin_user)
+):
+    start, end = stats_range(days, end)
+    totals: Dict[str, list] = {}
+    async for bucket in db.sales_categories.find({"day": {"$gte": start, "$lte": end}}, SALES_ROLLUP_PROJECTION):
+        entry = totals.setdefault(bucket["category"], [0.0, 0])
+        entry[0] += bucket.get("revenue", 0.0)
+        entry[1] += bucket.get("units", 0)
+    return sorted(
+        (CategorySales(category=category, revenue=round(revenue, 2), units=units)
+         for category, (revenue, units) in totals.items()),
+        key=lambda c: -c.revenue
+    )
+
+@api_router.get("/admin/jobs")
+async def get_job_stats(admin: dict = Depends(get_admin_user)):
+    return {
+        "media_jobs": await media_jobs.stats(),
+        "payment_events": await payment_jobs.stats(),
+    }
+
+# --- CATEGORIES ROUTE ---
+CATEGORIES = [
+    {"id": "ebooks", "name": "E-books", "description": "Livres numériques"},
+    {"id": "templates", "name": "Templates", "description": "Modèles et templates"},
+    {"id": "audio", "name": "Audio", "description": "Fichiers audio"},
+    {"id": "videos", "name": "Vidéos", "description": "Contenus vidéo"},
+    {"id": "ai_packs", "name": "Packs IA", "description": "Outils et ressources IA"}
+]
+
+@api_router.get("/categories")
+async def get_categories(request: Request):
+    async def produce():
+        return CATEGORIES
+    
+    return await response_cache.respond(request, ["categories"], produce)
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Service momentanément surchargé, veuillez réessayer"},
+        headers={"Retry-After": "1"}
+    )
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    # Liveness only: a database outage must not get every worker restarted
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    problems = []
+    if not accepting_traffic:
+        problems.append("not started or shutting down")
+    elif mongo_pool_listener.saturated():
+        problems.append("mongodb connection pool exhausted")
+    else:
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), READINESS_TIMEOUT)
+        except (asyncio.TimeoutError, PyMongoError) as e:
+            problems.append(f"mongodb unreachable: {type(e).__name__}")
+    if problems:
+        return ORJSONResponse({"status": "unavailable", "problems": problems}, status_code=503)
+    return {"status": "ready"}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not (authorization and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")):
+        raise HTTPException(status_code=401, detail="Token invalide")
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+metrics_registry.counter_callback(
+    "cache_hits_total", "Cache lookups served from cache", lambda: {
+        ("session",): session_cache.hits,
+        ("response",): response_cache.hits,
+    }, ["cache"]
+)
+metrics_registry.counter_callback(
+    "cache_misses_total", "Cache lookups that missed", lambda: {
+        ("session",): session_cache.misses,
+        ("response",): response_cache.misses,
+    }, ["cache"]
+)
+metrics_registry.gauge("password_hash_in_flight", "Password hashes running or queued", lambda: password_hasher.in_flight)
+metrics_registry.counter_callback(
+    "password_hash_rejected_total", "Password hashes rejected with 503", lambda: password_hasher.rejected
+)
+metrics_registry.counter_callback("rate_limit_rejected_total", "Requests rejected with 429", lambda: rate_limiter.rejected)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -283,13 +2185,125 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+# Added last so it is outermost and times the whole stack
+app.add_middleware(MetricsMiddleware, metrics=http_metrics, slow_request_ms=SLOW_REQUEST_MS)
+
+
+# Flipped once startup completes and again when shutdown begins, so the load
+# balancer only routes to workers that are warm and not draining
+accepting_traffic = False
+
+async def warm_up_mongo_pool():
+    # Pay server selection and connection handshakes before the first request does
+    started = time.perf_counter()
+    await client.admin.command("ping")
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(MONGO_WARMUP_CONNECTIONS)))
+    logger.info("MongoDB pool warmed in %.0fms", (time.perf_counter() - started) * 1000)
+
+def check_download_url_secret():
+    # Without it each process signs with its own random key: links handed out
+    # by one worker are rejected by the others, and by every worker after a restart
+    if os.environ.get('DOWNLOAD_URL_SECRET'):
+        return
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    if workers > 1:
+        raise RuntimeError(f"DOWNLOAD_URL_SECRET must be set to run {workers} workers (WEB_CONCURRENCY)")
+    logger.warning("DOWNLOAD_URL_SECRET is not set; download links will stop working when this process restarts")
+
+def connect():
+    """Build the MongoDB client and everything bound to the database.
+
+    Runs from startup(), in the worker process; manage.py calls it too. Motor
+    connects lazily, so nothing touches the network until the pool is warmed.
+    """
+    global client, db, blob_store, invalidation_bus, response_cache, media_jobs, referral_ledger, payment_jobs
+    client = AsyncIOMotorClient(
+        os.environ['MONGO_URL'],
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+        connectTimeoutMS=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        # Bounded wait for a pooled connection: fail fast rather than pile up requests
+        waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+        event_listeners=[MongoCommandListener(metrics_registry), mongo_pool_listener]
+    )
+    db = client[os.environ['DB_NAME']]
+    blob_store = create_blob_store(
+        os.environ.get('BLOB_BACKEND', 'gridfs'),
+        db,
+        root=os.environ.get('BLOB_ROOT', str(ROOT_DIR / 'blobs')),
+        chunk_size=int(os.environ.get('BLOB_CHUNK_SIZE', 1024 * 1024)),
+    )
+    invalidation_bus = create_invalidation_bus(os.environ.get('CACHE_INVALIDATION_BACKEND', 'local'), db)
+    invalidation_bus.subscribe("users", drop_cached_user)
+    invalidation_bus.subscribe("sessions", session_cache.pop)
+    response_cache = ResponseCache(
+        create_response_backend(
+            os.environ.get('RESPONSE_CACHE_BACKEND', 'memory'),
+            db,
+            maxsize=int(os.environ.get('RESPONSE_CACHE_SIZE', 1000)),
+            ttl=RESPONSE_CACHE_MAX_AGE + RESPONSE_CACHE_SWR
+        ),
+        invalidation_bus,
+        render=render_json,
+        max_age=RESPONSE_CACHE_MAX_AGE,
+        stale_while_revalidate=RESPONSE_CACHE_SWR
+    )
+    rate_limiter.backend = create_rate_limit_backend(os.environ.get('RATE_LIMIT_BACKEND', 'memory'), db)
+    media_jobs = JobQueue(
+        db.media_jobs,
+        derive_product_media,
+        name="media_jobs",
+        concurrency=MEDIA_JOB_CONCURRENCY,
+        max_attempts=3,
+        # Media switched back to an earlier image or file must be derived again
+        dedupe_finished=False
+    )
+    referral_ledger = ReferralLedger(
+        db.referral_ledger,
+        db.referral_summaries,
+        db.referral_rollup_state,
+        interval=REFERRAL_ROLLUP_INTERVAL,
+        lag=REFERRAL_ROLLUP_LAG
+    )
+    payment_jobs = JobQueue(
+        db.payment_events,
+        apply_payment_event,
+        name="payment_events",
+        concurrency=PAYMENT_JOB_CONCURRENCY,
+        max_attempts=8
+    )
+
+async def startup():
+    global media_pool, accepting_traffic
+    check_download_url_secret()
+    connect()
+    await warm_up_mongo_pool()
+    await ensure_indexes()
+    await report_collection_scans()
+    await invalidation_bus.start()
+    await response_cache.start()
+    await rate_limiter.start()
+    # spawn, not fork: the parent already runs Motor's threads
+    media_pool = ProcessPoolExecutor(
+        max_workers=MEDIA_PROCESS_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+    await media_jobs.start()
+    await payment_jobs.start()
+    await referral_ledger.start()
+    accepting_traffic = True
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def shutdown():
+    global accepting_traffic
+    accepting_traffic = False
+    await referral_ledger.stop()
+    await payment_jobs.stop()
+    await media_jobs.stop()
+    if media_pool:
+        media_pool.shutdown(wait=False, cancel_futures=True)
+    await invalidation_bus.stop()
+    password_hasher.shutdown()
+    if client:
+        client.close()
\ No newline at end of file
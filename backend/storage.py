@@ -0,0 +1,334 @@
+"""Content-addressed blob storage for product files and images.
+
+Blobs are identified by the SHA-256 of their raw bytes, so identical uploads are
+stored once. Two backends are available: GridFS (default, lives next to the
+rest of the data) and a local filesystem store for single-host deployments.
+
+Large files arrive as numbered parts of a resumable upload. Parts are kept
+under the upload id until ``compose`` streams them, in order, into a blob.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pydantic import BaseModel
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_BLOB_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class StoredBlob(BaseModel):
+    id: str
+    size: int
+
+
+class StoredPart(BaseModel):
+    size: int
+    sha256: str
+
+
+def is_blob_id(value: str) -> bool:
+    return bool(_BLOB_ID_RE.match(value or ""))
+
+
+def _check_upload_id(upload_id: str) -> str:
+    if not re.match(r"^[0-9a-f-]{1,64}$", upload_id or ""):
+        raise ValueError(f"Invalid upload id: {upload_id}")
+    return upload_id
+
+
+class BlobStore(ABC):
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+
+    @abstractmethod
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> StoredBlob:
+        ...
+
+    async def put_bytes(self, data: bytes) -> StoredBlob:
+        async def _chunks():
+            view = memoryview(data)
+            for offset in range(0, len(view), self.chunk_size):
+                yield bytes(view[offset:offset + self.chunk_size])
+
+        return await self.put_stream(_chunks())
+
+    @abstractmethod
+    async def size(self, blob_id: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def iter_range(self, blob_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Yield bytes ``start..end`` (inclusive) in ``chunk_size`` pieces."""
+
+    @abstractmethod
+    async def delete(self, blob_id: str) -> None:
+        ...
+
+    async def read(self, blob_id: str) -> bytes:
+        """Load a whole blob; only for payloads known to be small."""
+        size = await self.size(blob_id)
+        if size is None:
+            raise BlobNotFound(blob_id)
+        if not size:
+            return b""
+        return b"".join([chunk async for chunk in self.iter_range(blob_id, 0, size - 1)])
+
+    async def put_file(self, path: str) -> StoredBlob:
+        async def _chunks():
+            f = await asyncio.to_thread(open, path, "rb")
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                await asyncio.to_thread(f.close)
+
+        return await self.put_stream(_chunks())
+
+    async def download_to(self, blob_id: str, path: str) -> None:
+        size = await self.size(blob_id)
+        if size is None:
+            raise BlobNotFound(blob_id)
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            if size:
+                async for chunk in self.iter_range(blob_id, 0, size - 1):
+                    await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @abstractmethod
+    async def put_part(self, upload_id: str, part_number: int, chunks: AsyncIterator[bytes]) -> StoredPart:
+        """Store one part of an upload, replacing any earlier attempt at it."""
+
+    @abstractmethod
+    def iter_part(self, upload_id: str, part_number: int) -> AsyncIterator[bytes]:
+        ...
+
+    @abstractmethod
+    async def delete_parts(self, upload_id: str, part_numbers: List[int]) -> None:
+        ...
+
+    async def compose(self, upload_id: str, part_numbers: List[int]) -> StoredBlob:
+        # Parts are streamed one chunk at a time, so memory stays at chunk_size
+        async def _chunks():
+            for part_number in part_numbers:
+                async for chunk in self.iter_part(upload_id, part_number):
+                    yield chunk
+
+        return await self.put_stream(_chunks())
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.tmp_dir = self.root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, blob_id: str) -> Path:
+        if not is_blob_id(blob_id):
+            raise BlobNotFound(blob_id)
+        return self.root / blob_id[:2] / blob_id[2:4] / blob_id
+
+    async def _write_tmp(self, chunks: AsyncIterator[bytes]):
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = self.tmp_dir / uuid.uuid4().hex
+        f = await asyncio.to_thread(open, tmp_path, "wb")
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            f.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(f.close)
+        return tmp_path, size, digest.hexdigest()
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> StoredBlob:
+        tmp_path, size, blob_id = await self._write_tmp(chunks)
+        final_path = self._path(blob_id)
+        if final_path.exists():
+            tmp_path.unlink(missing_ok=True)
+        else:
+            final_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, final_path)
+        return StoredBlob(id=blob_id, size=size)
+
+    async def size(self, blob_id: str) -> Optional[int]:
+        try:
+            return self._path(blob_id).stat().st_size
+        except (BlobNotFound, FileNotFoundError):
+            return None
+
+    async def iter_range(self, blob_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        try:
+            f = await asyncio.to_thread(open, self._path(blob_id), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(blob_id)
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def delete(self, blob_id: str) -> None:
+        try:
+            self._path(blob_id).unlink(missing_ok=True)
+        except BlobNotFound:
+            pass
+
+    def _part_path(self, upload_id: str, part_number: int) -> Path:
+        return self.root / "uploads" / _check_upload_id(upload_id) / str(int(part_number))
+
+    async def put_part(self, upload_id: str, part_number: int, chunks: AsyncIterator[bytes]) -> StoredPart:
+        part_path = self._part_path(upload_id, part_number)
+        tmp_path, size, sha256 = await self._write_tmp(chunks)
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, part_path)
+        return StoredPart(size=size, sha256=sha256)
+
+    async def iter_part(self, upload_id: str, part_number: int) -> AsyncIterator[bytes]:
+        try:
+            f = await asyncio.to_thread(open, self._part_path(upload_id, part_number), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(f"{upload_id}/{part_number}")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def delete_parts(self, upload_id: str, part_numbers: List[int]) -> None:
+        for part_number in part_numbers:
+            self._part_path(upload_id, part_number).unlink(missing_ok=True)
+        try:
+            (self.root / "uploads" / _check_upload_id(upload_id)).rmdir()
+        except OSError:
+            pass
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, db, bucket_name: str = "blobs", chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=chunk_size)
+        self.files = db[f"{bucket_name}.files"]
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> StoredBlob:
+        digest = hashlib.sha256()
+        size = 0
+        # The content hash is only known once the last chunk is written, so the
+        # file is uploaded under a temporary name and renamed afterwards.
+        grid_in = self.bucket.open_upload_stream(f"tmp-{uuid.uuid4().hex}")
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+
+        blob_id = digest.hexdigest()
+        existing = await self.files.find_one({"filename": blob_id}, {"_id": 1})
+        if existing:
+            await self.bucket.delete(grid_in._id)
+        else:
+            await self.bucket.rename(grid_in._id, blob_id)
+        return StoredBlob(id=blob_id, size=size)
+
+    async def size(self, blob_id: str) -> Optional[int]:
+        doc = await self.files.find_one({"filename": blob_id}, {"length": 1})
+        return doc["length"] if doc else None
+
+    async def iter_range(self, blob_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        try:
+            grid_out = await self.bucket.open_download_stream_by_name(blob_id)
+        except NoFile:
+            raise BlobNotFound(blob_id)
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    async def delete(self, blob_id: str) -> None:
+        async for doc in self.files.find({"filename": blob_id}, {"_id": 1}):
+            await self.bucket.delete(doc["_id"])
+
+    @staticmethod
+    def _part_name(upload_id: str, part_number: int) -> str:
+        return f"part:{_check_upload_id(upload_id)}:{int(part_number)}"
+
+    async def put_part(self, upload_id: str, part_number: int, chunks: AsyncIterator[bytes]) -> StoredPart:
+        digest = hashlib.sha256()
+        size = 0
+        name = self._part_name(upload_id, part_number)
+        grid_in = self.bucket.open_upload_stream(name)
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+        # Drop earlier attempts at this part
+        async for doc in self.files.find({"filename": name, "_id": {"$ne": grid_in._id}}, {"_id": 1}):
+            await self.bucket.delete(doc["_id"])
+        return StoredPart(size=size, sha256=digest.hexdigest())
+
+    async def iter_part(self, upload_id: str, part_number: int) -> AsyncIterator[bytes]:
+        try:
+            grid_out = await self.bucket.open_download_stream_by_name(self._part_name(upload_id, part_number))
+        except NoFile:
+            raise BlobNotFound(f"{upload_id}/{part_number}")
+        while True:
+            chunk = await grid_out.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    async def delete_parts(self, upload_id: str, part_numbers: List[int]) -> None:
+        names = [self._part_name(upload_id, part_number) for part_number in part_numbers]
+        async for doc in self.files.find({"filename": {"$in": names}}, {"_id": 1}):
+            await self.bucket.delete(doc["_id"])
+
+
+def create_blob_store(backend: str, db, root: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> BlobStore:
+    if backend == "gridfs":
+        return GridFSBlobStore(db, chunk_size=chunk_size)
+    if backend == "local":
+        return LocalBlobStore(root, chunk_size=chunk_size)
+    raise ValueError(f"Unknown blob storage backend: {backend}")
@@ -4,7 +4,7 @@ import axios from "axios";
 import { 
   FiHome, FiShoppingBag, FiInfo, FiMail, FiUser, FiLogOut, FiLogIn, FiUserPlus,
   FiSearch, FiFilter, FiShoppingCart, FiDownload, FiEdit, FiTrash2, FiPlus,
-  FiBook, FiLayout, FiMusic, FiVideo, FiCpu, FiCheck, FiX, FiUpload
+  FiBook, FiLayout, FiMusic, FiVideo, FiCpu, FiCheck, FiX, FiUpload, FiStar
 } from 'react-icons/fi';
 import { 
   HiOutlineSparkles, HiOutlineLightBulb, HiOutlineShieldCheck 
@@ -61,7 +61,9 @@ const AuthProvider = ({ children }) => {
 
   const register = async (email, username, password) => {
     try {
-      const response = await axios.post(`${API}/auth/register`, { email, username, password });
+      // Referral links land on /?ref=CODE
+      const referral_code = new URLSearchParams(window.location.search).get('ref') || undefined;
+      const response = await axios.post(`${API}/auth/register`, { email, username, password, referral_code });
       const { token: newToken, user: userData } = response.data;
       
       localStorage.setItem('token', newToken);
@@ -208,8 +210,8 @@ const HomePage = ({ setCurrentPage }) => {
 
   const fetchFeaturedProducts = async () => {
     try {
-      const response = await axios.get(`${API}/products`);
-      setFeaturedProducts(response.data.slice(0, 6));
+      const response = await axios.get(`${API}/products?limit=6`);
+      setFeaturedProducts(response.data.items);
     } catch (error) {
       console.error('Erreur lors du chargement des produits:', error);
     }
@@ -286,9 +288,11 @@ const HomePage = ({ setCurrentPage }) => {
 
 const ProductsPage = ({ setCurrentPage }) => {
   const [products, setProducts] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [categories, setCategories] = useState([]);
   const [selectedCategory, setSelectedCategory] = useState('');
   const [searchTerm, setSearchTerm] = useState('');
+  const [suggestions, setSuggestions] = useState([]);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -296,6 +300,22 @@ const ProductsPage = ({ setCurrentPage }) => {
     fetchProducts();
   }, [selectedCategory, searchTerm]);
 
+  useEffect(() => {
+    if (!searchTerm.trim()) {
+      setSuggestions([]);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/products/suggest`, { params: { q: searchTerm } });
+        setSuggestions(response.data);
+      } catch (error) {
+        setSuggestions([]);
+      }
+    }, 200);
+    return () => clearTimeout(timer);
+  }, [searchTerm]);
+
   const fetchCategories = async () => {
     try {
       const response = await axios.get(`${API}/categories`);
@@ -305,14 +325,16 @@ const ProductsPage = ({ setCurrentPage }) => {
     }
   };
 
-  const fetchProducts = async () => {
+  const fetchProducts = async (after = null) => {
     try {
       const params = new URLSearchParams();
       if (selectedCategory) params.append('category', selectedCategory);
       if (searchTerm) params.append('search', searchTerm);
+      if (after) params.append('after', after);
       
       const response = await axios.get(`${API}/products?${params}`);
-      setProducts(response.data);
+      setProducts(after ? [...products, ...response.data.items] : response.data.items);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Erreur:', error);
     }
@@ -334,7 +356,13 @@ const ProductsPage = ({ setCurrentPage }) => {
               placeholder="Rechercher un produit..."
               value={searchTerm}
               onChange={(e) => setSearchTerm(e.target.value)}
+              list="product-suggestions"
             />
+            <datalist id="product-suggestions">
+              {suggestions.map(suggestion => (
+                <option key={suggestion.id} value={suggestion.name} />
+              ))}
+            </datalist>
           </div>
           
           <div className="category-filter">
@@ -363,16 +391,31 @@ const ProductsPage = ({ setCurrentPage }) => {
           </div>
         )}
       </div>
+
+      {nextCursor && (
+        <button className="btn-load-more" onClick={() => fetchProducts(nextCursor)}>
+          Voir plus de produits
+        </button>
+      )}
     </div>
   );
 };
 
 const ProductCard = ({ product }) => {
+  const srcSet = Object.entries(product.thumbnails || {})
+    .map(([width, url]) => `${BACKEND_URL}${url} ${width}w`)
+    .join(', ');
   return (
     <div className="product-card">
       <div className="product-image">
-        {product.image_base64 ? (
-          <img src={`data:image/jpeg;base64,${product.image_base64}`} alt={product.name} />
+        {product.image_url ? (
+          <img
+            src={`${BACKEND_URL}${product.image_url}`}
+            srcSet={srcSet || undefined}
+            sizes="(max-width: 600px) 100vw, 320px"
+            alt={product.name}
+            loading="lazy"
+          />
         ) : (
           <div className="placeholder-image">
             <FiShoppingBag />
@@ -381,6 +424,11 @@ const ProductCard = ({ product }) => {
       </div>
       <div className="product-info">
         <h3>{product.name}</h3>
+        {product.rating_count > 0 && (
+          <div className="product-rating" title={`${product.rating_average} / 5`}>
+            <FiStar /> {product.rating_average.toFixed(1)} ({product.rating_count})
+          </div>
+        )}
         <p className="product-description">{product.description}</p>
         <div className="product-footer">
           <span className="product-price">{product.price}€</span>
@@ -499,6 +547,7 @@ const RegisterPage = ({ setCurrentPage }) => {
 const AdminPage = () => {
   const { user } = useAuth();
   const [products, setProducts] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [showForm, setShowForm] = useState(false);
   const [editingProduct, setEditingProduct] = useState(null);
 
@@ -508,10 +557,14 @@ const AdminPage = () => {
     }
   }, [user]);
 
-  const fetchAdminProducts = async () => {
+  const fetchAdminProducts = async (after = null) => {
     try {
-      const response = await axios.get(`${API}/admin/products`);
-      setProducts(response.data);
+      const params = new URLSearchParams();
+      if (after) params.append('after', after);
+
+      const response = await axios.get(`${API}/admin/products?${params}`);
+      setProducts(after ? [...products, ...response.data.items] : response.data.items);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Erreur:', error);
     }
@@ -579,6 +632,11 @@ const AdminPage = () => {
             </div>
           ))}
         </div>
+        {nextCursor && (
+          <button className="btn-load-more" onClick={() => fetchAdminProducts(nextCursor)}>
+            Voir plus
+          </button>
+        )}
       </div>
     </div>
   );
@@ -595,51 +653,85 @@ const AdminPage = () => {
   }
 };
 
+const uploadInParts = async (file, kind) => {
+  // Resumable upload: each part is retried on its own instead of restarting the file
+  const { data: upload } = await axios.post(`${API}/uploads`, {
+    kind,
+    file_name: file.name,
+    file_type: file.type || 'application/octet-stream',
+    size: file.size
+  });
+  for (let part = 1; part <= upload.total_parts; part++) {
+    const start = (part - 1) * upload.part_size;
+    const chunk = file.slice(start, start + upload.part_size);
+    for (let attempt = 1; ; attempt++) {
+      try {
+        await axios.put(`${API}/uploads/${upload.id}/parts/${part}`, chunk, {
+          headers: { 'Content-Type': 'application/octet-stream' }
+        });
+        break;
+      } catch (error) {
+        if (attempt >= 3) throw error;
+      }
+    }
+  }
+  const { data: completed } = await axios.post(`${API}/uploads/${upload.id}/complete`);
+  return completed.blob_id;
+};
+
 const ProductForm = ({ product, onClose, onSave }) => {
   const [formData, setFormData] = useState({
     name: product?.name || '',
     description: product?.description || '',
     price: product?.price || '',
     category: product?.category || 'ebooks',
-    image_base64: product?.image_base64 || '',
-    file_base64: product?.file_base64 || '',
     file_name: product?.file_name || '',
     file_type: product?.file_type || ''
   });
+  const [imageFile, setImageFile] = useState(null);
+  const [productFile, setProductFile] = useState(null);
+  const [saving, setSaving] = useState(false);
 
   const handleFileChange = (e, type) => {
     const file = e.target.files[0];
     if (file) {
-      const reader = new FileReader();
-      reader.onload = () => {
-        const base64 = reader.result.split(',')[1];
-        if (type === 'image') {
-          setFormData({...formData, image_base64: base64});
-        } else {
-          setFormData({
-            ...formData, 
-            file_base64: base64,
-            file_name: file.name,
-            file_type: file.type
-          });
-        }
-      };
-      reader.readAsDataURL(file);
+      if (type === 'image') {
+        setImageFile(file);
+      } else {
+        setProductFile(file);
+        setFormData({
+          ...formData,
+          file_name: file.name,
+          file_type: file.type
+        });
+      }
     }
   };
 
   const handleSubmit = async (e) => {
     e.preventDefault();
+    setSaving(true);
     try {
+      const payload = { ...formData };
+      if (imageFile) payload.image_blob_id = await uploadInParts(imageFile, 'image');
+      if (productFile) payload.file_blob_id = await uploadInParts(productFile, 'file');
       if (product) {
-        await axios.put(`${API}/products/${product.id}`, formData);
+        // Send only what changed; the version makes a concurrent edit fail with 412
+        const changes = Object.fromEntries(
+          Object.entries(payload).filter(([key, value]) => String(value) !== String(product[key] ?? ''))
+        );
+        await axios.patch(`${API}/products/${product.id}`, { ...changes, version: product.version });
       } else {
-        await axios.post(`${API}/products`, formData);
+        await axios.post(`${API}/products`, payload);
       }
       onSave();
     } catch (error) {
+      if (error.response?.status === 412) {
+        window.alert('Ce produit a été modifié par quelqu\'un d\'autre. Rechargez la liste puis recommencez.');
+      }
       console.error('Erreur:', error);
     }
+    setSaving(false);
   };
 
   return (
@@ -694,7 +786,9 @@ const ProductForm = ({ product, onClose, onSave }) => {
           
           <div className="form-actions">
             <button type="button" onClick={onClose}>Annuler</button>
-            <button type="submit">Sauvegarder</button>
+            <button type="submit" disabled={saving}>
+              {saving ? 'Envoi en cours...' : 'Sauvegarder'}
+            </button>
           </div>
         </form>
       </div>
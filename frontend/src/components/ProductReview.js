@@ -1,30 +1,59 @@
-import React, { useState } from "react";
+import React, { useCallback, useEffect, useState } from "react";
+import axios from "axios";
 
-const ProductReview = ({ productId, reviews = [], onAddReview }) => {
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+// Reviews live on the server; posting again replaces the user's own review
+const ProductReview = ({ productId, onRatingChange }) => {
+  const [reviews, setReviews] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [rating, setRating] = useState(0);
   const [comment, setComment] = useState("");
+  const [error, setError] = useState("");
+
+  const fetchReviews = useCallback(async (cursor) => {
+    const response = await axios.get(`${API}/products/${productId}/reviews`, {
+      params: { limit: 10, cursor: cursor || undefined }
+    });
+    setReviews(previous => (cursor ? [...previous, ...response.data.items] : response.data.items));
+    setNextCursor(response.data.next_cursor);
+  }, [productId]);
+
+  useEffect(() => {
+    fetchReviews(null).catch(() => setError("Impossible de charger les avis."));
+  }, [fetchReviews]);
 
-  const handleSubmit = (e) => {
+  const handleSubmit = async (e) => {
     e.preventDefault();
-    if (rating && comment) {
-      onAddReview({ productId, rating, comment });
+    if (!rating) return;
+    try {
+      await axios.put(`${API}/products/${productId}/reviews`, { rating, comment });
       setRating(0);
       setComment("");
+      setError("");
+      await fetchReviews(null);
+      if (onRatingChange) onRatingChange();
+    } catch (err) {
+      setError(err.response?.status === 401 ? "Connectez-vous pour laisser un avis." : "Envoi de l'avis impossible.");
     }
   };
 
   return (
     <div className="product-review">
       <h4>Avis des utilisateurs</h4>
+      {error && <p className="error-message">{error}</p>}
       {reviews.length === 0 && <p>Aucun avis pour ce produit.</p>}
       <ul>
-        {reviews.map((r, idx) => (
-          <li key={idx}>
-            <strong>Note :</strong> {r.rating} / 5<br />
-            <em>{r.comment}</em>
+        {reviews.map((r) => (
+          <li key={r.id}>
+            <strong>{r.username}</strong> — {r.rating} / 5<br />
+            {r.comment && <em>{r.comment}</em>}
           </li>
         ))}
       </ul>
+      {nextCursor && (
+        <button type="button" onClick={() => fetchReviews(nextCursor)}>Plus d'avis</button>
+      )}
       <form onSubmit={handleSubmit}>
         <label>
           Note :
@@ -39,14 +68,14 @@ const ProductReview = ({ productId, reviews = [], onAddReview }) => {
         <textarea
           placeholder="Votre avis..."
           value={comment}
+          maxLength={2000}
           onChange={e => setComment(e.target.value)}
-          required
         />
         <br />
-        <button type="submit">Envoyer</button>
+        <button type="submit" disabled={!rating}>Envoyer</button>
       </form>
     </div>
   );
 };
 
-export default ProductReview;
\ No newline at end of file
+export default ProductReview;
@@ -4,14 +4,6 @@ import ProductReview from "./ProductReview";
 
 const ProductPage = ({ products }) => {
   const [filteredProducts, setFilteredProducts] = useState(products);
-  const [reviews, setReviews] = useState({}); // { productId: [ {rating, comment}, ... ] }
-
-  const handleAddReview = (review) => {
-    setReviews((prev) => ({
-      ...prev,
-      [review.productId]: [...(prev[review.productId] || []), review],
-    }));
-  };
 
   return (
     <div className="product-page">
@@ -22,11 +14,7 @@ const ProductPage = ({ products }) => {
             <h3>{product.name}</h3>
             <p>{product.description}</p>
             <span>{product.price} €</span>
-            <ProductReview
-              productId={product.id}
-              reviews={reviews[product.id] || []}
-              onAddReview={handleAddReview}
-            />
+            <ProductReview productId={product.id} />
           </div>
         ))}
       </div>
@@ -1,7 +1,21 @@
-import React from "react";
+import React, { useEffect, useState } from "react";
+import axios from "axios";
 
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+// Totals come from a summary refreshed every minute or so, not in real time
 const Referral = ({ user }) => {
-  const referralLink = `https://olyst.com/?ref=${user.referralCode}`;
+  const [summary, setSummary] = useState(null);
+
+  useEffect(() => {
+    axios.get(`${API}/me/referrals`)
+      .then(response => setSummary(response.data))
+      .catch(() => setSummary(null));
+  }, [user.id]);
+
+  const referralCode = summary?.referral_code || user.referral_code;
+  if (!referralCode) return null;
+  const referralLink = `https://olyst.com/?ref=${referralCode}`;
   return (
     <div className="referral-section">
       <h3>Parrainez vos amis !</h3>
@@ -12,8 +26,15 @@ const Referral = ({ user }) => {
       <button onClick={() => navigator.clipboard.writeText(referralLink)}>
         Copier le lien
       </button>
+      {summary && (
+        <ul>
+          <li>Inscriptions : {summary.signups}</li>
+          <li>Achats : {summary.purchases}</li>
+          <li>Récompenses : {summary.rewards_total.toFixed(2)}€</li>
+        </ul>
+      )}
     </div>
   );
 };
 
-export default Referral;
\ No newline at end of file
+export default Referral;
@@ -1,6 +1,9 @@
 import React from "react";
 import Referral from "./Referral";
 
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+
+// purchases: items from GET /api/me/library; download links expire after a few minutes
 const UserDashboard = ({ user, purchases }) => (
   <div>
     <h2>Bienvenue, {user.name} !</h2>
@@ -10,11 +13,13 @@ const UserDashboard = ({ user, purchases }) => (
     ) : (
       <ul>
         {purchases.map((item) => (
-          <li key={item.id}>
-            {item.productName} — {item.date}
-            <a href={item.downloadUrl} download>
-              <button>Télécharger</button>
-            </a>
+          <li key={item.product_id}>
+            {item.name} — {new Date(item.purchased_at).toLocaleDateString()}
+            {item.download_url && (
+              <a href={`${BACKEND_URL}${item.download_url}`} download>
+                <button>Télécharger</button>
+              </a>
+            )}
           </li>
         ))}
       </ul>
@@ -23,4 +28,4 @@ const UserDashboard = ({ user, purchases }) => (
   </div>
 );
 
-export default UserDashboard;
\ No newline at end of file
+export default UserDashboard;
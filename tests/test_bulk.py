@@ -0,0 +1,145 @@
+import base64
+import unittest
+import uuid
+
+import tests
+from bulk import RowError, csv_line, iter_lines, parse_csv, parse_records
+
+
+async def chunked(data: bytes, size: int):
+    for offset in range(0, len(data), size):
+        yield data[offset:offset + size]
+
+
+async def collect(iterator) -> list:
+    return [item async for item in iterator]
+
+
+async def parse(fmt: str, data: bytes, chunk_size: int = 7, max_line_bytes: int = 1024) -> list:
+    return await collect(parse_records(fmt, chunked(data, chunk_size), max_line_bytes))
+
+
+class IterLinesTest(unittest.IsolatedAsyncioTestCase):
+    async def test_splits_across_chunk_boundaries(self):
+        data = b"first\r\nsecond\n\nthird"
+        for size in (1, 3, len(data)):
+            with self.subTest(chunk_size=size):
+                self.assertEqual(await collect(iter_lines(chunked(data, size), 64)), [b"first", b"second", b"", b"third"])
+
+    async def test_rejects_overlong_lines(self):
+        with self.assertRaisesRegex(RowError, "longer than 8 bytes"):
+            await collect(iter_lines(chunked(b"short\n" + b"x" * 20 + b"\n", 4), 8))
+
+
+class ParseCsvTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rows_become_dicts(self):
+        rows = await parse("csv", "\ufeffname, price ,category\nGuide,10,\nAlbum,5,music\n".encode())
+        self.assertEqual(rows, [
+            (1, {"name": "Guide", "price": "10", "category": None}),
+            (2, {"name": "Album", "price": "5", "category": "music"}),
+        ])
+
+    async def test_quoted_fields_span_lines(self):
+        data = (
+            'name,description,price\r\n'
+            '"Guide","Line one\r\n'
+            '\r\n'
+            'He said ""hi""\r\n'
+            'last, with a comma",10\r\n'
+            'Album,plain,5\r\n'
+        ).encode()
+        rows = await parse("csv", data, chunk_size=5)
+        self.assertEqual(rows, [
+            (1, {"name": "Guide", "description": 'Line one\n\nHe said "hi"\nlast, with a comma', "price": "10"}),
+            (2, {"name": "Album", "description": "plain", "price": "5"}),
+        ])
+
+    async def test_column_count_errors_are_reported_per_row(self):
+        rows = await parse("csv", b'name,price\nGuide,10\nAlbum\n"Box, large",3,extra\nPen,1\n')
+        self.assertEqual([row for row, _ in rows], [1, 2, 3, 4])
+        self.assertEqual(str(rows[1][1]), "expected 2 columns, got 1")
+        self.assertEqual(str(rows[2][1]), "expected 2 columns, got 3")
+        self.assertEqual(rows[3], (4, {"name": "Pen", "price": "1"}))
+
+    async def test_blank_lines_are_skipped(self):
+        rows = await parse("csv", b"name,price\n\nGuide,10\n,\n")
+        self.assertEqual(rows, [(1, {"name": "Guide", "price": "10"})])
+
+    async def test_unterminated_quote_at_end_of_file(self):
+        rows = await parse("csv", b'name,price\nGuide,10\n"Album,5\nPen,1\n')
+        self.assertEqual(rows[0], (1, {"name": "Guide", "price": "10"}))
+        self.assertEqual((rows[1][0], str(rows[1][1])), (2, "unterminated quoted field"))
+
+    async def test_unbalanced_quote_cannot_swallow_the_upload(self):
+        data = b'name,price\n"Guide,10\n' + b"Album,5\n" * 50
+
+        async def lines():
+            for line in data.split(b"\n"):
+                yield line
+
+        with self.assertRaisesRegex(RowError, "row longer than 100 bytes"):
+            await collect(parse_csv(lines(), max_row_bytes=100))
+
+    async def test_invalid_utf8_is_a_row_error(self):
+        rows = await parse("csv", b"name,price\n\xff\xfe,1\nPen,1\n")
+        self.assertIsInstance(rows[0][1], RowError)
+        self.assertEqual(rows[1], (2, {"name": "Pen", "price": "1"}))
+
+    async def test_round_trips_csv_line(self):
+        values = ["Guide", 'multi\nline "quoted", text', None, 10]
+        rows = await parse("csv", (csv_line(["a", "b", "c", "d"]) + csv_line(values)).encode())
+        self.assertEqual(rows, [(1, {"a": "Guide", "b": 'multi\nline "quoted", text', "c": None, "d": "10"})])
+
+
+class ParseNdjsonTest(unittest.IsolatedAsyncioTestCase):
+    async def test_records_and_errors(self):
+        rows = await parse("ndjson", b'{"name": "Guide"}\n\nnot json\n[1, 2]\n{"name": "Pen"}')
+        self.assertEqual(rows[0], (1, {"name": "Guide"}))
+        self.assertIn("invalid JSON", str(rows[1][1]))
+        self.assertEqual(str(rows[2][1]), "expected a JSON object")
+        self.assertEqual(rows[3], (4, {"name": "Pen"}))
+
+
+class ProductImportTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = tests.load_server()
+        self.admin = {"id": str(uuid.uuid4())}
+        self.product = self.server.Product(
+            name="Guide", description="A guide", price=10, category="ebooks", created_by=self.admin["id"],
+            image_blob_id="old-image", media={"thumbnails": {"320": "thumb.webp"}, "preview": "clip.mp3"}
+        ).dict()
+        await self.server.db.products.insert_one(dict(self.product))
+
+    async def import_rows(self, *records: dict) -> dict:
+        result = self.server.ImportResult()
+        batch = [(row, *await self.server.product_import_operation(record, self.admin))
+                 for row, record in enumerate(records, 1)]
+        await self.server.write_import_batch(batch, result)
+        self.assertEqual(result.errors, [])
+        return await self.server.db.products.find_one({"id": self.product["id"]})
+
+    def row(self, **fields) -> dict:
+        return {"id": self.product["id"], "name": "Guide", "description": "A guide", "price": "12",
+                "category": "ebooks", **fields}
+
+    async def test_replaced_image_drops_its_thumbnails(self):
+        product = await self.import_rows(self.row(image_base64=base64.b64encode(b"new image").decode()))
+        self.assertNotEqual(product["image_blob_id"], "old-image")
+        self.assertEqual(product["media"], {"preview": "clip.mp3"})
+        self.assertEqual((product["price"], product["version"]), (12, 2))
+
+    async def test_rows_without_media_keep_derived_assets(self):
+        product = await self.import_rows(self.row())
+        self.assertEqual(product["media"], self.product["media"])
+
+    async def test_is_active_round_trips(self):
+        self.assertFalse((await self.import_rows(self.row(is_active="False")))["is_active"])
+        # Left out, the current state is kept
+        self.assertFalse((await self.import_rows(self.row()))["is_active"])
+        self.assertTrue((await self.import_rows(self.row(is_active="True")))["is_active"])
+
+    async def test_upsert_with_media_creates_the_product(self):
+        row = self.row(id=str(uuid.uuid4()), image_base64=base64.b64encode(b"image").decode(), is_active=None)
+        await self.import_rows(row)
+        product = await self.server.db.products.find_one({"id": row["id"]})
+        self.assertEqual((product["name"], product["is_active"], product["version"]), ("Guide", True, 1))
@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+
+from bson import ObjectId
+from pymongo.errors import CollectionInvalid
+
+import tests
+
+
+class MongoInvalidationBusTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        from cache import MongoInvalidationBus
+
+        await super().asyncSetUp()
+        self.bus = MongoInvalidationBus(self.db, collection_name=f"invalidations_{uuid.uuid4().hex}",
+                                        retry_interval=0.05)
+        self.received = []
+        self.bus.subscribe("products", self.received.append)
+        # Published before this worker started: never delivered
+        await self.publish("before start", minutes=60)
+        # mongomock has no capped collections; pretend it already exists
+        with mock.patch.object(self.db, "create_collection", side_effect=CollectionInvalid("exists")):
+            await self.bus.start()
+
+    async def asyncTearDown(self):
+        await self.bus.stop()
+        await super().asyncTearDown()
+
+    async def publish(self, message: str, minutes: int, origin: str = "other worker"):
+        # Another process's clock: its ObjectIds sort apart from insertion order
+        _id = ObjectId.from_datetime(datetime.utcnow() + timedelta(minutes=minutes))
+        await self.bus.collection.insert_one({"_id": _id, "channel": "products", "message": message, "origin": origin})
+
+    async def wait_for(self, count: int):
+        for _ in range(100):
+            if len(self.received) >= count:
+                return
+            await asyncio.sleep(0.05)
+        self.fail(f"received {self.received}, expected {count} message(s)")
+
+    async def test_messages_with_older_ids_are_delivered_in_insertion_order(self):
+        await self.publish("first", minutes=-60)
+        await self.publish("own", minutes=-90, origin=self.bus.origin)
+        await self.publish("second", minutes=-120)
+        await self.wait_for(2)
+        # The listener resumes after "second" although newer ids were seen before it
+        await self.publish("third", minutes=-30)
+        await self.wait_for(3)
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.received, ["first", "second", "third"])
+
+    async def test_overwritten_position_delivers_what_is_left(self):
+        await self.publish("first", minutes=-60)
+        await self.wait_for(1)
+        # The capped collection wrapped: the last seen message is gone
+        await self.bus.collection.delete_many({})
+        await self.publish("second", minutes=-120)
+        await self.wait_for(2)
+        self.assertEqual(self.received, ["first", "second"])
+
+
+class ProductResponseCacheTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.admin = await self.auth_headers(await self.create_user(is_admin=True))
+        # A category of its own keeps the listing independent of other tests
+        self.category = uuid.uuid4().hex
+        product = self.server.Product(name="Guide", description="A guide", price=10, category=self.category,
+                                      created_by="admin")
+        await self.db.products.insert_one(product.dict())
+        self.product_id = product.id
+        self.urls = [f"/api/products?category={self.category}", f"/api/products/{self.product_id}"]
+
+    async def prices(self) -> list:
+        listing, detail = [(await self.client.get(url)).json() for url in self.urls]
+        return [[item["price"] for item in listing["items"]], detail["price"]]
+
+    async def test_product_writes_invalidate_listing_and_detail(self):
+        self.assertEqual(await self.prices(), [[10], 10])
+        # Changed behind the API's back: still served from the cache
+        await self.db.products.update_one({"id": self.product_id}, {"$set": {"price": 11}})
+        self.assertEqual(await self.prices(), [[10], 10])
+
+        response = await self.client.patch(f"/api/products/{self.product_id}", json={"price": 12, "version": 1},
+                                           headers=self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.prices(), [[12], 12])
+
+        response = await self.client.delete(f"/api/products/{self.product_id}", headers=self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((await self.client.get(self.urls[0])).json()["items"], [])
+        self.assertEqual((await self.client.get(self.urls[1])).status_code, 404)
+
+    async def test_if_none_match_returns_not_modified(self):
+        etags = {}
+        for url in self.urls:
+            with self.subTest(url=url):
+                first = await self.client.get(url)
+                etags[url] = etag = first.headers["ETag"]
+                self.assertIn("max-age=", first.headers["Cache-Control"])
+                for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+                    response = await self.client.get(url, headers={"If-None-Match": if_none_match})
+                    self.assertEqual((response.status_code, response.content), (304, b""))
+                    self.assertEqual(response.headers["ETag"], etag)
+                self.assertEqual((await self.client.get(url, headers={"If-None-Match": '"other"'})).status_code, 200)
+
+        response = await self.client.patch(f"/api/products/{self.product_id}", json={"price": 12, "version": 1},
+                                           headers=self.admin)
+        self.assertEqual(response.status_code, 200)
+        for url, etag in etags.items():
+            with self.subTest(url=url, after_write=True):
+                response = await self.client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
@@ -0,0 +1,78 @@
+import os
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import tests
+
+
+class SignedDownloadTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        blob = await self.server.blob_store.put_bytes(b"%PDF-1.7 guide")
+        product = self.server.Product(
+            name="Guide", description="A guide", price=10, category="ebooks", created_by="admin",
+            file_blob_id=blob.id, file_name="guide.pdf", file_type="application/pdf"
+        )
+        await self.db.products.insert_one(product.dict())
+        self.product_id = product.id
+        self.buyer = await self.create_user()
+        await self.db.entitlements.insert_one(
+            self.server.Entitlement(user_id=self.buyer["id"], product_id=product.id, order_id="order").dict()
+        )
+
+    async def link(self, user: dict):
+        return await self.client.get(f"/api/me/library/{self.product_id}/download", headers=await self.auth_headers(user))
+
+    async def download(self, **params):
+        return await self.client.get(f"/api/products/{self.product_id}/file", params=params)
+
+    async def signed_params(self) -> dict:
+        url = (await self.link(self.buyer)).json()["download_url"]
+        return {name: values[0] for name, values in parse_qs(urlsplit(url).query).items()}
+
+    async def test_entitled_user_downloads(self):
+        response = await self.download(**await self.signed_params())
+        self.assertEqual((response.status_code, response.content), (200, b"%PDF-1.7 guide"))
+
+    async def test_user_without_entitlement_gets_no_link(self):
+        self.assertEqual((await self.link(await self.create_user())).status_code, 404)
+
+    async def test_link_is_bound_to_its_user(self):
+        other = await self.create_user()
+        params = await self.signed_params()
+        self.assertEqual((await self.download(**dict(params, uid=other["id"]))).status_code, 403)
+
+    async def test_tampered_signature_is_rejected(self):
+        params = await self.signed_params()
+        tampered = ("0" if params["sig"][0] != "0" else "1") + params["sig"][1:]
+        for changed in ({"sig": tampered}, {"expires": str(int(params["expires"]) + 3600)}, {"sig": ""}):
+            with self.subTest(changed=changed):
+                self.assertEqual((await self.download(**dict(params, **changed))).status_code, 403)
+
+    async def test_expired_link_is_rejected(self):
+        params = await self.signed_params()
+        with mock.patch("time.time", return_value=int(params["expires"]) + 1):
+            response = await self.download(**params)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("expiré", response.json()["detail"])
+
+
+class DownloadSecretCheckTest(unittest.TestCase):
+    def check(self, **environ):
+        with mock.patch.dict(os.environ, environ):
+            if "DOWNLOAD_URL_SECRET" not in environ:
+                os.environ.pop("DOWNLOAD_URL_SECRET", None)
+            tests.load_server().check_download_url_secret()
+
+    def test_missing_secret_warns_with_one_worker(self):
+        with self.assertLogs("server", "WARNING"):
+            self.check(WEB_CONCURRENCY="1")
+
+    def test_missing_secret_refuses_several_workers(self):
+        with self.assertRaisesRegex(RuntimeError, "DOWNLOAD_URL_SECRET"):
+            self.check(WEB_CONCURRENCY="4")
+
+    def test_secret_set(self):
+        with self.assertNoLogs("server", "WARNING"):
+            self.check(DOWNLOAD_URL_SECRET="shared", WEB_CONCURRENCY="4")
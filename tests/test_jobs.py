@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+import uuid
+from datetime import datetime, timedelta
+
+import tests
+
+
+class JobQueueLeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        from jobs import JobQueue
+
+        self.collection = tests.load_server().db[f"jobs_{uuid.uuid4().hex}"]
+        self.runs = []
+
+        async def handler(job):
+            self.runs.append(job["payload"]["n"])
+            await asyncio.sleep(job["payload"].get("seconds", 0))
+
+        self.queue = JobQueue(self.collection, handler, name="test", concurrency=0, max_attempts=2,
+                              lease_seconds=0.3, heartbeat_seconds=0.05)
+        await self.queue.start()
+
+    async def test_heartbeat_keeps_long_jobs_leased(self):
+        await self.queue.enqueue({"n": 1, "seconds": 0.8})
+        first = asyncio.create_task(self.queue.run_job(await self.queue.claim()))
+        # Well past the original lease, the job must still be ours alone
+        await asyncio.sleep(0.5)
+        self.assertIsNone(await self.queue.claim())
+        await first
+        job = await self.collection.find_one({})
+        self.assertEqual((job["status"], job["attempts"], self.runs), ("done", 1, [1]))
+
+    async def test_expired_lease_is_retried_until_max_attempts(self):
+        await self.queue.enqueue({"n": 1})
+        # Two workers crash in turn: claimed, never finished
+        for attempt in (1, 2):
+            job = await self.queue.claim()
+            self.assertEqual(job["attempts"], attempt)
+            await self.collection.update_one({"_id": job["_id"]}, {"$set": {"locked_until": datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertIsNone(await self.queue.claim())
+        self.assertEqual(await self.queue.fail_abandoned(), 1)
+        job = await self.collection.find_one({})
+        self.assertEqual(job["status"], "failed")
+
+    async def test_stale_worker_cannot_overwrite_new_owner(self):
+        await self.queue.enqueue({"n": 1})
+        stale = await self.queue.claim()
+        await self.collection.update_one({"_id": stale["_id"]}, {"$set": {"locked_until": datetime.utcnow() - timedelta(seconds=1)}})
+        current = await self.queue.claim()
+        await self.queue.run_job(stale)
+        job = await self.collection.find_one({})
+        self.assertEqual((job["status"], job["lock_id"]), ("running", current["lock_id"]))
@@ -0,0 +1,102 @@
+import base64
+import io
+import unittest
+import uuid
+
+from fastapi import HTTPException
+from PIL import Image
+
+import tests
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+
+
+class DecodeBase64FieldTest(unittest.TestCase):
+    def setUp(self):
+        self.decode = tests.load_server().decode_base64_field
+
+    def test_bare_base64(self):
+        self.assertEqual(self.decode(base64.b64encode(PNG).decode(), "image_base64"), PNG)
+
+    def test_data_url(self):
+        for media_type in ("image/png", "image/svg+xml", "application/octet-stream", ""):
+            value = f"data:{media_type};base64," + base64.b64encode(PNG).decode()
+            with self.subTest(media_type=media_type):
+                self.assertEqual(self.decode(value, "image_base64"), PNG)
+
+    def test_line_wrapped(self):
+        encoded = base64.encodebytes(PNG).decode()
+        self.assertIn("\n", encoded)
+        self.assertEqual(self.decode(encoded, "file_base64"), PNG)
+
+    def test_rejects_invalid_payloads(self):
+        encoded = base64.b64encode(PNG).decode()
+        for value in ("not base64!", "data:text/plain,hello", f"data:image/png;base64,{encoded}*", encoded[:-1]):
+            with self.subTest(value=value[:30]), self.assertRaises(HTTPException) as raised:
+                self.decode(value, "image_base64")
+            self.assertEqual(raised.exception.status_code, 400)
+
+
+class ParseRangeHeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.parse = tests.load_server().parse_range_header
+
+    def assertUnsatisfiable(self, header: str, size: int):
+        with self.assertRaises(HTTPException) as raised:
+            self.parse(header, size)
+        self.assertEqual(raised.exception.status_code, 416)
+        self.assertEqual(raised.exception.headers["Content-Range"], f"bytes */{size}")
+
+    def test_closed_range(self):
+        self.assertEqual(self.parse("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(self.parse("bytes=500-1999", 1000), (500, 999))
+
+    def test_open_ended_range(self):
+        self.assertEqual(self.parse("bytes=100-", 1000), (100, 999))
+        self.assertEqual(self.parse("bytes=999-", 1000), (999, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(self.parse("bytes=-100", 1000), (900, 999))
+        self.assertEqual(self.parse("bytes=-5000", 1000), (0, 999))
+
+    def test_unsatisfiable(self):
+        self.assertUnsatisfiable("bytes=1000-", 1000)
+        self.assertUnsatisfiable("bytes=1000-1100", 1000)
+        self.assertUnsatisfiable("bytes=-0", 1000)
+        self.assertUnsatisfiable("bytes=0-", 0)
+
+    def test_ignored_headers_serve_the_full_body(self):
+        for header in (None, "", "items=0-1", "bytes=0-1,5-6", "bytes=-", "bytes=a-b", "bytes=--5", "bytes=10-5"):
+            with self.subTest(header=header):
+                self.assertIsNone(self.parse(header, 1000))
+
+
+class MediaDerivationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = tests.load_server()
+        self.server.media_jobs.concurrency = 0
+        await self.server.media_jobs.start()
+        self.blob_ids = []
+        for color in ("red", "blue"):
+            image = io.BytesIO()
+            Image.new("RGB", (64, 64), color).save(image, "PNG")
+            self.blob_ids.append((await self.server.blob_store.put_bytes(image.getvalue())).id)
+        self.product_id = str(uuid.uuid4())
+        await self.server.db.products.insert_one({"id": self.product_id, "name": "Guide"})
+
+    async def switch_image(self, blob_id: str) -> dict:
+        server = self.server
+        await server.db.products.update_one(
+            {"id": self.product_id},
+            server.product_update({"image_blob_id": blob_id}, {"image_blob_id": blob_id})
+        )
+        await server.schedule_media_derivation({"id": self.product_id, "image_blob_id": blob_id})
+        while job := await server.media_jobs.claim():
+            await server.media_jobs.run_job(job)
+        return await server.db.products.find_one({"id": self.product_id})
+
+    async def test_switching_back_to_earlier_image_derives_it_again(self):
+        first, second = self.blob_ids
+        for blob_id in (first, second, first):
+            product = await self.switch_image(blob_id)
+            self.assertIn("thumbnails", product.get("media", {}), blob_id)
@@ -0,0 +1,79 @@
+import uuid
+from unittest import mock
+
+from pymongo import ASCENDING, IndexModel
+
+import tests
+
+
+class IdempotentOrderTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # mongomock ignores partialFilterExpression; sparse is the same here,
+        # only keyed orders carry the field
+        await self.db.orders.create_indexes([
+            IndexModel([("idempotency_key", ASCENDING)], name="orders_idempotency_key_test", unique=True, sparse=True)
+        ])
+        product = self.server.Product(name="Guide", description="A guide", price=10, category="ebooks", created_by="admin")
+        await self.db.products.insert_one(product.dict())
+        self.body = {"items": [{"product_id": product.id, "quantity": 2}], "user_email": "guest@example.com"}
+        self.key = uuid.uuid4().hex
+
+    async def order(self, headers=None, body=None, key=None):
+        headers = dict(headers or {}, **{"Idempotency-Key": key or self.key})
+        response = await self.client.post("/api/orders", json=body or self.body, headers=headers)
+        self.assertEqual(response.status_code, 200, response.text)
+        return response.json()
+
+    async def keyed_orders(self) -> int:
+        return await self.db.orders.count_documents({"idempotency_key": {"$regex": f":{self.key}$"}})
+
+    async def test_replay_returns_the_same_order(self):
+        headers = await self.auth_headers(await self.create_user())
+        first, again = await self.order(headers), await self.order(headers)
+        # Mongo stores created_at to the millisecond; the first response has microseconds
+        self.assertEqual({**again, "created_at": None}, {**first, "created_at": None})
+        self.assertEqual(await self.keyed_orders(), 1)
+
+    async def test_reused_key_with_another_cart_is_rejected(self):
+        await self.order()
+        body = dict(self.body, items=[dict(self.body["items"][0], quantity=3)])
+        response = await self.client.post("/api/orders", json=body, headers={"Idempotency-Key": self.key})
+        self.assertEqual(response.status_code, 422)
+
+    async def test_keys_are_scoped_per_user(self):
+        first, second = [await self.auth_headers(await self.create_user()) for _ in range(2)]
+        orders = [await self.order(first), await self.order(second), await self.order()]
+        self.assertEqual(len({order["id"] for order in orders}), 3)
+        self.assertEqual(await self.keyed_orders(), 3)
+        # The guest's order is replayed like anyone else's
+        self.assertEqual((await self.order())["id"], orders[2]["id"])
+
+    async def test_losing_a_concurrent_insert_returns_the_winner(self):
+        find_idempotent_order = self.server.find_idempotent_order
+        winner = {}
+
+        async def racing(idempotency_key, request_hash):
+            if not winner:
+                # A retry with the same key inserts between our lookup and our insert
+                order = self.server.Order(products=[], total_amount=20, user_email="guest@example.com").dict()
+                winner.update(order)
+                await self.db.orders.insert_one(dict(order, idempotency_key=idempotency_key, request_hash=request_hash))
+                return None
+            return await find_idempotent_order(idempotency_key, request_hash)
+
+        with mock.patch.object(self.server, "find_idempotent_order", racing):
+            order = await self.order()
+        self.assertEqual(order["id"], winner["id"])
+        self.assertEqual(await self.keyed_orders(), 1)
+
+    async def test_client_prices_are_ignored(self):
+        body = {
+            "items": [dict(self.body["items"][0], price=0.01, name="Free")],
+            "user_email": "guest@example.com",
+            "total_amount": 0.02,
+            "status": "completed",
+        }
+        order = await self.order(body=body)
+        self.assertEqual((order["total_amount"], order["status"]), (20, "pending"))
+        self.assertEqual([(item["name"], item["price"]) for item in order["products"]], [("Guide", 10)])
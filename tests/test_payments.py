@@ -0,0 +1,162 @@
+import json
+import time
+import unittest
+import uuid
+
+import tests
+from payments import InvalidSignature, event_transition, sign_payload, verify_signature
+
+SECRET = "whsec_test"
+
+
+def approved_event(order_id: str, amount, currency="XOF", event_id=None) -> dict:
+    return {
+        "id": event_id or str(uuid.uuid4()),
+        "name": "transaction.approved",
+        "entity": {
+            "id": 4242,
+            "amount": amount,
+            "currency": {"iso": currency},
+            "custom_metadata": {"order_id": order_id},
+        },
+    }
+
+
+class VerifySignatureTest(unittest.TestCase):
+    payload = b'{"id": "evt_1", "name": "transaction.approved"}'
+
+    def test_accepts_valid_signature(self):
+        verify_signature(self.payload, sign_payload(self.payload, SECRET), SECRET)
+
+    def test_rejects_wrong_secret(self):
+        with self.assertRaisesRegex(InvalidSignature, "mismatch"):
+            verify_signature(self.payload, sign_payload(self.payload, "other"), SECRET)
+
+    def test_rejects_tampered_payload(self):
+        header = sign_payload(self.payload, SECRET)
+        with self.assertRaisesRegex(InvalidSignature, "mismatch"):
+            verify_signature(self.payload.replace(b"approved", b"declined"), header, SECRET)
+
+    def test_rejects_stale_timestamp(self):
+        header = sign_payload(self.payload, SECRET, timestamp=int(time.time()) - 301)
+        with self.assertRaisesRegex(InvalidSignature, "tolerance"):
+            verify_signature(self.payload, header, SECRET, tolerance=300)
+
+    def test_rejects_future_timestamp(self):
+        header = sign_payload(self.payload, SECRET, timestamp=int(time.time()) + 301)
+        with self.assertRaisesRegex(InvalidSignature, "tolerance"):
+            verify_signature(self.payload, header, SECRET, tolerance=300)
+
+    def test_rejects_malformed_headers(self):
+        digest = sign_payload(self.payload, SECRET).split(",s=", 1)[1]
+        for header in (None, "", "garbage", f"s={digest}", f"t=soon,s={digest}", f"t={int(time.time())}"):
+            with self.subTest(header=header), self.assertRaisesRegex(InvalidSignature, "malformed"):
+                verify_signature(self.payload, header, SECRET)
+
+
+class EventTransitionTest(unittest.TestCase):
+    def test_extracts_amount_and_currency(self):
+        transition = event_transition(approved_event("o1", 2500, "xof"))
+        self.assertEqual(transition.order_id, "o1")
+        self.assertEqual(transition.status, "completed")
+        self.assertEqual(transition.transaction_id, "4242")
+        self.assertEqual((transition.amount, transition.currency), (2500.0, "XOF"))
+        self.assertTrue(transition.pays_for(2500, "XOF"))
+        self.assertFalse(transition.pays_for(2501, "XOF"))
+        self.assertFalse(transition.pays_for(2500, "EUR"))
+
+    def test_missing_amount_never_pays(self):
+        event = approved_event("o1", 2500)
+        del event["entity"]["amount"]
+        self.assertFalse(event_transition(event).pays_for(2500, "XOF"))
+
+    def test_ignores_unknown_events(self):
+        self.assertIsNone(event_transition({"name": "customer.created", "entity": {}}))
+        self.assertIsNone(event_transition({"name": "transaction.approved", "entity": {"id": 1}}))
+
+
+class ApplyPaymentEventTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = tests.load_server()
+        self.fulfilled = []
+
+        async def record(order):
+            self.fulfilled.append(order["id"])
+
+        self.server.order_completed_hooks.append(record)
+        self.addCleanup(self.server.order_completed_hooks.remove, record)
+        self.order = self.server.Order(
+            user_email=f"{uuid.uuid4()}@example.com",
+            products=[self.server.OrderItem(product_id=str(uuid.uuid4()), name="Guide", price=2500)],
+            total_amount=2500
+        ).dict()
+        await self.server.db.orders.insert_one(dict(self.order))
+
+    async def apply(self, event: dict):
+        await self.server.apply_payment_event({"payload": event})
+        return await self.server.db.orders.find_one({"id": self.order["id"]})
+
+    async def test_matching_payment_completes_and_fulfils(self):
+        order = await self.apply(approved_event(self.order["id"], 2500))
+        self.assertEqual(order["status"], "completed")
+        self.assertEqual(order["payment_reference"], "4242")
+        self.assertEqual(self.fulfilled, [self.order["id"]])
+
+    async def test_duplicate_event_is_a_no_op(self):
+        event = approved_event(self.order["id"], 2500)
+        first = await self.apply(event)
+        second = await self.apply(event)
+        self.assertEqual(second["updated_at"], first["updated_at"])
+        self.assertEqual(second["fulfilled_at"], first["fulfilled_at"])
+        self.assertEqual(self.fulfilled, [self.order["id"]])
+
+    async def test_underpayment_is_recorded_not_fulfilled(self):
+        order = await self.apply(approved_event(self.order["id"], 1))
+        self.assertEqual(order["status"], "pending")
+        self.assertEqual(order["payment_mismatch"]["amount"], 1)
+        self.assertEqual(self.fulfilled, [])
+
+    async def test_wrong_currency_is_recorded_not_fulfilled(self):
+        order = await self.apply(approved_event(self.order["id"], 2500, "USD"))
+        self.assertEqual(order["status"], "pending")
+        self.assertEqual(order["payment_mismatch"]["currency"], "USD")
+        self.assertEqual(self.fulfilled, [])
+
+    async def test_decline_after_completion_is_ignored(self):
+        await self.apply(approved_event(self.order["id"], 2500))
+        declined = dict(approved_event(self.order["id"], 2500), name="transaction.declined")
+        order = await self.apply(declined)
+        self.assertEqual(order["status"], "completed")
+
+
+class WebhookEndpointTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        import httpx
+
+        self.server = tests.load_server()
+        self.server.FEDAPAY_WEBHOOK_SECRET = SECRET
+        # Indexes only; no workers, so queued events stay put
+        self.server.payment_jobs.concurrency = 0
+        await self.server.payment_jobs.start()
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.server.app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def post(self, payload: bytes, signature):
+        headers = {"X-FEDAPAY-SIGNATURE": signature} if signature else {}
+        return await self.client.post("/api/payments/fedapay/webhook", content=payload, headers=headers)
+
+    async def test_rejects_bad_signatures(self):
+        payload = json.dumps(approved_event("o1", 2500)).encode()
+        stale = sign_payload(payload, SECRET, timestamp=int(time.time()) - 3600)
+        for signature in (None, "t=1", sign_payload(payload, "other"), stale):
+            with self.subTest(signature=signature):
+                self.assertEqual((await self.post(payload, signature)).status_code, 400)
+
+    async def test_redelivery_is_deduplicated(self):
+        payload = json.dumps(approved_event("o1", 2500)).encode()
+        first = await self.post(payload, sign_payload(payload, SECRET))
+        again = await self.post(payload, sign_payload(payload, SECRET))
+        self.assertEqual(first.json(), {"received": True, "duplicate": False})
+        self.assertEqual(again.json(), {"received": True, "duplicate": True})
@@ -0,0 +1,80 @@
+import json
+import uuid
+from datetime import datetime
+
+import tests
+
+
+class PatchProductTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.admin = await self.auth_headers(await self.create_user(is_admin=True))
+
+    async def insert_product(self, **fields) -> str:
+        product = self.server.Product(
+            name="Guide", description="A guide", price=10, category="ebooks", created_by="admin", **fields
+        ).dict()
+        await self.db.products.insert_one(product)
+        return product["id"]
+
+    async def patch(self, product_id: str, body: dict, if_match=None):
+        headers = dict(self.admin, **({"If-Match": if_match} if if_match else {}))
+        return await self.client.patch(f"/api/products/{product_id}", json=body, headers=headers)
+
+    async def stored(self, product_id: str) -> dict:
+        return await self.db.products.find_one({"id": product_id})
+
+    async def test_version_is_required(self):
+        product_id = await self.insert_product()
+        response = await self.patch(product_id, {"price": 12})
+        self.assertEqual(response.status_code, 428)
+        self.assertEqual((await self.stored(product_id))["price"], 10)
+
+    async def test_stale_version_is_rejected(self):
+        product_id = await self.insert_product(version=3)
+        for body, if_match in (({"price": 12, "version": 2}, None), ({"price": 12}, 'W/"2"')):
+            with self.subTest(if_match=if_match):
+                self.assertEqual((await self.patch(product_id, body, if_match)).status_code, 412)
+        self.assertEqual((await self.stored(product_id))["price"], 10)
+
+    async def test_unknown_product(self):
+        self.assertEqual((await self.patch(str(uuid.uuid4()), {"price": 12, "version": 1})).status_code, 404)
+
+    async def test_matching_version_applies_and_increments(self):
+        product_id = await self.insert_product(version=2)
+        response = await self.patch(product_id, {"price": 12, "version": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()["price"], response.json()["version"]), (12, 3))
+        # If-Match takes precedence over the body
+        response = await self.patch(product_id, {"name": "Atlas", "version": 1}, if_match='"3"')
+        self.assertEqual(response.json()["version"], 4)
+        stored = await self.stored(product_id)
+        self.assertEqual((stored["name"], stored["price"], stored["version"]), ("Atlas", 12, 4))
+        # The edit consumed version 3: replaying it is now stale
+        self.assertEqual((await self.patch(product_id, {"price": 15, "version": 3})).status_code, 412)
+
+    async def test_products_predating_versions_match_version_zero(self):
+        for legacy in ({"$set": {"version": 0}}, {"$unset": {"version": ""}}):
+            with self.subTest(legacy=legacy):
+                product_id = await self.insert_product()
+                await self.db.products.update_one({"id": product_id}, legacy)
+                response = await self.patch(product_id, {"price": 12, "version": 0})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual((await self.stored(product_id))["version"], 1)
+                self.assertEqual((await self.patch(product_id, {"price": 15}, if_match="0")).status_code, 412)
+
+
+class ProductListingFormatTest(tests.ApiTestCase):
+    async def test_ndjson_streams_the_catalog(self):
+        category = uuid.uuid4().hex
+        for day, name in enumerate(("Guide", "Atlas"), 1):
+            product = self.server.Product(name=name, description="", price=10, category=category, created_by="admin",
+                                          created_at=datetime(2026, 3, day))
+            await self.db.products.insert_one(product.dict())
+        response = await self.client.get("/api/products", params={"format": "ndjson", "category": category})
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        self.assertEqual([json.loads(line)["name"] for line in response.text.splitlines()], ["Atlas", "Guide"])
+
+    async def test_ndjson_is_refused_with_search(self):
+        response = await self.client.get("/api/products", params={"format": "ndjson", "search": "guide"})
+        self.assertEqual(response.status_code, 400)
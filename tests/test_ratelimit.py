@@ -0,0 +1,56 @@
+import unittest
+
+import tests  # noqa: F401  (puts backend/ on sys.path)
+from ratelimit import MemoryRateLimitBackend, RateLimiter, parse_rate
+
+LIMIT, WINDOW = 5, 60
+
+
+async def replay(times, limit=LIMIT, window=WINDOW) -> int:
+    """Send one hit at each time on a fresh limiter; return the last result."""
+    clock = iter(times)
+    limiter = RateLimiter(MemoryRateLimitBackend(), clock=lambda: next(clock))
+    result = 0
+    for _ in times:
+        result = await limiter.hit("login:ip:10.0.0.1", limit, window)
+    return result
+
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def assertRetryAfterIsExact(self, history, expected, limit=LIMIT):
+        retry_after = await replay(history, limit)
+        self.assertEqual(retry_after, expected)
+        # A retry after waiting exactly that long goes through, a second earlier it doesn't
+        self.assertEqual(await replay(history + [history[-1] + retry_after], limit), 0)
+        self.assertGreater(await replay(history + [history[-1] + retry_after - 1], limit), 0)
+
+    async def test_allows_up_to_the_limit(self):
+        self.assertEqual(await replay([0] * LIMIT), 0)
+        self.assertGreater(await replay([0] * (LIMIT + 1)), 0)
+
+    async def test_retry_within_the_window(self):
+        # 5 hits last window; at the start of this one a 6th is rejected.
+        # Retrying at 84s: 5 * 36/60 + 2 = 5
+        await self.assertRetryAfterIsExact([0] * 5 + [60], 24)
+
+    async def test_retry_across_a_window_boundary(self):
+        # The 6th hit at 50s can't fit before the boundary at 60s. After it the
+        # 6 hits are weighted down: 6 * 40/60 + 1 = 5 at 80s
+        await self.assertRetryAfterIsExact([0] * 5 + [50], 30)
+
+    async def test_retry_across_a_boundary_at_limit_one(self):
+        # With a limit of 1 the 2 hits must slide out entirely: at 120s, not within 60-120s
+        await self.assertRetryAfterIsExact([10, 20], 100, limit=1)
+
+    async def test_previous_window_is_weighted_by_overlap(self):
+        # Halfway through, 5 hits from last window count as 2.5
+        self.assertEqual(await replay([0] * 5 + [90, 90]), 0)
+        self.assertGreater(await replay([0] * 5 + [90, 90, 90]), 0)
+
+    async def test_old_windows_are_forgotten(self):
+        self.assertEqual(await replay([0] * 10 + [120]), 0)
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate("20/60"), (20, 60))
+        with self.assertRaises(ValueError):
+            parse_rate("20")
@@ -0,0 +1,69 @@
+import unittest
+import uuid
+from datetime import datetime
+from unittest import mock
+
+from pymongo.errors import AutoReconnect
+
+import tests
+
+
+class SalesRollupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = tests.load_server()
+        self.db = self.server.db
+        for name in ("orders", "sales_daily", "sales_products", "sales_categories"):
+            await self.db[name].delete_many({})
+        self.product_ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+
+    async def completed_order(self) -> dict:
+        order = self.server.Order(
+            products=[
+                self.server.OrderItem(product_id=self.product_ids[0], name="Guide", price=10, quantity=2, category="ebooks"),
+                self.server.OrderItem(product_id=self.product_ids[1], name="Album", price=5, category="music"),
+            ],
+            total_amount=25,
+            status="completed"
+        ).dict()
+        order["updated_at"] = datetime(2026, 3, 1, 12)
+        await self.db.orders.insert_one(dict(order))
+        return order
+
+    async def totals(self):
+        daily = await self.db.sales_daily.find_one({"_id": "2026-03-01"}) or {}
+        products = {p["_id"]: p["units"] async for p in self.db.sales_products.find()}
+        categories = {c["category"]: c["revenue"] async for c in self.db.sales_categories.find()}
+        return daily.get("revenue"), daily.get("orders"), products, categories
+
+    async def test_counts_each_order_once(self):
+        orders = [await self.completed_order() for _ in range(3)]
+        for order in orders + orders:
+            await self.server.roll_up_sales(order)
+        revenue, count, products, categories = await self.totals()
+        self.assertEqual((revenue, count), (75, 3))
+        self.assertEqual(products, {self.product_ids[0]: 6, self.product_ids[1]: 3})
+        self.assertEqual(categories, {"ebooks": 60, "music": 15})
+
+    async def test_retry_after_partial_failure_finishes_the_rollup(self):
+        order = await self.completed_order()
+        with mock.patch.object(type(self.db.sales_categories), "bulk_write", side_effect=AutoReconnect("down")):
+            with self.assertRaises(AutoReconnect):
+                await self.server.roll_up_sales(order)
+        self.assertFalse((await self.db.orders.find_one({"id": order["id"]})).get("rolled_up"))
+
+        await self.server.roll_up_sales(order)
+        revenue, count, products, categories = await self.totals()
+        self.assertEqual((revenue, count), (25, 1))
+        self.assertEqual(products, {self.product_ids[0]: 2, self.product_ids[1]: 1})
+        self.assertEqual(categories, {"ebooks": 20, "music": 5})
+        self.assertTrue((await self.db.orders.find_one({"id": order["id"]}))["rolled_up"])
+
+    async def test_guard_is_bounded(self):
+        order = await self.completed_order()
+        order_ids = [str(uuid.uuid4()) for _ in range(3)]
+        with mock.patch.object(self.server, "SALES_ROLLUP_GUARD", 2):
+            for order_id in order_ids:
+                await self.server.apply_sales_rollup(dict(order, id=order_id))
+        daily = await self.db.sales_daily.find_one({"_id": "2026-03-01"})
+        self.assertEqual(daily["orders"], 3)
+        self.assertEqual(daily["order_ids"], order_ids[-2:])
@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import tests
+
+
+class ImportTest(unittest.TestCase):
+    def test_import_builds_no_client_and_reads_no_dotenv(self):
+        # backend/.env sets MONGO_URL; importing must not load it nor connect
+        env = {name: value for name, value in os.environ.items() if name not in ("MONGO_URL", "DB_NAME")}
+        code = "import os, server; assert (server.client, server.db) == (None, None); assert 'MONGO_URL' not in os.environ"
+        subprocess.run([sys.executable, "-c", code], cwd=tests.BACKEND_DIR, env=env, check=True)
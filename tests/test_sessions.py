@@ -0,0 +1,85 @@
+import argparse
+from datetime import datetime, timedelta
+from unittest import mock
+
+import tests
+
+
+class SessionTest(tests.ApiTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.user = await self.create_user()
+
+    async def me(self, token: str) -> int:
+        response = await self.client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+        return response.status_code
+
+    async def new_token(self) -> str:
+        return (await self.auth_headers(self.user))["Authorization"].removeprefix("Bearer ")
+
+    async def session(self, token: str) -> dict:
+        return await self.db.auth_sessions.find_one({"token_hash": self.server.hash_token(token)})
+
+    async def test_only_the_token_hash_is_stored(self):
+        token = await self.new_token()
+        session = await self.session(token)
+        self.assertEqual(session["user_id"], self.user["id"])
+        self.assertNotIn(token, [str(value) for value in session.values()])
+        self.assertEqual(await self.me(token), 200)
+        self.assertEqual(await self.me(session["token_hash"]), 401)
+
+    async def test_least_recently_used_sessions_are_pruned_past_the_cap(self):
+        now = datetime.utcnow()
+        with mock.patch.object(self.server, "SESSION_MAX_PER_USER", 3):
+            tokens = [await self.new_token() for _ in range(3)]
+            # The first session is the one still in use
+            for token, idle in zip(tokens, (0, 3, 2)):
+                await self.db.auth_sessions.update_one(
+                    {"token_hash": self.server.hash_token(token)},
+                    {"$set": {"last_used_at": now - timedelta(hours=idle)}}
+                )
+            tokens.append(await self.new_token())
+        self.assertEqual(await self.db.auth_sessions.count_documents({"user_id": self.user["id"]}), 3)
+        self.assertIsNone(await self.session(tokens[1]))
+        self.assertEqual(await self.me(tokens[1]), 401)
+        for token in (tokens[0], tokens[2], tokens[3]):
+            self.assertEqual(await self.me(token), 200)
+
+    async def test_use_extends_expiry(self):
+        now = datetime.utcnow()
+        fresh, idle = await self.new_token(), await self.new_token()
+        for token, last_used_at in ((fresh, now - timedelta(minutes=1)), (idle, now - timedelta(days=2))):
+            await self.db.auth_sessions.update_one(
+                {"token_hash": self.server.hash_token(token)},
+                {"$set": {"last_used_at": last_used_at, "expires_at": now + timedelta(hours=1)}}
+            )
+            self.assertEqual(await self.me(token), 200)
+        # Used within the refresh interval: no write
+        self.assertLess((await self.session(fresh))["expires_at"], now + timedelta(hours=2))
+        session = await self.session(idle)
+        self.assertGreaterEqual(session["expires_at"], now + self.server.SESSION_TTL - timedelta(seconds=1))
+        self.assertGreaterEqual(session["last_used_at"], now - timedelta(seconds=1))
+
+    async def test_expired_sessions_are_rejected(self):
+        token = await self.new_token()
+        await self.db.auth_sessions.update_one(
+            {"token_hash": self.server.hash_token(token)},
+            {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+        )
+        self.assertEqual(await self.me(token), 401)
+
+    async def test_hash_session_tokens_keeps_existing_sessions_signed_in(self):
+        import manage
+
+        token = "legacy-raw-token"
+        await self.db.auth_sessions.insert_one({
+            "id": "legacy", "user_id": self.user["id"], "token": token,
+            "expires_at": datetime.utcnow() + timedelta(days=1), "created_at": datetime.utcnow(),
+        })
+        self.assertEqual(await self.me(token), 401)
+        await manage.hash_session_tokens(argparse.Namespace())
+        session = await self.db.auth_sessions.find_one({"id": "legacy"})
+        self.assertNotIn("token", session)
+        self.assertEqual(session["token_hash"], self.server.hash_token(token))
+        self.assertIn("last_used_at", session)
+        self.assertEqual(await self.me(token), 200)
@@ -0,0 +1,47 @@
+import hashlib
+import tempfile
+import unittest
+import uuid
+
+import tests  # noqa: F401  (puts backend/ on sys.path)
+from storage import BlobStore, LocalBlobStore
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+class BlobStoreTest(unittest.TestCase):
+    def test_backends_must_implement_every_primitive(self):
+        class Partial(BlobStore):
+            async def put_stream(self, chunks):
+                pass
+
+        with self.assertRaisesRegex(TypeError, "abstract"):
+            Partial()
+
+
+class LocalBlobStoreTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = LocalBlobStore(tempfile.mkdtemp(prefix="olyst-test-blobs-"), chunk_size=4)
+
+    async def test_blobs_are_content_addressed(self):
+        data = b"0123456789"
+        blob = await self.store.put_bytes(data)
+        self.assertEqual((blob.id, blob.size), (hashlib.sha256(data).hexdigest(), 10))
+        self.assertEqual((await self.store.put_bytes(data)).id, blob.id)
+        self.assertEqual(await self.store.read(blob.id), data)
+        self.assertEqual(b"".join([chunk async for chunk in self.store.iter_range(blob.id, 3, 8)]), b"345678")
+        await self.store.delete(blob.id)
+        self.assertIsNone(await self.store.size(blob.id))
+
+    async def test_parts_compose_in_order(self):
+        upload_id = str(uuid.uuid4())
+        await self.store.put_part(upload_id, 2, chunks(b"world"))
+        await self.store.put_part(upload_id, 1, chunks(b"hello ", b"there"))
+        # A retried part replaces the earlier attempt
+        await self.store.put_part(upload_id, 1, chunks(b"hello "))
+        blob = await self.store.compose(upload_id, [1, 2])
+        self.assertEqual(await self.store.read(blob.id), b"hello world")
+        await self.store.delete_parts(upload_id, [1, 2])